@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The notebooks import the helpers as `utils.<module>` with `notebooks/` as the working directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,36 @@
+from utils.candidate_batch import KBTable, to_candidate_batches
+from utils.evalutation import custom_accuracy, evaluate_predictions, hits_at_n_score, mrr_score
+from utils.index_search_helpers import label_search_results
+
+
+def get_candidate(mesh_id, description, score, alt_disease_ids=None):
+    return {'MESH_ID': mesh_id, 'Description': description, 'Synonyms': None, 'AltDiseaseIDs': alt_disease_ids, 'score': score}
+
+def get_predictions() -> list:
+    return [
+        label_search_results([get_candidate('MESH:D001', 'Asthma', 0.9)], 'MESH:D001', 'asthma'),
+        label_search_results([get_candidate('MESH:D002', 'Gout', 0.9), get_candidate('MESH:D003', 'Gouty Arthritis', 0.8)], 'MESH:D003', 'gouty arthritis'),
+        label_search_results([get_candidate('MESH:D004', 'Colitis', 0.9, 'DO:1|MESH:D005')], 'MESH:D005', 'colitis'),
+        label_search_results([], 'MESH:D006', 'unheard of syndrome'),
+        label_search_results([get_candidate('MESH:D001', 'Asthma', 0.7)], 'MESH:D007', 'wheezing')
+    ]
+
+def test_metrics_match_on_batches():
+    predictions = get_predictions()
+    batches = list(to_candidate_batches(predictions, KBTable()))
+    true_values = [{'MESH_ID': candidates[0]['True MESH_ID']} for candidates in predictions]
+
+    assert mrr_score(batches) == mrr_score(predictions)
+    for n in (1, 2, 5):
+        assert hits_at_n_score(batches, n) == hits_at_n_score(predictions, n)
+    assert custom_accuracy(true_values, batches) == custom_accuracy(true_values, predictions)
+    assert evaluate_predictions(batches) == evaluate_predictions(predictions)
+
+def test_empty_batch_holds_placeholder():
+    predictions = get_predictions()
+    batches = list(to_candidate_batches(predictions, KBTable()))
+
+    assert [batch.to_dicts() for batch in batches] == predictions
+    assert len(batches[3]) == 1 and batches[3][0] == predictions[3][0]
+    assert [dict(candidate) for candidate in batches[1][:1]] == predictions[1][:1]
+    assert batches[1][5:] == []
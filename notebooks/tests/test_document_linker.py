@@ -0,0 +1,65 @@
+import pytest
+
+from utils.benchmark import build_standin_driver, get_standin_records, hashed_embedding, load_split
+from utils.document_linker import DocumentLinker, find_abbreviations, find_long_form, make_combined_search_batch
+
+
+@pytest.fixture(scope='module')
+def records() -> list:
+    return get_standin_records(load_split('train'))
+
+
+
+# Excerpts of NCBI disease corpus abstracts
+brca1_text = (
+    'Genetic analysis was undertaken to establish linkage between the breast or ovarian cancer cases and markers '
+    'on chromosomes 17q (BRCA1) and 13q (BRCA2). However, it is not yet clear what proportion of hereditary breast '
+    'cancer is explained by BRCA1 and BRCA2 or by some other unidentified susceptibility gene (s).'
+)
+at_text = (
+    'Comparative genome mapping of the ataxia-telangiectasia region in mouse, rat, and Syrian hamster. '
+    'Chromosomal locations of the Atm (ataxia-telangiectasia (AT) mutated) gene were determined.'
+)
+hfe_text = 'Mutations in the hemochromatosis gene (HFE) The hemochromatosis gene (HFE) is located on 6p.'
+
+def test_long_form():
+    assert find_long_form('APC', 'germline mutations of the adenomatous polyposis coli') == 'adenomatous polyposis coli'
+    assert find_long_form('BRCA1', 'the breast cancer susceptibility gene 1') == 'breast cancer susceptibility gene 1'
+
+def test_long_form_drops_brackets():
+    assert find_abbreviations(at_text)['AT'] == 'ataxia-telangiectasia'
+    assert find_long_form('HFE', '(HFE) The hemochromatosis gene') is None
+
+def test_long_form_word_limit():
+    abbreviations = find_abbreviations(brca1_text)
+
+    assert 'BRCA1' not in abbreviations
+    assert find_long_form('BRCA1', 'linkage between the breast or ovarian cancer cases and markers on chromosomes 17q') is None
+
+def test_long_form_starts_with_short_form():
+    assert find_long_form('CT', 'the patients had a computed tomography') == 'computed tomography'
+    # 'c' starts a word part only, the long form would start with 'x'
+    assert find_long_form('CT', 'an x-computed tomography') is None
+
+def test_short_form_length():
+    assert 's' not in find_abbreviations(brca1_text)
+    assert find_abbreviations('mice homozygous for white spotting (W) alleles') == {}
+    assert find_abbreviations('a novel cardiomyopathy (superlongabbreviation) was found') == {}
+
+def test_search_batch_embeds_once_per_document(records):
+    calls = []
+
+    def embed_batch(texts):
+        calls.append(list(texts))
+        return [hashed_embedding(text).tolist() for text in texts]
+
+    linker = DocumentLinker(make_combined_search_batch(build_standin_driver(records), embed_batch, limit=5))
+    document = {
+        'ID': 1,
+        'Text': at_text,
+        'mentions': [{'Description': 'ataxia-telangiectasia'}, {'Description': 'AT'}, {'Description': 'breast cancer'}]
+    }
+    linked = list(linker.link([document]))
+
+    assert calls == [['ataxia-telangiectasia', 'breast cancer']]
+    assert [mention['resolved_by'] for mention in linked] == ['retrieval', 'abbreviation', 'retrieval']
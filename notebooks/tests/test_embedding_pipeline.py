@@ -0,0 +1,83 @@
+import numpy as np
+
+from utils.embedding_pipeline import run_embedding_pipeline
+from utils.embedding_store import EmbeddingStore
+from utils.generic import Models
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def data(self):
+        return self.rows
+
+    def consume(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def run(self, query, **params):
+        if 'batch' in params:
+            self.driver.writes.setdefault(params['embedding_prop'], []).extend(row['disease_id'] for row in params['batch'])
+            return FakeResult([])
+
+        rows = self.driver.diseases
+        if params.get('disease_ids') is not None:
+            rows = [row for row in rows if row['DiseaseID'] in params['disease_ids']]
+
+        return FakeResult(rows)
+
+
+class FakeDriver:
+    def __init__(self, diseases):
+        self.diseases = diseases
+        self.writes = {}
+
+    def session(self):
+        return FakeSession(self)
+
+
+class FakeEmbedModel:
+    def get_text_embedding_batch(self, texts):
+        return [[float(len(text)), 1.0, 0.0] for text in texts]
+
+
+diseases = [
+    {'DiseaseID': 'MESH:D001', 'DiseaseName': 'Asthma', 'Synonyms': 'Bronchial Asthma|Asthma, Bronchial'},
+    {'DiseaseID': 'MESH:D002', 'DiseaseName': 'Gout', 'Synonyms': None}
+]
+
+def test_full_run_writes_store(tmp_path):
+    driver = FakeDriver(diseases)
+    store = EmbeddingStore(str(tmp_path / 'store'))
+    model = Models.BAAI_BGE_SMALL_EN_V1_5
+
+    run_embedding_pipeline(driver, model, str(tmp_path / 'cache.sqlite'), store=store, embed_model=FakeEmbedModel())
+
+    assert store.exists(model, 'DiseaseEmbedding')
+    assert store.exists(model, 'SynonymsEmbedding')
+
+    disease_matrix = store.load(model, 'DiseaseEmbedding')
+    assert disease_matrix.ids == ['MESH:D001', 'MESH:D002']
+    np.testing.assert_array_equal(disease_matrix.get('MESH:D002'), [4.0, 1.0, 0.0])
+    assert len(store.load(model, 'SynonymsEmbedding').get('MESH:D001')) == 2
+
+def test_partial_run_leaves_store_alone(tmp_path):
+    driver = FakeDriver(diseases)
+    store = EmbeddingStore(str(tmp_path / 'store'))
+    model = Models.BAAI_BGE_SMALL_EN_V1_5
+
+    run_embedding_pipeline(driver, model, str(tmp_path / 'cache.sqlite'), store=store, embed_model=FakeEmbedModel(), disease_ids=['MESH:D002'])
+
+    assert not store.exists(model, 'DiseaseEmbedding')
+    assert all(ids == ['MESH:D002'] for ids in driver.writes.values())
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from utils.embedding_store import EmbeddingMatrix
+from utils.generic import Models
+from utils.index_update_helpers import rebuild_synonym_centroid_embeddings
+
+
+def test_rebuild_rejects_non_ragged_synonym_embeddings():
+    synonym_embeddings = EmbeddingMatrix(np.ones((2, 4)), ['MESH:D1', 'MESH:D2'])
+
+    with pytest.raises(ValueError, match='ragged'):
+        rebuild_synonym_centroid_embeddings(None, Models.BAAI_BGE_SMALL_EN_V1_5, synonym_embeddings=synonym_embeddings)
+
+def test_rebuild_rejects_misaligned_synonym_embeddings():
+    # Three disease IDs but offsets for only two
+    synonym_embeddings = EmbeddingMatrix(np.ones((3, 4)), ['MESH:D1', 'MESH:D2', 'MESH:D3'], np.array([0, 1, 3]))
+
+    with pytest.raises(ValueError, match='offsets'):
+        rebuild_synonym_centroid_embeddings(None, Models.BAAI_BGE_SMALL_EN_V1_5, synonym_embeddings=synonym_embeddings)
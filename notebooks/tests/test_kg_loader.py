@@ -0,0 +1,71 @@
+import pandas as pd
+
+from utils.exact_match_index import ExactMatchIndex
+from utils.kg_loader import disease_properties, update_ctd_diseases
+
+
+class FakeResult:
+    def consume(self):
+        pass
+
+
+class FakeTransaction:
+    def run(self, query, **params):
+        return FakeResult()
+
+
+class FakeSession:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def run(self, query, **params):
+        return [{**properties, 'DiseaseID': disease_id, 'ParentIDs': []} for disease_id, properties in self.nodes.items()]
+
+    def execute_write(self, work):
+        return work(FakeTransaction())
+
+
+class FakeDriver:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def session(self):
+        return FakeSession(self.nodes)
+
+
+def get_properties(name, synonyms=None) -> dict:
+    return {**{prop: None for prop in disease_properties}, 'DiseaseName': name, 'Synonyms': synonyms}
+
+def test_update_keeps_exact_match_index_current(tmp_path):
+    nodes = {
+        'MESH:D001': get_properties('Asthma', 'Bronchial Asthma'),
+        'MESH:D002': get_properties('Gout'),
+        'MESH:D003': get_properties('Colitis')
+    }
+    exact_match_index = ExactMatchIndex(
+        {'MESH_ID': disease_id, 'Description': properties['DiseaseName'], 'Synonyms': properties['Synonyms'], 'AltDiseaseIDs': None}
+        for disease_id, properties in nodes.items()
+    )
+
+    release = pd.DataFrame([
+        {**get_properties('Asthma', 'Asthmatic Disease'), 'DiseaseID': 'MESH:D001', 'ParentIDs': None},
+        {**get_properties('Gout'), 'DiseaseID': 'MESH:D002', 'ParentIDs': None},
+        {**get_properties('Pancreatitis'), 'DiseaseID': 'MESH:D004', 'ParentIDs': None}
+    ])
+    path = str(tmp_path / 'CTD_diseases.csv')
+    release.to_csv(path, index=False)
+
+    diff = update_ctd_diseases(FakeDriver(nodes), path, exact_match_index=exact_match_index)
+
+    assert diff['removed_ids'] == ['MESH:D003']
+    assert exact_match_index.lookup('asthmatic disease')['MESH_ID'] == 'MESH:D001'
+    assert exact_match_index.lookup('bronchial asthma') is None
+    assert exact_match_index.lookup('colitis') is None
+    assert exact_match_index.lookup('pancreatitis')['MESH_ID'] == 'MESH:D004'
+    assert exact_match_index.lookup('gout')['MESH_ID'] == 'MESH:D002'
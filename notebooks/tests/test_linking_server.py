@@ -0,0 +1,142 @@
+import asyncio
+import json
+import time
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from utils.benchmark import build_standin_driver, get_standin_records, load_split
+from utils.linking_server import HashedEmbeddingModel, LinkingService, MicroBatcher, create_app, create_llm_standin_app
+
+
+@pytest.fixture(scope='module')
+def records() -> list:
+    return get_standin_records(load_split('train'))
+
+
+class SlowEmbeddingModel(HashedEmbeddingModel):
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def get_text_embedding_batch(self, texts):
+        time.sleep(self.seconds)
+        return super().get_text_embedding_batch(texts)
+
+async def with_clients(records, test, embed_model=None, **service_kwargs):
+    async with TestClient(TestServer(create_llm_standin_app(tokens_per_second=1000.0))) as llm_client:
+        service = LinkingService(
+            embed_model or HashedEmbeddingModel(),
+            build_standin_driver(records),
+            llm_url=str(llm_client.make_url('/api/generate')),
+            **service_kwargs
+        )
+
+        async with TestClient(TestServer(create_app(service))) as client:
+            return await test(client, service)
+
+def test_concurrent_requests_are_coalesced(records):
+    mentions = [record['Description'] for record in records[:24]]
+
+    async def test(client, service):
+        responses = await asyncio.gather(*[client.post('/link', json={'disease_name': mention}) for mention in mentions])
+        results = [(await response.json())['results'][0] for response in responses]
+        stats = await (await client.get('/stats')).json()
+
+        return results, stats
+
+    results, stats = asyncio.run(with_clients(records, test, max_wait_ms=50.0))
+
+    assert [candidates[0]['Description'] for candidates in results] == mentions
+    assert stats['items'] == len(mentions)
+    assert stats['batches'] < len(mentions)
+    assert stats['max_batch_size'] > 1
+
+def test_results_keep_mention_order(records):
+    mentions = [record['Description'] for record in records[:40]][::-1]
+
+    async def test(client, service):
+        response = await client.post('/link', json={'mentions': mentions, 'limit': 3})
+        expected = service._link_batch_sync(mentions)
+
+        return response.status, await response.json(), expected
+
+    status, body, expected = asyncio.run(with_clients(records, test, max_batch_size=8))
+
+    assert status == 200
+    assert [[candidate['MESH_ID'] for candidate in candidates] for candidates in body['results']] == [
+        [candidate['MESH_ID'] for candidate in candidates[:3]] for candidates in expected
+    ]
+
+def test_overload_is_shed(records):
+    mentions = [record['Description'] for record in records[:3]]
+
+    async def test(client, service):
+        first = asyncio.ensure_future(client.post('/link', json={'mentions': mentions}))
+        await asyncio.sleep(0.05)
+
+        overloaded = await client.post('/link', json={'mentions': mentions})
+        too_large = await client.post('/link', json={'mentions': mentions * 2})
+
+        return (await first).status, overloaded.status, overloaded.headers.get('Retry-After'), too_large.status
+
+    first, overloaded, retry_after, too_large = asyncio.run(
+        with_clients(records, test, embed_model=SlowEmbeddingModel(0.3), max_pending=4, max_wait_ms=1.0)
+    )
+
+    assert first == 200
+    assert overloaded == 503 and retry_after == '1'
+    assert too_large == 413
+
+def test_bad_requests(records):
+    async def test(client, service):
+        return [
+            (await client.post('/link', data='{"mentions": [', headers={'Content-Type': 'application/json'})).status,
+            (await client.post('/link', json=['asthma'])).status,
+            (await client.post('/link', json={'mentions': [1]})).status,
+            (await client.post('/link', json={'mentions': ['asthma'], 'limit': 'abc'})).status,
+            (await client.post('/link', json={'mentions': ['asthma'], 'limit': 0})).status,
+            (await client.post('/link', json={'mentions': ['asthma'], 'limit': service.limit + 1})).status,
+            (await client.post('/generate', data='not json')).status
+        ]
+
+    assert asyncio.run(with_clients(records, test)) == [400] * 7
+
+def test_generate_streams_tokens(records):
+    disease_name = records[0]['Description']
+
+    async def test(client, service):
+        response = await client.post('/generate', json={'disease_name': disease_name, 'limit': 2})
+        lines = [json.loads(line) async for line in response.content if line.strip()]
+
+        return response.status, response.headers['Content-Type'], lines
+
+    status, content_type, lines = asyncio.run(with_clients(records, test))
+
+    assert status == 200 and content_type == 'application/x-ndjson'
+    entities = lines[0]['entities']
+    assert entities[0]['DiseaseName'] == disease_name and len(entities) <= 2
+    # The stand-in LLM echoes the DiseaseName lines of the prompt, which holds every entity once
+    names = dict.fromkeys(entity['DiseaseName'] for entity in entities)
+    assert ''.join(line['token'] for line in lines[1:]).split() == ' '.join(f'DiseaseName: {name}' for name in names).split()
+
+def test_batches_run_concurrently():
+    running, peak = 0, 0
+
+    async def process_batch(items):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+
+        return items
+
+    async def test():
+        batcher = MicroBatcher(process_batch, max_batch_size=2, max_wait_ms=1.0, max_concurrent_batches=3)
+        batcher.start()
+        try:
+            return await asyncio.gather(*[batcher.submit([i]) for i in range(12)])
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(test()) == [[i] for i in range(12)]
+    assert peak == 3
@@ -0,0 +1,66 @@
+from functools import partial
+import numpy as np
+import pytest
+
+from utils.benchmark import build_standin_driver, get_standin_records, hashed_embedding, load_split
+from utils.generic import Vectors
+from utils.index_search_helpers import CascadeConfig, get_combined_search_for_df
+from utils.kb_snapshot import KBSnapshot
+from utils.sharded_evaluation import get_chunk_path, get_run_fingerprint, merge_evaluation, read_chunk, run_sharded_evaluation
+
+
+@pytest.fixture(scope='module')
+def records() -> list:
+    return get_standin_records(load_split('train'))
+
+@pytest.fixture(scope='module')
+def snapshot_path(records, tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp('kb') / 'snapshot')
+    mesh_ids = [record['MESH_ID'] for record in records]
+    embeddings = {
+        Vectors.BAAI_DISEASE_NAME.value: (mesh_ids, np.stack([hashed_embedding(record['Description']) for record in records])),
+        Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value: (mesh_ids, np.stack([hashed_embedding(record['Description']) for record in records]))
+    }
+    KBSnapshot.write(path, records, [[] for _ in records], embeddings, version='test')
+
+    return path
+
+@pytest.fixture(scope='module')
+def dataset():
+    dataset = load_split('dev').iloc[:60].copy()
+    dataset['MentionEmbedding'] = [hashed_embedding(disease_name).tolist() for disease_name in dataset['Description']]
+
+    return dataset
+
+def test_snapshot_run_resumes(records, snapshot_path, dataset, tmp_path):
+    kwargs = dict(driver_factory=partial(build_standin_driver, records), workers=2, chunk_size=25, snapshot_path=snapshot_path, limit=10)
+
+    first = run_sharded_evaluation(dataset, 'MentionEmbedding', str(tmp_path), **kwargs)
+    resumed = run_sharded_evaluation(dataset, 'MentionEmbedding', str(tmp_path), **kwargs)
+
+    assert first['run']['resumed_chunks'] == 0
+    assert resumed['run']['resumed_chunks'] == 3
+    assert resumed['mrr'] == first['mrr']
+
+    expected = get_combined_search_for_df(dataset, 'MentionEmbedding', build_standin_driver(records), limit=10, batch_size=50, **KBSnapshot(snapshot_path).search_kwargs())
+    predictions = [predictions for chunk in range(3) for predictions in read_chunk(get_chunk_path(str(tmp_path), chunk))]
+    assert [[candidate['MESH_ID'] for candidate in candidates] for candidates in predictions] == [[candidate['MESH_ID'] for candidate in candidates] for candidates in expected]
+
+def test_fingerprint_rejects_engines(snapshot_path, dataset):
+    with pytest.raises(ValueError):
+        get_run_fingerprint(dataset, 'MentionEmbedding', 25, KBSnapshot(snapshot_path).search_kwargs())
+
+def test_merge_without_run(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        merge_evaluation(str(tmp_path))
+
+def test_concurrent_retrieval_matches_sequential(records, snapshot_path, dataset):
+    search_kwargs = KBSnapshot(snapshot_path).search_kwargs()
+    sequential = get_combined_search_for_df(dataset, 'MentionEmbedding', build_standin_driver(records), limit=10, **search_kwargs)
+    concurrent = get_combined_search_for_df(dataset, 'MentionEmbedding', build_standin_driver(records), limit=10, workers=4, **search_kwargs)
+
+    assert [[candidate['MESH_ID'] for candidate in candidates] for candidates in concurrent] == [[candidate['MESH_ID'] for candidate in candidates] for candidates in sequential]
+
+def test_cascade_rejected_with_batch_size(records, dataset):
+    with pytest.raises(ValueError):
+        get_combined_search_for_df(dataset, 'MentionEmbedding', build_standin_driver(records), batch_size=50, cascade=CascadeConfig())
@@ -0,0 +1,28 @@
+import numpy as np
+
+from utils.generic import Models, Vectors
+from utils.index_search_helpers import get_embedding_col_name
+from utils.vector_engine import VectorEngine, get_vector_index_property
+
+
+def get_engine(n=500, dim=384, seed=0) -> VectorEngine:
+    embeddings = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    mesh_ids = [f'MESH:D{i:06d}' for i in range(n)]
+
+    return VectorEngine(embeddings, mesh_ids, mesh_ids, [None] * n, [None] * n)
+
+def test_own_vector_scores_one():
+    engine = get_engine()
+    scores = engine.scores(engine.matrix)
+
+    assert (np.diag(scores) == 1.0).all()
+    assert (scores[~np.eye(len(engine), dtype=bool)] < 1.0).all()
+
+def test_own_vector_is_direct_hit():
+    engine = get_engine()
+    predictions = engine.search_batch(engine.matrix[:50], limit=3)
+
+    assert all(hits[0]['MESH_ID'] == engine.mesh_ids[i] and hits[0]['score'] == 1.0 for i, hits in enumerate(predictions))
+
+def test_vector_index_property():
+    assert get_vector_index_property(Vectors.BAAI_DISEASE_NAME.value) == get_embedding_col_name(Models.BAAI_BGE_SMALL_EN_V1_5, 'DiseaseEmbedding')
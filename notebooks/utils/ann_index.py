@@ -0,0 +1,261 @@
+import json
+import os
+import time
+from typing import List, Optional, Sequence
+import numpy as np
+
+from utils.candidate_batch import KBTable
+from utils.embedding_store import EmbeddingProp, EmbeddingStore
+from utils.generic import Models
+from utils.vector_engine import normalize_rows, to_index_scores
+
+
+###########
+# HELPERS #
+###########
+
+def iterate_blocks(matrix: np.ndarray, block_size: int):
+    for start in range(0, matrix.shape[0], block_size):
+        yield start, normalize_rows(np.asarray(matrix[start:start + block_size], dtype=np.float32))
+
+def train_centroids(matrix: np.ndarray, n_lists: int, n_iter=10, sample_size=50000, seed=0) -> np.ndarray:
+    """
+    Spherical k-means on a sample of the rows, the coarse quantiser of the inverted lists.
+    """
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(matrix.shape[0], size=min(sample_size, matrix.shape[0]), replace=False))
+    sample = normalize_rows(np.asarray(matrix[sample_rows], dtype=np.float32))
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+
+    for _ in range(n_iter):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = np.bincount(assignments, minlength=n_lists) == 0
+
+        # Lists that lost all their rows restart from random sample rows
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class ANNIndex:
+    """
+    Inverted-file index with 8-bit scalar quantisation (IVF-SQ8) over normalised embeddings, with an
+    exact re-rank of the short list against the original vectors.
+
+    The rows are grouped by their nearest k-means centroid into `n_lists` inverted lists and every
+    dimension is quantised to int8, a quarter of the float32 size. A query scans the int8 codes of its
+    `nprobe` nearest lists, keeps the `rerank * limit` best approximate candidates and scores them exactly
+    from `vectors` (typically the memory-mapped EmbeddingStore matrix, so only those rows are read).
+
+    Scores follow the Neo4j cosine convention, (1 + cos) / 2, like `VectorEngine`, so the index can be
+    passed in `vector_engines` wherever a `VectorEngine` is accepted when it is built with a `kb`.
+    Larger `nprobe` and `rerank` values trade speed for recall, see `measure_recall`.
+    """
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            codes: np.ndarray,
+            offsets: np.ndarray,
+            order: np.ndarray,
+            minimum: np.ndarray,
+            scale: np.ndarray,
+            ids: Sequence[str],
+            vectors: Optional[np.ndarray] = None,
+            kb: Optional[KBTable] = None,
+            nprobe=8,
+            rerank=4
+            ):
+        self.centroids = centroids
+        self.codes = codes
+        self.offsets = offsets
+        self.order = order
+        self.minimum = minimum
+        self.scale = scale
+        self.ids = list(ids)
+        self.vectors = vectors
+        self.kb = kb
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+    @classmethod
+    def build(
+            cls,
+            matrix: np.ndarray,
+            ids: Sequence[str],
+            n_lists: Optional[int] = None,
+            n_iter=10,
+            sample_size=50000,
+            block_size=4096,
+            seed=0,
+            **kwargs
+            ) -> 'ANNIndex':
+        """
+        Builds the index from an embedding matrix, read block by block so a memory-mapped matrix
+        is never loaded as a whole. `matrix` is kept as the re-rank vectors.
+        """
+        n_lists = n_lists or max(1, int(4 * np.sqrt(matrix.shape[0])))
+        centroids = train_centroids(matrix, min(n_lists, matrix.shape[0]), n_iter, sample_size, seed)
+
+        assignments = np.empty(matrix.shape[0], dtype=np.int32)
+        minimum = np.full(matrix.shape[1], np.inf, dtype=np.float32)
+        maximum = np.full(matrix.shape[1], -np.inf, dtype=np.float32)
+
+        for start, block in iterate_blocks(matrix, block_size):
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            minimum = np.minimum(minimum, block.min(axis=0))
+            maximum = np.maximum(maximum, block.max(axis=0))
+
+        scale = np.maximum(maximum - minimum, 1e-12) / 255
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))])
+        positions = np.empty_like(order)
+        positions[order] = np.arange(len(order))
+
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        for start, block in iterate_blocks(matrix, block_size):
+            quantised = np.rint((block - minimum) / scale) - 128
+            codes[positions[start:start + len(block)]] = np.clip(quantised, -128, 127).astype(np.int8)
+
+        return cls(centroids, codes, offsets, order, minimum, scale, ids, vectors=matrix, **kwargs)
+
+    @classmethod
+    def from_store(cls, store: EmbeddingStore, model: Models, prop: EmbeddingProp = 'DiseaseEmbedding', **kwargs) -> 'ANNIndex':
+        embeddings = store.load(model, prop)
+        if embeddings.ragged:
+            raise ValueError(f'{prop} holds several vectors per disease, build the index from a single vector property')
+
+        return cls.build(embeddings.matrix, embeddings.ids, **kwargs)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        for name in ['centroids', 'codes', 'offsets', 'order', 'minimum', 'scale']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'ids': self.ids, 'nprobe': self.nprobe, 'rerank': self.rerank}, f)
+
+    @classmethod
+    def load(cls, path: str, vectors: Optional[np.ndarray] = None, kb: Optional[KBTable] = None, mmap_mode='r') -> 'ANNIndex':
+        """
+        Loads a saved index with its codes memory-mapped. Without `vectors` the re-rank is skipped
+        and the scores are the approximate ones.
+        """
+        with open(os.path.join(path, 'index.json')) as f:
+            meta = json.load(f)
+
+        arrays = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode if name == 'codes' else None)
+            for name in ['centroids', 'codes', 'offsets', 'order', 'minimum', 'scale']
+        }
+
+        return cls(**arrays, ids=meta['ids'], vectors=vectors, kb=kb, nprobe=meta['nprobe'], rerank=meta['rerank'])
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ['centroids', 'codes', 'offsets', 'order', 'minimum', 'scale'])
+
+    def _candidate_positions(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        lists = np.argsort(-(self.centroids @ query))[:nprobe]
+
+        return np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+
+    def _top_k_single(self, query: np.ndarray, limit: int, nprobe: int, rerank: int) -> tuple:
+        positions = self._candidate_positions(query, nprobe)
+
+        # q . (code * scale + minimum) without decoding the codes
+        approximate = (np.asarray(self.codes[positions], dtype=np.float32) + 128) @ (query * self.scale) + query @ self.minimum
+
+        shortlist = min(len(positions), limit * rerank if self.vectors is not None else limit)
+        if shortlist < len(positions):
+            best = np.argpartition(-approximate, shortlist - 1)[:shortlist]
+            positions, approximate = positions[best], approximate[best]
+
+        rows = self.order[positions]
+
+        if self.vectors is not None:
+            # Sorted rows keep the reads of a memory-mapped matrix sequential
+            sorted_rows = np.sort(rows)
+            exact = normalize_rows(np.asarray(self.vectors[sorted_rows], dtype=np.float32)) @ query
+            rows, similarities = sorted_rows, exact
+        else:
+            similarities = approximate
+
+        top = np.argsort(-similarities, kind='stable')[:limit]
+
+        return rows[top], to_index_scores(similarities[top])
+
+    def top_k(self, embeddings: np.ndarray, limit=1, nprobe: Optional[int] = None, rerank: Optional[int] = None) -> List[tuple]:
+        queries = normalize_rows(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        rerank = rerank or self.rerank
+
+        return [self._top_k_single(query, limit, nprobe, rerank) for query in queries]
+
+    def search_batch(self, embeddings: np.ndarray, limit=1, threshold=0.80) -> List[list]:
+        if self.kb is None:
+            raise ValueError('Searching for candidate records needs the index to be loaded with a KBTable')
+
+        results = []
+        for rows, scores in self.top_k(embeddings, limit):
+            search_results = []
+
+            for row, score in zip(rows, scores):
+                if score > threshold:
+                    kb_row = self.kb.rows[self.ids[row]]
+                    search_results.append({
+                        'MESH_ID': self.kb.mesh_ids[kb_row],
+                        'Description': self.kb.descriptions[kb_row],
+                        'Synonyms': self.kb.synonyms[kb_row],
+                        'AltDiseaseIDs': self.kb.alt_disease_ids[kb_row],
+                        'score': float(score)
+                    })
+
+            results.append(search_results)
+
+        return results
+
+    def search(self, embedding: list, limit=1, threshold=0.80) -> list:
+        return self.search_batch(np.asarray(embedding, dtype=np.float32)[None, :], limit, threshold)[0]
+
+    def exact_top_k(self, embeddings: np.ndarray, limit=1, block_size=4096) -> np.ndarray:
+        queries = normalize_rows(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        similarities = np.empty((len(queries), len(self)), dtype=np.float32)
+
+        for start, block in iterate_blocks(self.vectors, block_size):
+            similarities[:, start:start + len(block)] = queries @ block.T
+
+        return np.argsort(-similarities, axis=1, kind='stable')[:, :limit]
+
+    def measure_recall(self, embeddings: np.ndarray, limit=10, nprobe: Optional[int] = None, rerank: Optional[int] = None) -> dict:
+        """
+        Compares the index with exact search over `vectors` for the given queries.
+
+        Returns:
+            dict: recall@limit (the share of the exact top `limit` rows the index returns), the mean
+            query time in ms and the settings used.
+        """
+        if self.vectors is None:
+            raise ValueError('Measuring recall needs the original vectors')
+
+        exact = self.exact_top_k(embeddings, limit)
+
+        started = time.perf_counter()
+        approximate = self.top_k(embeddings, limit, nprobe, rerank)
+        elapsed = time.perf_counter() - started
+
+        found = [len(np.intersect1d(rows, expected)) for (rows, _), expected in zip(approximate, exact)]
+
+        return {
+            f'recall@{limit}': sum(found) / exact.size if exact.size > 0 else 0.0,
+            'query_ms': elapsed * 1000 / len(exact) if len(exact) > 0 else 0.0,
+            'nprobe': min(nprobe or self.nprobe, len(self.centroids)),
+            'rerank': rerank or self.rerank
+        }
@@ -0,0 +1,454 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+import numpy as np
+import pandas as pd
+from neo4j import Driver
+
+from utils.embedding_store import EmbeddingStore, get_mention_key
+from utils.evalutation import evaluate_predictions
+from utils.fulltext_engine import FulltextEngine
+from utils.generic import Models, Vectors
+from utils import tracing
+from utils.index_search_helpers import (
+    batch_fulltext_index_query,
+    batch_vector_index_query,
+    CascadeConfig,
+    combined_search,
+    fulltext_index_query,
+    fulltext_search,
+    label_search_results,
+    summarize_cascade_reports,
+    vector_index_query,
+    vector_index_search
+)
+from utils.vector_engine import VectorEngine
+
+
+#############
+# CONSTANTS #
+#############
+
+data_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'processed')
+
+benchmark_strategies: Dict[str, Callable] = {
+    'fulltext': lambda disease_name, embedding, driver, limit: fulltext_search(
+        fulltext_index_query, disease_name, driver, limit
+    ),
+    'vector_name': lambda disease_name, embedding, driver, limit: vector_index_search(
+        driver, vector_index_query, embedding, Vectors.BAAI_DISEASE_NAME.value, limit, 0.80
+    ),
+    'vector_centroid': lambda disease_name, embedding, driver, limit: vector_index_search(
+        driver, vector_index_query, embedding, Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value, limit, 0.80
+    ),
+    'combined': lambda disease_name, embedding, driver, limit: combined_search(
+        disease_name, embedding, driver, limit
+    ),
+    'cascade': lambda disease_name, embedding, driver, limit: combined_search(
+        disease_name, embedding, driver, limit, cascade=CascadeConfig(), return_report=True
+    ),
+    'combined_rrf': lambda disease_name, embedding, driver, limit: combined_search(
+        disease_name, embedding, driver, limit, fusion='rrf'
+    ),
+    'combined_weighted': lambda disease_name, embedding, driver, limit: combined_search(
+        disease_name, embedding, driver, limit, fusion='weighted'
+    ),
+}
+
+###########
+# HELPERS #
+###########
+
+class CountingDriver:
+    """
+    Wraps a Neo4j driver and counts the statements sent through its sessions, i.e. the database round trips.
+    """
+
+    def __init__(self, driver: Driver):
+        self.driver = driver
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def session(self, **kwargs):
+        return CountingSession(self, self.driver.session(**kwargs))
+
+    def count(self):
+        with self.lock:
+            self.round_trips += 1
+
+    def close(self):
+        self.driver.close()
+
+
+class CountingSession:
+    def __init__(self, driver: CountingDriver, session):
+        self.driver = driver
+        self.session = session
+
+    def __enter__(self):
+        self.session.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.session.__exit__(*args)
+
+    def run(self, query: str, parameters: Optional[dict] = None, **kwargs):
+        self.driver.count()
+        return self.session.run(query, parameters, **kwargs)
+
+
+class InProcessDriver:
+    """
+    Stand-in for a Neo4j driver that answers the index queries of `utils.index_search_helpers`
+    from a `FulltextEngine` and `VectorEngine`s, so the search helpers run unchanged without a database.
+
+    Every `session.run` counts as one round trip, as it would against Neo4j.
+    """
+
+    def __init__(self, fulltext_engine: FulltextEngine, vector_engines: Dict[str, VectorEngine]):
+        self.fulltext_engine = fulltext_engine
+        self.vector_engines = vector_engines
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def session(self, **kwargs):
+        return InProcessSession(self)
+
+    def count(self):
+        with self.lock:
+            self.round_trips += 1
+
+    def close(self):
+        pass
+
+
+class InProcessSession:
+    def __init__(self, driver: InProcessDriver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def run(self, query: str, parameters: Optional[dict] = None, **kwargs) -> List[dict]:
+        params = {**(parameters or {}), **kwargs}
+        self.driver.count()
+
+        if query == fulltext_index_query:
+            return self.driver.fulltext_engine.search(params['disease_name'], params['limit'])
+
+        if query == vector_index_query:
+            return self.driver.vector_engines[params['index']].search(params['embedding'], params['limit'], params['threshold'])
+
+        if query == batch_fulltext_index_query:
+            return [
+                {'row': item['row'], **record}
+                for item in params['batch']
+                for record in self.driver.fulltext_engine.search(item['disease_name'], params['limit'])
+            ]
+
+        if query == batch_vector_index_query:
+            engine = self.driver.vector_engines[params['index']]
+            results = engine.search_batch(
+                np.array([item['embedding'] for item in params['batch']], dtype=np.float32), params['limit'], params['threshold']
+            )
+            return [
+                {'row': item['row'], **record}
+                for item, records in zip(params['batch'], results)
+                for record in records
+            ]
+
+        raise ValueError('The in-process backend only answers the fulltext and vector index queries')
+
+def hashed_embedding(text: str, dim=384, n=3) -> np.ndarray:
+    """
+    Deterministic character n-gram feature hashing, a stand-in for the embedding models when
+    benchmarking without ollama or HuggingFace. Similar spellings get similar vectors.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    padded = f"#{text.lower()}#"
+
+    for i in range(max(len(padded) - n + 1, 1)):
+        vector[zlib.crc32(padded[i:i + n].encode('utf-8')) % dim] += 1
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def get_standin_records(annotations: pd.DataFrame) -> List[dict]:
+    """
+    Builds a small knowledge base out of annotated mentions: one disease per MESH ID, named after
+    its most frequent mention, with the other mentions as synonyms.
+    """
+    records = []
+
+    for mesh_id, mentions in annotations.groupby('MESH ID')['Description']:
+        names = mentions.value_counts().index.tolist()
+        records.append({
+            'MESH_ID': mesh_id,
+            'Description': names[0],
+            'Synonyms': '|'.join(names[1:]) if len(names) > 1 else None,
+            'AltDiseaseIDs': None
+        })
+
+    return records
+
+def build_standin_driver(records: List[dict], embed: Callable = hashed_embedding) -> InProcessDriver:
+    names = [[record['Description']] + (record['Synonyms'].split('|') if record['Synonyms'] else []) for record in records]
+    name_embeddings = np.stack([embed(record['Description']) for record in records])
+    centroid_embeddings = np.stack([np.mean([embed(name) for name in record_names], axis=0) for record_names in names])
+
+    def get_engine(embeddings: np.ndarray) -> VectorEngine:
+        return VectorEngine(
+            embeddings=embeddings,
+            mesh_ids=[record['MESH_ID'] for record in records],
+            descriptions=[record['Description'] for record in records],
+            synonyms=[record['Synonyms'] for record in records],
+            alt_disease_ids=[record['AltDiseaseIDs'] for record in records]
+        )
+
+    return InProcessDriver(
+        FulltextEngine(records),
+        {
+            Vectors.BAAI_DISEASE_NAME.value: get_engine(name_embeddings),
+            Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value: get_engine(centroid_embeddings)
+        }
+    )
+
+def load_split(split: str) -> pd.DataFrame:
+    return pd.read_csv(os.path.join(data_dir, f'ncbi_{split}_annotations.csv'))
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_strategy(
+        strategy: Callable,
+        dataset: pd.DataFrame,
+        embeddings: List[np.ndarray],
+        driver,
+        limit=100,
+        warmup=10,
+        k_values=(1, 3, 5, 10)
+        ) -> dict:
+    """
+    Replays every mention of the dataset through a retrieval strategy, one call per mention.
+
+    Parameters:
+        strategy (callable): Called as `strategy(disease_name, embedding, driver, limit)`, see `benchmark_strategies`.
+            A strategy returning `(search_results, report)` gets its reports summarised under 'stages'.
+        dataset (DataFrame): The annotations, with 'Description', 'MESH ID' and 'Type' columns.
+        embeddings (list): The embedding of every mention, in dataset order.
+        driver: A `CountingDriver` or `InProcessDriver`, used to count the round trips.
+        limit (int): The number of candidates requested per mention.
+        warmup (int): The number of leading mentions run once before timing, to fill connection pools and caches.
+
+    Returns:
+        dict: Latency percentiles (ms), throughput, round trips per mention, how far the strategy raised the
+        peak RSS of the process and the retrieval metrics.
+    """
+    rows = list(zip(dataset['Description'], dataset['MESH ID'], embeddings))
+    # ru_maxrss is the peak of the whole process, so only its growth can be put down to this strategy
+    baseline_rss = get_peak_rss_mb()
+
+    for disease_name, _, embedding in rows[:warmup]:
+        strategy(disease_name, embedding, driver, limit)
+
+    latencies = np.zeros(len(rows), dtype=np.float64)
+    predictions = []
+    reports = []
+    round_trips = driver.round_trips
+    started = time.perf_counter()
+
+    for i, (disease_name, true_mesh_id, embedding) in enumerate(rows):
+        call_started = time.perf_counter()
+        search_results = strategy(disease_name, embedding, driver, limit)
+        latencies[i] = time.perf_counter() - call_started
+
+        if isinstance(search_results, tuple):
+            search_results, report = search_results
+            reports.append(report)
+
+        predictions.append(label_search_results(search_results, true_mesh_id, disease_name))
+
+    elapsed = time.perf_counter() - started
+    round_trips = driver.round_trips - round_trips
+
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99]) if len(rows) > 0 else (0.0, 0.0, 0.0)
+
+    result = {
+        'mentions': len(rows),
+        'latency_ms': {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'mean': float(latencies.mean() * 1000) if len(rows) > 0 else 0.0},
+        'mentions_per_second': len(rows) / elapsed if elapsed > 0 else 0.0,
+        'round_trips_per_mention': round_trips / len(rows) if len(rows) > 0 else 0.0,
+        'peak_rss_increase_mb': get_peak_rss_mb() - baseline_rss,
+        'metrics': evaluate_predictions(predictions, k_values, mention_types=dataset['Type'].tolist())
+    }
+
+    if reports:
+        result['stages'] = summarize_cascade_reports(reports)
+
+    return result
+
+def run_benchmark(
+        driver,
+        datasets: Dict[str, pd.DataFrame],
+        embed: Callable[[str], np.ndarray],
+        strategies: Optional[List[str]] = None,
+        limit=100,
+        warmup=10,
+        backend='standin'
+        ) -> dict:
+    """
+    Benchmarks the retrieval strategies on every dataset split.
+
+    Returns:
+        dict: The run metadata and the results per split and strategy, ready for `save_benchmark`.
+    """
+    strategies = strategies or list(benchmark_strategies.keys())
+    results = {}
+
+    for split, dataset in datasets.items():
+        # Embeddings are computed up front, the benchmark measures retrieval only
+        embeddings = [embed(row) for row in dataset.itertuples(index=False)]
+
+        results[split] = {
+            name: benchmark_strategy(benchmark_strategies[name], dataset, embeddings, driver, limit, warmup)
+            for name in strategies
+        }
+
+    return {
+        'metadata': {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'git_commit': get_git_commit(),
+            'backend': backend,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'limit': limit,
+            'warmup': warmup,
+            'peak_rss_mb': get_peak_rss_mb()
+        },
+        'results': results
+    }
+
+def save_benchmark(benchmark: dict, path: str):
+    with open(path, 'w') as file:
+        json.dump(benchmark, file, indent=2)
+
+def compare_benchmarks(baseline: dict, current: dict) -> pd.DataFrame:
+    """
+    Lines up two saved benchmark runs, with the relative change of every latency, throughput and metric value.
+    """
+    rows = []
+
+    for split, strategies in current['results'].items():
+        for name, result in strategies.items():
+            baseline_result = baseline['results'].get(split, {}).get(name)
+            if baseline_result is None:
+                continue
+
+            values = [
+                ('latency_p50_ms', baseline_result['latency_ms']['p50'], result['latency_ms']['p50']),
+                ('latency_p95_ms', baseline_result['latency_ms']['p95'], result['latency_ms']['p95']),
+                ('latency_p99_ms', baseline_result['latency_ms']['p99'], result['latency_ms']['p99']),
+                ('mentions_per_second', baseline_result['mentions_per_second'], result['mentions_per_second']),
+                ('round_trips_per_mention', baseline_result['round_trips_per_mention'], result['round_trips_per_mention']),
+                ('mrr', baseline_result['metrics']['mrr'], result['metrics']['mrr']),
+                ('hits@1', baseline_result['metrics']['hits@1'], result['metrics']['hits@1']),
+                ('hits@10', baseline_result['metrics']['hits@10'], result['metrics']['hits@10'])
+            ]
+
+            for measure, before, after in values:
+                rows.append({
+                    'split': split,
+                    'strategy': name,
+                    'measure': measure,
+                    'baseline': before,
+                    'current': after,
+                    'change': (after - before) / before if before else None
+                })
+
+    return pd.DataFrame(rows)
+
+def get_mention_embedder(backend: str, model: Models, store_dir: Optional[str]) -> Callable:
+    if backend == 'standin':
+        return lambda row: hashed_embedding(row.Description)
+
+    if store_dir is not None:
+        embeddings = EmbeddingStore(store_dir).load(model, 'DiseaseEmbedding')
+        return lambda row: embeddings.get(get_mention_key(row._asdict()))
+
+    from utils.embedding_pipeline import get_embed_model
+    embed_model = get_embed_model(model)
+    return lambda row: embed_model.get_text_embedding(row.Description)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the retrieval strategies on the NCBI annotation splits.')
+    parser.add_argument('--backend', choices=['standin', 'neo4j'], default='standin')
+    parser.add_argument('--splits', nargs='+', default=['dev', 'test'])
+    parser.add_argument('--strategies', nargs='+', choices=list(benchmark_strategies.keys()), default=None)
+    parser.add_argument('--kb-split', default='train', help='Split whose annotations make up the stand-in knowledge base')
+    parser.add_argument('--store-dir', default=None, help='EmbeddingStore with the mention embeddings (neo4j backend)')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--max-mentions', type=int, default=None)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--trace', default=None, help='Also record per-stage spans and write them as a Chrome trace')
+    args = parser.parse_args()
+
+    datasets = {split: load_split(split).iloc[:args.max_mentions] for split in args.splits}
+
+    if args.backend == 'standin':
+        driver = build_standin_driver(get_standin_records(load_split(args.kb_split)))
+    else:
+        from utils.generic import get_driver
+        driver = CountingDriver(get_driver())
+
+    if args.trace:
+        tracing.enable_tracing()
+
+    try:
+        benchmark = run_benchmark(
+            driver,
+            datasets,
+            get_mention_embedder(args.backend, Models.BAAI_BGE_SMALL_EN_V1_5, args.store_dir),
+            strategies=args.strategies,
+            limit=args.limit,
+            warmup=args.warmup,
+            backend=args.backend
+        )
+    finally:
+        driver.close()
+
+    if args.trace:
+        benchmark['stages'] = tracing.tracer.histograms()
+        tracing.tracer.write_chrome_trace(args.trace)
+
+    save_benchmark(benchmark, args.output)
+
+    for split, strategies in benchmark['results'].items():
+        for name, result in strategies.items():
+            print(
+                f"{split:>5} {name:<16} p50 {result['latency_ms']['p50']:8.2f} ms  p99 {result['latency_ms']['p99']:8.2f} ms  "
+                f"{result['mentions_per_second']:8.1f} mentions/s  {result['round_trips_per_mention']:.2f} round trips  "
+                f"MRR {result['metrics']['mrr']:.3f}  Hits@10 {result['metrics']['hits@10']:.3f}"
+            )
@@ -0,0 +1,327 @@
+from collections.abc import MutableMapping
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional
+import numpy as np
+
+from utils.exact_match_index import disease_names_retrieve_query, get_ctd_records
+from utils.string_similarity import calculate_string_similarity_batch, get_candidate_names, string_similarity_scorers
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from neo4j import Driver
+
+
+#############
+# CONSTANTS #
+#############
+
+# Candidate keys served from the shared KB table
+kb_fields = ('MESH_ID', 'Description', 'Synonyms', 'AltDiseaseIDs')
+
+# Candidate keys held once per batch, i.e. per mention
+label_fields = ('True MESH_ID', 'True Description')
+
+_missing = object()
+
+###########
+# HELPERS #
+###########
+
+class KBTable:
+    """
+    Shared disease table the candidate batches point into: every disease ID is interned once
+    with its name, synonyms and alternative IDs, instead of being copied into each candidate.
+    """
+
+    def __init__(self, records: Iterable[dict] = ()):
+        self.rows: Dict[str, int] = {}
+        self.mesh_ids: List[str] = []
+        self.descriptions: List[str] = []
+        self.synonyms: List[Optional[str]] = []
+        self.alt_disease_ids: List[Optional[str]] = []
+
+        for record in records:
+            self.intern(record)
+
+    @classmethod
+    def from_driver(cls, driver: 'Driver') -> 'KBTable':
+        with driver.session() as session:
+            return cls(record.data() for record in session.run(disease_names_retrieve_query))
+
+    @classmethod
+    def from_ctd_dataframe(cls, diseases: 'pd.DataFrame') -> 'KBTable':
+        return cls(get_ctd_records(diseases))
+
+    def __len__(self) -> int:
+        return len(self.mesh_ids)
+
+    def intern(self, record) -> int:
+        """
+        Returns the row of the record's disease, adding the disease on first sight.
+        """
+        row = self.rows.get(record['MESH_ID'])
+
+        if row is None:
+            row = len(self.mesh_ids)
+            self.rows[record['MESH_ID']] = row
+            self.mesh_ids.append(record['MESH_ID'])
+            self.descriptions.append(record['Description'])
+            self.synonyms.append(record['Synonyms'])
+            self.alt_disease_ids.append(record['AltDiseaseIDs'])
+
+        return row
+
+    def get(self, row: int, field: str):
+        if field == 'MESH_ID':
+            return self.mesh_ids[row]
+        if field == 'Description':
+            return self.descriptions[row]
+        if field == 'Synonyms':
+            return self.synonyms[row]
+
+        return self.alt_disease_ids[row]
+
+
+class CandidateBatch:
+    """
+    The candidates of one mention as columns: KB rows (int32), retrieval scores and string similarity
+    metrics (NumPy arrays), with the true label stored once for the whole batch.
+
+    Indexing or iterating yields `CandidateView`s, which behave like the candidate dicts returned by
+    `fulltext_search`/`vector_index_search` and fetch names and synonyms from the KB table on access;
+    slicing returns a list of them. Like the labelled prediction lists, a labelled batch without
+    candidates holds the single 'Unknown' placeholder, so the metrics of `evalutation` accept batches.
+    """
+
+    def __init__(
+            self,
+            kb: KBTable,
+            rows: np.ndarray,
+            scores: np.ndarray,
+            metrics: Optional[Dict[str, np.ndarray]] = None,
+            true_mesh_id: Optional[str] = None,
+            true_description: Optional[str] = None
+            ):
+        self.kb = kb
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.metrics = metrics if metrics is not None else {}
+        self.labels = {}
+        self.extras: Dict[str, np.ndarray] = {}
+
+        if true_mesh_id is not None:
+            self.labels['True MESH_ID'] = true_mesh_id
+        if true_description is not None:
+            self.labels['True Description'] = true_description
+
+    @classmethod
+    def from_records(
+            cls,
+            records: Iterable,
+            kb: KBTable,
+            true_mesh_id: Optional[str] = None,
+            true_description: Optional[str] = None
+            ) -> 'CandidateBatch':
+        """
+        Builds a batch from index query records or candidate dicts, interning their diseases into `kb`.
+        Metric values present on the records (e.g. after `process_predictions`) are kept. The 'Unknown'
+        placeholder of a mention without candidates isn't interned, the empty labelled batch yields it again.
+        """
+        rows, scores, metric_values = [], [], {metric: [] for metric in string_similarity_scorers}
+
+        for record in records:
+            if record['MESH_ID'] == 'Unknown':
+                continue
+
+            rows.append(kb.intern(record))
+            scores.append(record['score'] if record.get('score') is not None else np.nan)
+            for metric, values in metric_values.items():
+                values.append(record.get(metric, np.nan))
+
+        metrics = {
+            metric: np.array(values, dtype=string_similarity_scorers[metric][1] if not np.isnan(values).any() else np.float64)
+            for metric, values in metric_values.items() if len(values) > 0 and not np.isnan(values).all()
+        }
+
+        return cls(kb, rows, scores, metrics, true_mesh_id, true_description)
+
+    def __len__(self) -> int:
+        return len(self.rows) if len(self.rows) > 0 or not self.labels else 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+
+        if len(self.rows) == 0:
+            return self.get_placeholder()
+
+        return CandidateView(self, i % len(self))
+
+    def __iter__(self) -> Iterator:
+        if len(self.rows) == 0 and self.labels:
+            return iter([self.get_placeholder()])
+
+        return (CandidateView(self, i) for i in range(len(self)))
+
+    def get_placeholder(self) -> dict:
+        """
+        The 'Unknown' prediction `label_search_results` stands in for a mention without candidates.
+        """
+        return {
+            "MESH_ID": "Unknown",
+            "AltDiseaseIDs": "Unknown",
+            "Description": "Unknown",
+            **self.labels
+        }
+
+    @property
+    def mesh_ids(self) -> List[str]:
+        return [self.kb.mesh_ids[row] for row in self.rows]
+
+    def take(self, indices) -> 'CandidateBatch':
+        """
+        Returns the candidates at `indices` (e.g. an argsort) as a new batch sharing the KB table.
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        batch = CandidateBatch(
+            self.kb,
+            self.rows[indices],
+            self.scores[indices],
+            {metric: values[indices] for metric, values in self.metrics.items()}
+        )
+        batch.labels = dict(self.labels)
+        batch.extras = {key: values[indices] for key, values in self.extras.items()}
+
+        return batch
+
+    @classmethod
+    def concat(cls, batches: List['CandidateBatch']) -> 'CandidateBatch':
+        batch = cls(
+            batches[0].kb,
+            np.concatenate([batch.rows for batch in batches]),
+            np.concatenate([batch.scores for batch in batches]),
+            {
+                metric: np.concatenate([batch.metrics[metric] for batch in batches])
+                for metric in batches[0].metrics if all(metric in batch.metrics for batch in batches)
+            }
+        )
+        batch.labels = dict(batches[0].labels)
+
+        return batch
+
+    def rescore(self, disease_name: str, workers=1) -> 'CandidateBatch':
+        """
+        Fills the string similarity metric columns, scoring each distinct disease once (see `rescore_predictions`).
+        """
+        unique_rows, inverse = np.unique(self.rows, return_inverse=True)
+        names_per_candidate = [
+            get_candidate_names({'Description': self.kb.descriptions[row], 'Synonyms': self.kb.synonyms[row]})
+            for row in unique_rows
+        ]
+        similarity_metrics = calculate_string_similarity_batch(names_per_candidate, disease_name, workers)
+        self.metrics = {metric: values[inverse] for metric, values in similarity_metrics.items()}
+
+        return self
+
+    def label(self, true_mesh_id: str, disease_name: str) -> 'CandidateBatch':
+        self.labels['True MESH_ID'] = true_mesh_id
+        self.labels['True Description'] = disease_name
+
+        return self
+
+    def set_value(self, i: int, key: str, value):
+        if key in kb_fields:
+            raise KeyError(f"'{key}' comes from the KB table and can't be changed per candidate")
+
+        if key == 'score':
+            self.scores[i] = value
+        elif key in self.metrics or key in string_similarity_scorers:
+            if key not in self.metrics:
+                self.metrics[key] = np.full(len(self.rows), np.nan)
+            self.metrics[key][i] = value
+        else:
+            if key not in self.extras:
+                self.extras[key] = np.full(len(self.rows), _missing, dtype=object)
+            self.extras[key][i] = value
+
+    def to_dicts(self) -> list:
+        """
+        Materialises the batch as the list of candidate dicts `label_search_results` would return,
+        including its 'Unknown' placeholder for a batch without candidates.
+        """
+        return [dict(candidate) for candidate in self]
+
+    def nbytes(self) -> int:
+        return self.rows.nbytes + self.scores.nbytes + sum(values.nbytes for values in self.metrics.values())
+
+
+class CandidateView(MutableMapping):
+    """
+    Dict-compatible view of one candidate of a `CandidateBatch`. Extra keys such as 'is_correct'
+    can be set and are stored as columns of the batch.
+    """
+    __slots__ = ('batch', 'i')
+
+    def __init__(self, batch: CandidateBatch, i: int):
+        self.batch = batch
+        self.i = i
+
+    def _keys(self) -> List[str]:
+        keys = list(kb_fields) + ['score'] + list(self.batch.metrics) + list(self.batch.labels)
+
+        keys += [key for key, values in self.batch.extras.items() if values[self.i] is not _missing]
+
+        return list(dict.fromkeys(keys))
+
+    def __getitem__(self, key: str):
+        batch = self.batch
+
+        if key in kb_fields:
+            return batch.kb.get(int(batch.rows[self.i]), key)
+        if key == 'score':
+            return batch.scores[self.i].item()
+        if key in batch.metrics:
+            return batch.metrics[key][self.i].item()
+        if key in batch.extras and batch.extras[key][self.i] is not _missing:
+            return batch.extras[key][self.i]
+        if key in batch.labels:
+            return batch.labels[key]
+
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key in label_fields and self.batch.labels.get(key) == value:
+            return
+
+        self.batch.set_value(self.i, key, value)
+
+    def __delitem__(self, key: str):
+        raise TypeError('Candidate fields can not be deleted')
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys())
+
+    def __len__(self) -> int:
+        return len(self._keys())
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys()
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+def to_candidate_batches(disease_predictions: Iterable[list], kb: KBTable) -> Iterator[CandidateBatch]:
+    """
+    Converts the prediction lists of the `predict_*` helpers into candidate batches, e.g. to hold a whole split.
+    """
+    for predictions in disease_predictions:
+        first = predictions[0] if len(predictions) > 0 else {}
+
+        yield CandidateBatch.from_records(
+            predictions,
+            kb,
+            true_mesh_id=first.get('True MESH_ID'),
+            true_description=first.get('True Description')
+        )
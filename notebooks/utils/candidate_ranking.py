@@ -0,0 +1,200 @@
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+
+from utils.generic import contains_abbreviation
+
+
+#############
+# CONSTANTS #
+#############
+
+# The k of reciprocal rank fusion, 1 / (k + rank)
+rrf_k = 60
+
+###########
+# HELPERS #
+###########
+
+class QueryFeatures:
+    """
+    The parts of `custom_sort_key` that only depend on the mention, computed once per mention.
+    """
+    __slots__ = ('disease_name', 'abbreviation', 'normalized_name', 'has_type')
+
+    def __init__(self, disease_name: str):
+        self.disease_name = disease_name
+        self.abbreviation = contains_abbreviation(disease_name)
+        self.normalized_name = disease_name.strip().lower()
+        self.has_type = 'type' in disease_name.lower()
+
+def get_sort_key_columns(candidates: Sequence[dict], query: QueryFeatures) -> List[np.ndarray]:
+    """
+    Returns the six parts of `custom_sort_key` as float columns, most significant first, ascending is better.
+    """
+    primary_metric, secondary_metric = ('weighted_ratio', 'token_set_ratio') if query.abbreviation else ('token_set_ratio', 'weighted_ratio')
+    description_features = {}
+
+    exact_match, subtype_penalty, primary, secondary, tertiary, quaternary = [np.empty(len(candidates)) for _ in range(6)]
+
+    for i, candidate in enumerate(candidates):
+        description = candidate['Description']
+
+        # The same disease usually comes back from several retrievers
+        features = description_features.get(description)
+        if features is None:
+            lowered = description.lower()
+            features = (
+                -1.0 if description.strip().lower() == query.normalized_name else 0.0,
+                -1.0 if query.has_type and 'type' not in lowered else 0.0
+            )
+            description_features[description] = features
+
+        exact_match[i], subtype_penalty[i] = features
+        primary[i] = -candidate[primary_metric]
+        secondary[i] = -candidate[secondary_metric]
+        tertiary[i] = -candidate['JaroWinkler_distance']
+        quaternary[i] = -candidate['LCSseq_distance']
+
+    return [exact_match, subtype_penalty, primary, secondary, tertiary, quaternary]
+
+def lexsort_top_k(keys: List[np.ndarray], limit: Optional[int] = None, coarse_key: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Returns the indices of the `limit` smallest rows by `keys` (most significant first), in order.
+
+    With a `coarse_key` that never orders two rows against `keys` (ties allowed), only the rows up to the
+    `limit`-th smallest coarse value, ties included, are sorted: O(n) selection plus a sort of about `limit` rows.
+    """
+    n = len(keys[0])
+
+    if limit is not None and coarse_key is not None and limit < n:
+        threshold = np.partition(coarse_key, limit - 1)[limit - 1]
+        rows = np.flatnonzero(coarse_key <= threshold)
+    else:
+        rows = np.arange(n)
+
+    # np.lexsort sorts by its last key first
+    order = rows[np.lexsort([key[rows] for key in reversed(keys)])]
+
+    return order[:limit] if limit is not None else order
+
+def get_coarse_sort_key(keys: List[np.ndarray]) -> np.ndarray:
+    # exact_match in {-1, 0} and subtype_penalty in {-1, 0} outweigh any primary similarity in [-100, 0]
+    return keys[0] * 1000 + keys[1] * 200 + keys[2]
+
+def get_retriever_ranks(keys: List[np.ndarray], retrievers: np.ndarray) -> np.ndarray:
+    """
+    Returns the 0-based rank of every candidate within its retriever's list by the sort key.
+    """
+    order = np.lexsort([np.arange(len(retrievers))] + list(reversed(keys)) + [retrievers])
+    ranks = np.empty(len(order), dtype=np.int64)
+
+    sorted_retrievers = retrievers[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_retrievers[1:] != sorted_retrievers[:-1]]))
+    ranks[order] = np.arange(len(order)) - np.repeat(starts, np.diff(np.concatenate([starts, [len(order)]])))
+
+    return ranks
+
+def group_by_mesh_id(candidates: Sequence[dict], order: np.ndarray) -> tuple:
+    """
+    Assigns every candidate to its MESH_ID group, numbering the groups by their best candidate in `order`.
+
+    Returns:
+        tuple: The group of every candidate and the best candidate of every group.
+    """
+    group_index: Dict[str, int] = {}
+    groups = np.empty(len(candidates), dtype=np.int64)
+    representatives = []
+
+    for i in order.tolist():
+        group = group_index.get(candidates[i]['MESH_ID'])
+        if group is None:
+            group = group_index[candidates[i]['MESH_ID']] = len(representatives)
+            representatives.append(i)
+        groups[i] = group
+
+    return groups, np.array(representatives, dtype=np.int64)
+
+def tuple_fusion(candidates, keys, retrievers, scores, limit, merge_duplicates=False) -> np.ndarray:
+    """
+    The ordering of `combined_search`: every retriever's list sorted by `custom_sort_key`, concatenated and
+    sorted again, ties kept in retriever order. Duplicate MESH_IDs are kept unless `merge_duplicates` is set.
+    """
+    tiebreak = [retrievers, np.arange(len(retrievers))]
+
+    if not merge_duplicates:
+        return lexsort_top_k(keys + tiebreak, limit, get_coarse_sort_key(keys))
+
+    _, representatives = group_by_mesh_id(candidates, lexsort_top_k(keys + tiebreak))
+
+    return representatives[:limit]
+
+def reciprocal_rank_fusion(candidates, keys, retrievers, scores, limit, k=rrf_k) -> np.ndarray:
+    """
+    Scores every MESH_ID by the sum of 1 / (k + rank) over the retriever lists it is ranked in (ranks by the sort key),
+    so diseases found by several retrievers move up. Ties are broken by the sort key.
+    """
+    full_order = lexsort_top_k(keys + [retrievers, np.arange(len(retrievers))])
+    groups, representatives = group_by_mesh_id(candidates, full_order)
+
+    fused = np.bincount(groups, weights=1 / (k + 1 + get_retriever_ranks(keys, retrievers)), minlength=len(representatives))
+
+    # The representatives are numbered in sort key order, so the group number breaks ties
+    return representatives[lexsort_top_k([-fused, np.arange(len(representatives), dtype=np.float64)], limit, -fused)]
+
+def weighted_fusion(candidates, keys, retrievers, scores, limit, weights=(1.0, 1.0, 1.0), similarity_weight=1.0) -> np.ndarray:
+    """
+    Scores every MESH_ID by the weighted sum of its retrieval scores (each scaled by the best score of its
+    retriever, as BM25 and cosine scores are not on the same scale) plus `similarity_weight` times its
+    primary string similarity (0-1). Ties are broken by the sort key.
+    """
+    full_order = lexsort_top_k(keys + [retrievers, np.arange(len(retrievers))])
+    groups, representatives = group_by_mesh_id(candidates, full_order)
+
+    scores = np.nan_to_num(scores)
+    best_scores = np.zeros(int(retrievers.max()) + 1 if len(retrievers) > 0 else 0)
+    np.maximum.at(best_scores, retrievers, scores)
+    scaled_scores = np.divide(scores, best_scores[retrievers], out=np.zeros_like(scores), where=best_scores[retrievers] > 0)
+
+    fused = np.bincount(groups, weights=np.asarray(weights, dtype=np.float64)[retrievers] * scaled_scores, minlength=len(representatives))
+    # The primary similarity is a property of the disease, counted once per group
+    fused += similarity_weight * -keys[2][representatives] / 100
+
+    return representatives[lexsort_top_k([-fused, np.arange(len(representatives), dtype=np.float64)], limit, -fused)]
+
+fusion_rules: Dict[str, Callable] = {
+    'tuple': tuple_fusion,
+    'rrf': reciprocal_rank_fusion,
+    'weighted': weighted_fusion
+}
+
+def rank_candidates(
+        disease_name: str,
+        retriever_predictions: List[list],
+        limit: Optional[int] = None,
+        fusion='tuple',
+        **fusion_params
+        ) -> list:
+    """
+    Ranks the rescored candidates of one or more retrievers with one vectorised sort key computation.
+
+    Parameters:
+        disease_name (str): The mention.
+        retriever_predictions (list): The candidate lists of the retrievers, with their string similarity metrics.
+        limit (int): The number of candidates to return, None for all.
+        fusion (str): The key of the fusion rule in `fusion_rules`, 'tuple' for the order of `combined_search`.
+        fusion_params: Passed to the fusion rule, e.g. `k` for 'rrf' or `weights` for 'weighted'.
+
+    Returns:
+        list: The candidates in rank order.
+    """
+    candidates = [candidate for predictions in retriever_predictions for candidate in predictions]
+    if len(candidates) == 0:
+        return []
+
+    retrievers = np.repeat(np.arange(len(retriever_predictions)), [len(predictions) for predictions in retriever_predictions])
+    scores = np.array([candidate.get('score') if candidate.get('score') is not None else np.nan for candidate in candidates], dtype=np.float64)
+    keys = get_sort_key_columns(candidates, QueryFeatures(disease_name))
+
+    order = fusion_rules[fusion](candidates, keys, retrievers, scores, limit, **fusion_params)
+
+    return [candidates[i] for i in order.tolist()]
@@ -0,0 +1,103 @@
+import math
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from neo4j import Driver
+
+
+###########
+# QUERIES #
+###########
+
+disease_ids_retrieve_query = """
+    MATCH (d:Disease)
+    RETURN d.DiseaseID AS DiseaseID, d.AltDiseaseIDs AS AltDiseaseIDs
+"""
+
+disease_id_constraint_query = """
+    CREATE CONSTRAINT disease_id_unique IF NOT EXISTS
+    FOR (d:Disease) REQUIRE d.DiseaseID IS UNIQUE
+"""
+
+disease_alias_constraint_query = """
+    CREATE CONSTRAINT disease_alias_id_unique IF NOT EXISTS
+    FOR (a:DiseaseAlias) REQUIRE a.id IS UNIQUE
+"""
+
+batch_alias_create_query = """
+    UNWIND $batch AS row
+    MATCH (d:Disease {DiseaseID: row.disease_id})
+    MERGE (a:DiseaseAlias {id: row.alias})
+    MERGE (a)-[:ALIAS_OF]->(d)
+"""
+
+# Drop-in replacement for the SPLIT() based shortest path lookup, with IDs resolved by `DiseaseAliases`
+shortest_path_by_disease_id_query = """
+    MATCH (start:Disease {DiseaseID: $trueID})
+    MATCH (end:Disease {DiseaseID: $predictedID})
+    MATCH p = shortestPath((start)-[:SUB_CATEGORY_OF*]-(end))
+
+    RETURN length(p) AS distance
+"""
+
+###########
+# HELPERS #
+###########
+
+def split_ids(value) -> list:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return []
+
+    return [id for id in str(value).split('|') if id]
+
+
+class DiseaseAliases:
+    """
+    In-process alias -> canonical DiseaseID mapping, built once from the DiseaseID and AltDiseaseIDs
+    of every Disease node, so lookups no longer scan the label with SPLIT().
+    """
+
+    def __init__(self, records: Iterable[Tuple[str, Optional[str]]]):
+        self.canonical: Dict[str, str] = {}
+        self.ids: Dict[str, FrozenSet[str]] = {}
+
+        for disease_id, alt_disease_ids in records:
+            all_ids = frozenset(split_ids(disease_id) + split_ids(alt_disease_ids))
+            self.ids[disease_id] = all_ids
+
+            for alias in all_ids:
+                # The primary ID of a node wins over the alternative ID of another one
+                if alias not in self.canonical or alias in split_ids(disease_id):
+                    self.canonical[alias] = disease_id
+
+    @classmethod
+    def from_driver(cls, driver: 'Driver') -> 'DiseaseAliases':
+        with driver.session() as session:
+            result = session.run(disease_ids_retrieve_query)
+            return cls((record['DiseaseID'], record['AltDiseaseIDs']) for record in result)
+
+    def __len__(self) -> int:
+        return len(self.canonical)
+
+    def __contains__(self, alias: str) -> bool:
+        return alias in self.canonical
+
+    def resolve(self, alias: str) -> Optional[str]:
+        return self.canonical.get(alias)
+
+    def all_ids(self, disease_id: str) -> FrozenSet[str]:
+        return self.ids.get(disease_id, frozenset(split_ids(disease_id)))
+
+def create_disease_alias_nodes(driver: 'Driver', aliases: DiseaseAliases, batch_size=1000):
+    """
+    Materialises the alias mapping in the graph as (:DiseaseAlias {id})-[:ALIAS_OF]->(:Disease) nodes
+    backed by uniqueness constraints, for Cypher queries that need to resolve IDs server side.
+    """
+    rows = [{'alias': alias, 'disease_id': disease_id} for alias, disease_id in aliases.canonical.items()]
+
+    with driver.session() as session:
+        session.run(disease_id_constraint_query).consume()
+        session.run(disease_alias_constraint_query).consume()
+
+        for i in range(0, len(rows), batch_size):
+            session.run(batch_alias_create_query, batch=rows[i:i + batch_size]).consume()
@@ -0,0 +1,305 @@
+import math
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from neo4j import Driver
+
+from utils.disease_aliases import DiseaseAliases, split_ids
+from utils.index_search_helpers import batch_list, combined_search_batch
+
+
+###########
+# QUERIES #
+###########
+
+disease_definitions_retrieve_query = """
+    MATCH (d:Disease)
+    OPTIONAL MATCH (d)-[:SUB_CATEGORY_OF]->(p:Disease)
+    RETURN d.DiseaseID AS DiseaseID,
+        d.AltDiseaseIDs AS AltDiseaseIDs,
+        d.DiseaseName AS DiseaseName,
+        d.Definition AS Definition,
+        collect(p.DiseaseID) AS ParentIDs
+"""
+
+batch_nearest_defined_ancestor_update_query = """
+    UNWIND $batch AS row
+    MATCH (d:Disease {DiseaseID: row.DiseaseID})
+    SET d.NearestDefinedAncestorID = row.AncestorID,
+        d.NearestDefinedAncestorDistance = row.Distance,
+        d.ContextVersion = $version
+"""
+
+# One round trip for the context of any number of candidates, once the mapping is stored on the nodes
+batch_context_retrieve_query = """
+    UNWIND $disease_ids AS disease_id
+    MATCH (d:Disease {DiseaseID: disease_id})
+    OPTIONAL MATCH (a:Disease {DiseaseID: d.NearestDefinedAncestorID})
+    RETURN disease_id AS DiseaseID,
+        d.DiseaseName AS DiseaseName,
+        d.Definition AS Definition,
+        a.DiseaseName AS AncestorName,
+        a.Definition AS AncestorDefinition,
+        d.NearestDefinedAncestorDistance AS Distance
+"""
+
+###########
+# HELPERS #
+###########
+
+def has_definition(definition) -> bool:
+    # `Definition IS NOT NULL` of the notebook's description_query, with NaN (a missing CSV value) as null
+    return definition is not None and not (isinstance(definition, float) and math.isnan(definition))
+
+def get_entity(disease_id: str, name, definition, ancestor_name, ancestor_definition, distance) -> dict:
+    # The entity shape built by `retrieve_entities` in augumented_search_results.ipynb
+    if has_definition(definition):
+        return {'DiseaseID': disease_id, 'DiseaseName': name, 'Definition': definition}
+
+    return {
+        'DiseaseID': disease_id,
+        'DiseaseName': name,
+        'AncestorName': ancestor_name,
+        'AncestorDefinition': ancestor_definition,
+        'Distance': distance
+    }
+
+
+class DiseaseContext:
+    """
+    Materialised nearest-defined-ancestor table: for every disease the closest node along
+    SUB_CATEGORY_OF (the disease itself at distance 0) that has a Definition, the same answer as the
+    variable-length `description_query` of the RAG notebook, computed for all diseases in one pass.
+
+    Build it once per KB version, then `save` it locally or `write_to_graph`, and look up the context
+    of all candidates of many mentions at once with `get_entities`.
+    """
+
+    def __init__(
+            self,
+            disease_ids: List[str],
+            alt_disease_ids: List[Optional[str]],
+            names: List[str],
+            definitions: List[Optional[str]],
+            ancestors: np.ndarray,
+            distances: np.ndarray,
+            version=''
+            ):
+        self.disease_ids = disease_ids
+        self.alt_disease_ids = alt_disease_ids
+        self.names = names
+        self.definitions = definitions
+        self.ancestors = ancestors
+        self.distances = distances
+        self.version = version
+
+        self.aliases = DiseaseAliases(zip(disease_ids, alt_disease_ids))
+        self.node_index = {disease_id: i for i, disease_id in enumerate(disease_ids)}
+
+    @classmethod
+    def build(
+            cls,
+            disease_ids: List[str],
+            alt_disease_ids: List[Optional[str]],
+            names: List[str],
+            definitions: List[Optional[str]],
+            edges: Iterable[Tuple[str, str]],
+            version=''
+            ) -> 'DiseaseContext':
+        """
+        Runs a multi-source BFS from every defined disease down the hierarchy (parent to child),
+        level by level over a CSR child adjacency, so each node gets its nearest defined ancestor.
+        """
+        node_index = {disease_id: i for i, disease_id in enumerate(disease_ids)}
+        pairs = np.array([
+            (node_index[parent], node_index[child])
+            for child, parent in edges if child in node_index and parent in node_index
+        ], dtype=np.int64).reshape(-1, 2)
+
+        order = np.argsort(pairs[:, 0], kind='stable')
+        children = pairs[order, 1]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(pairs[:, 0], minlength=len(disease_ids)))])
+
+        ancestors = np.full(len(disease_ids), -1, dtype=np.int32)
+        distances = np.full(len(disease_ids), -1, dtype=np.int32)
+
+        frontier = np.flatnonzero([has_definition(definition) for definition in definitions])
+        ancestors[frontier] = frontier
+        distances[frontier] = 0
+        level = 0
+
+        while frontier.size > 0:
+            level += 1
+            starts = indptr[frontier]
+            counts = indptr[frontier + 1] - starts
+            total = counts.sum()
+
+            if total == 0:
+                break
+
+            positions = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(total)
+            reached = children[positions]
+            origins = np.repeat(frontier, counts)
+
+            unvisited = distances[reached] < 0
+            reached, origins = reached[unvisited], origins[unvisited]
+
+            # A child reached from several parents at the same level keeps the first one
+            frontier, first = np.unique(reached, return_index=True)
+            ancestors[frontier] = ancestors[origins[first]]
+            distances[frontier] = level
+
+        return cls(disease_ids, alt_disease_ids, names, definitions, ancestors, distances, version)
+
+    @classmethod
+    def from_driver(cls, driver: Driver, version='') -> 'DiseaseContext':
+        with driver.session() as session:
+            records = list(session.run(disease_definitions_retrieve_query))
+
+        return cls.build(
+            disease_ids=[record['DiseaseID'] for record in records],
+            alt_disease_ids=[record['AltDiseaseIDs'] for record in records],
+            names=[record['DiseaseName'] for record in records],
+            definitions=[record['Definition'] for record in records],
+            edges=[(record['DiseaseID'], parent_id) for record in records for parent_id in record['ParentIDs']],
+            version=version
+        )
+
+    @classmethod
+    def from_ctd_dataframe(cls, diseases: pd.DataFrame, version='') -> 'DiseaseContext':
+        return cls.build(
+            disease_ids=diseases['DiseaseID'].tolist(),
+            alt_disease_ids=diseases['AltDiseaseIDs'].tolist(),
+            names=diseases['DiseaseName'].tolist(),
+            definitions=diseases['Definition'].tolist(),
+            edges=[
+                (disease_id, parent_id)
+                for disease_id, parent_ids in zip(diseases['DiseaseID'], diseases['ParentIDs'])
+                for parent_id in split_ids(parent_ids)
+            ],
+            version=version
+        )
+
+    def __len__(self) -> int:
+        return len(self.disease_ids)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            'DiseaseID': self.disease_ids,
+            'AltDiseaseIDs': self.alt_disease_ids,
+            'DiseaseName': self.names,
+            'Definition': self.definitions,
+            'AncestorID': [self.disease_ids[i] if i >= 0 else None for i in self.ancestors],
+            'Distance': self.distances,
+            'Version': self.version
+        })
+
+    def save(self, path: str):
+        self.to_dataframe().to_csv(path, index=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'DiseaseContext':
+        table = pd.read_csv(path, dtype={'Version': str}, keep_default_na=False, na_values=[''])
+        table = table.astype(object).where(table.notna(), None)
+        node_index = {disease_id: i for i, disease_id in enumerate(table['DiseaseID'])}
+
+        return cls(
+            disease_ids=table['DiseaseID'].tolist(),
+            alt_disease_ids=table['AltDiseaseIDs'].tolist(),
+            names=table['DiseaseName'].tolist(),
+            definitions=table['Definition'].tolist(),
+            ancestors=np.array([node_index[ancestor_id] if ancestor_id is not None else -1 for ancestor_id in table['AncestorID']], dtype=np.int32),
+            distances=np.array(table['Distance'].tolist(), dtype=np.int32),
+            version=table['Version'].iloc[0] if len(table) > 0 and table['Version'].iloc[0] is not None else ''
+        )
+
+    def write_to_graph(self, driver: Driver, batch_size=1000):
+        """
+        Stores the mapping on the Disease nodes (NearestDefinedAncestorID/Distance and ContextVersion)
+        for `fetch_entities`.
+        """
+        rows = [
+            {'DiseaseID': disease_id, 'AncestorID': self.disease_ids[ancestor] if ancestor >= 0 else None, 'Distance': int(distance) if ancestor >= 0 else None}
+            for disease_id, ancestor, distance in zip(self.disease_ids, self.ancestors, self.distances)
+        ]
+
+        with driver.session() as session:
+            for batch in batch_list(rows, batch_size):
+                session.execute_write(lambda tx: tx.run(batch_nearest_defined_ancestor_update_query, batch=batch, version=self.version).consume())
+
+    def get_entity(self, disease_id: str) -> dict:
+        """
+        Returns the RAG context of a (primary or alternative) disease ID. Diseases without any defined
+        ancestor, or unknown IDs, get None for the ancestor fields.
+        """
+        canonical_id = self.aliases.resolve(disease_id)
+        if canonical_id is None:
+            return get_entity(disease_id, None, None, None, None, None)
+
+        i = self.node_index[canonical_id]
+        ancestor = self.ancestors[i]
+
+        return get_entity(
+            disease_id,
+            self.names[i],
+            self.definitions[i],
+            self.names[ancestor] if ancestor >= 0 else None,
+            self.definitions[ancestor] if ancestor >= 0 else None,
+            int(self.distances[i]) if ancestor >= 0 else None
+        )
+
+    def get_entities(self, candidate_lists: Iterable[list]) -> List[List[dict]]:
+        """
+        Looks up the context of every candidate of every mention in one call.
+        """
+        return [[self.get_entity(candidate['MESH_ID']) for candidate in candidates] for candidates in candidate_lists]
+
+def fetch_entities(driver: Driver, candidate_lists: List[list], aliases: DiseaseAliases) -> List[List[dict]]:
+    """
+    Same as `DiseaseContext.get_entities`, but reads the mapping stored with `write_to_graph`
+    with a single UNWIND query for all candidates.
+    """
+    candidate_ids = [[candidate['MESH_ID'] for candidate in candidates] for candidates in candidate_lists]
+    canonical_ids = {disease_id: aliases.resolve(disease_id) for ids in candidate_ids for disease_id in ids}
+
+    with driver.session() as session:
+        result = session.run(batch_context_retrieve_query, disease_ids=list({id for id in canonical_ids.values() if id is not None}))
+        records = {record['DiseaseID']: record for record in result}
+
+    entities = []
+    for ids in candidate_ids:
+        mention_entities = []
+
+        for disease_id in ids:
+            record = records.get(canonical_ids[disease_id])
+            if record is None:
+                mention_entities.append(get_entity(disease_id, None, None, None, None, None))
+            else:
+                mention_entities.append(get_entity(
+                    disease_id,
+                    record['DiseaseName'],
+                    record['Definition'],
+                    record['AncestorName'],
+                    record['AncestorDefinition'],
+                    record['Distance']
+                ))
+
+        entities.append(mention_entities)
+
+    return entities
+
+def retrieve_entities_batch(
+        disease_names: List[str],
+        embeddings: List[list],
+        driver: Driver,
+        context: DiseaseContext,
+        limit=5,
+        **kwargs
+        ) -> List[List[dict]]:
+    """
+    Batched `retrieve_entities` of the RAG notebook: one `combined_search_batch` for all mentions
+    and an in-memory context lookup for all their top `limit` candidates.
+    """
+    candidate_lists = combined_search_batch(disease_names, embeddings, driver, limit, **kwargs)
+
+    return context.get_entities(candidate_lists)
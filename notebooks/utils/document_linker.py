@@ -0,0 +1,232 @@
+import itertools
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+import pandas as pd
+from neo4j import Driver
+
+from utils.index_search_helpers import combined_search_batch, label_search_results
+
+
+###########
+# HELPERS #
+###########
+
+short_form_pattern = re.compile(r'\(([^()]{1,15})\)')
+
+# Left over around a long form by the word split, e.g. the "(" of "Atm (ataxia-telangiectasia (AT)"
+long_form_punctuation = ' ,;:()[]{}"\''
+
+def read_documents(abstracts_path: str, annotations_path: Optional[str] = None, chunk_size=1000) -> Iterator[dict]:
+    """
+    Streams the documents of an `ncbi_*_abstracts.csv` file, with their annotated mentions.
+
+    Both files are read in chunks and merged on the document ID, so only one chunk of each is held in memory.
+    They must list the documents in the same order, as the processed NCBI files do.
+
+    Returns:
+        iterator: Dictionaries with the document 'ID', its 'Text' (title and abstract joined by a space,
+        the text the annotation offsets refer to) and its 'mentions'.
+    """
+    def rows(path: str) -> Iterator[dict]:
+        for chunk in pd.read_csv(path, chunksize=chunk_size):
+            yield from chunk.to_dict('records')
+
+    annotations = itertools.groupby(rows(annotations_path), key=lambda row: row['ID']) if annotations_path else iter(())
+    next_annotations = next(annotations, None)
+
+    for document_id, parts in itertools.groupby(rows(abstracts_path), key=lambda row: row['ID']):
+        mentions = []
+
+        if next_annotations is not None and next_annotations[0] == document_id:
+            mentions = list(next_annotations[1])
+            next_annotations = next(annotations, None)
+
+        yield {'ID': document_id, 'Text': ' '.join(part['Text'] for part in parts), 'mentions': mentions}
+
+def get_max_long_form_words(short_form: str) -> int:
+    # min(|SF| + 5, 2 * |SF|) words, counting the letters of the short form only, as the digits of
+    # gene symbols such as BRCA1 stand for a single word of the long form
+    letters = sum(char.isalpha() for char in short_form)
+
+    return min(letters + 5, letters * 2)
+
+def find_long_form(short_form: str, preceding_text: str) -> Optional[str]:
+    """
+    Matches the characters of the short form right to left against the preceding words (Schwartz & Hearst, 2003),
+    e.g. "APC" against "... adenomatous polyposis coli".
+    """
+    max_words = get_max_long_form_words(short_form)
+    words = preceding_text.split()[-max_words:]
+    candidate = ' '.join(words)
+
+    short_index = len(short_form) - 1
+    long_index = len(candidate) - 1
+
+    while short_index >= 0:
+        char = short_form[short_index].lower()
+
+        if not char.isalnum():
+            short_index -= 1
+            continue
+
+        # The first character of the short form has to start a word of the long form
+        while long_index >= 0 and (
+            candidate[long_index].lower() != char
+            or (short_index == 0 and long_index > 0 and candidate[long_index - 1].isalnum())
+        ):
+            long_index -= 1
+
+        if long_index < 0:
+            return None
+
+        short_index -= 1
+        long_index -= 1
+
+    start = candidate.rfind(' ', 0, long_index + 1) + 1
+    long_form = candidate[start:].strip(long_form_punctuation)
+
+    if (
+        len(long_form) <= len(short_form)
+        or len(long_form.split()) > max_words
+        or long_form[0].lower() != short_form[0].lower()
+        # Brackets left inside belong to another definition, e.g. "(HFE) The hemochromatosis gene"
+        or any(char in long_form for char in '()[]{}')
+    ):
+        return None
+
+    return long_form
+
+def find_abbreviations(text: str) -> Dict[str, str]:
+    """
+    Returns the abbreviations defined in a text as "long form (SF)", as a mapping of short to long form.
+    """
+    abbreviations = {}
+
+    for match in short_form_pattern.finditer(text):
+        short_form = match.group(1).strip()
+
+        if (
+            not 2 <= len(short_form) <= 10
+            or len(short_form.split()) > 2
+            or not short_form[0].isalnum()
+            or not any(char.isalpha() for char in short_form)
+        ):
+            continue
+
+        # Definitions stay within a sentence
+        preceding_text = re.split(r'[.;:!?]\s', text[:match.start()])[-1]
+        long_form = find_long_form(short_form, preceding_text)
+
+        if long_form is not None and short_form not in abbreviations:
+            abbreviations[short_form] = long_form
+
+    return abbreviations
+
+
+class DocumentLinker:
+    """
+    Links the mentions of streamed documents with one batched retrieval per document, re-using results
+    for repeated mentions within the document and within a sliding window of the last `window_size`
+    distinct mention texts, and resolving a defined short form to the result of its long form.
+
+    Parameters:
+        search_batch (callable): Called with a list of mention texts, returns a list of predictions per text,
+            e.g. `make_combined_search_batch(driver, embed_model.get_text_embedding_batch)`.
+        window_size (int): The number of recent mention results kept across documents.
+    """
+
+    def __init__(self, search_batch: Callable[[List[str]], List[list]], window_size=1000):
+        self.search_batch = search_batch
+        self.window_size = window_size
+        self.window = OrderedDict()
+        self.stats = {'documents': 0, 'mentions': 0, 'retrievals': 0, 'document': 0, 'window': 0, 'abbreviation': 0}
+
+    def _from_window(self, text: str) -> Optional[list]:
+        predictions = self.window.get(text)
+        if predictions is not None:
+            self.window.move_to_end(text)
+
+        return predictions
+
+    def _remember(self, text: str, predictions: list):
+        self.window[text] = predictions
+        self.window.move_to_end(text)
+
+        while len(self.window) > self.window_size:
+            self.window.popitem(last=False)
+
+    def link_document(self, document: dict) -> Iterator[dict]:
+        self.stats['documents'] += 1
+        abbreviations = find_abbreviations(document['Text'])
+
+        # The text each mention is retrieved with and how its result was obtained
+        query_texts, sources = [], []
+        for mention in document['mentions']:
+            text = mention['Description']
+            long_form = abbreviations.get(text)
+
+            query_texts.append(long_form if long_form is not None else text)
+            sources.append('abbreviation' if long_form is not None else None)
+
+        results = {}
+        for text in dict.fromkeys(query_texts):
+            predictions = self._from_window(text)
+            if predictions is not None:
+                results[text] = (predictions, 'window')
+
+        missing = [text for text in dict.fromkeys(query_texts) if text not in results]
+        if missing:
+            self.stats['retrievals'] += len(missing)
+            for text, predictions in zip(missing, self.search_batch(missing)):
+                results[text] = (predictions, 'retrieval')
+
+        for text, (predictions, _) in results.items():
+            self._remember(text, predictions)
+
+        seen = set()
+        for mention, text, source in zip(document['mentions'], query_texts, sources):
+            predictions, result_source = results[text]
+
+            if source is None:
+                source = 'document' if text in seen else result_source
+            seen.add(text)
+
+            self.stats['mentions'] += 1
+            if source != 'retrieval':
+                self.stats[source] += 1
+
+            yield {
+                **mention,
+                'resolved_by': source,
+                'predictions': label_search_results(
+                    [dict(candidate) for candidate in predictions], mention.get('MESH ID'), mention['Description']
+                )
+            }
+
+    def link(self, documents: Iterable[dict]) -> Iterator[dict]:
+        """
+        Yields every linked mention, document by document, as soon as its document is linked.
+        The 'predictions' are labelled like the `predict_*` helpers, ready for `evaluate_predictions`.
+        """
+        for document in documents:
+            yield from self.link_document(document)
+
+    def retrievals_per_document(self) -> float:
+        return self.stats['retrievals'] / self.stats['documents'] if self.stats['documents'] > 0 else 0.0
+
+def make_combined_search_batch(
+        driver: Driver,
+        embed_batch: Callable[[List[str]], List[list]],
+        limit=100,
+        **kwargs
+        ) -> Callable[[List[str]], List[list]]:
+    """
+    Returns a `search_batch` callable for `DocumentLinker` running `combined_search_batch`, embedding
+    all mention texts of a document with one `embed_batch` call (e.g. the `get_text_embedding_batch`
+    of a llama_index model).
+    """
+    def search_batch(disease_names: List[str]) -> List[list]:
+        return combined_search_batch(disease_names, embed_batch(disease_names), driver, limit, **kwargs)
+
+    return search_batch
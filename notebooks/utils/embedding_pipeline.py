@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import multiprocessing
+import sqlite3
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+import pandas as pd
+from neo4j import Driver
+from tqdm import tqdm
+
+from utils.embedding_store import EmbeddingStore
+from utils.generic import Models, get_driver
+from utils.index_search_helpers import batch_list, get_embedding_col_name
+
+
+###########
+# QUERIES #
+###########
+
+disease_synonyms_retrieve_query = """
+    MATCH (d:Disease)
+    WHERE $disease_ids IS NULL OR d.DiseaseID IN $disease_ids
+    RETURN d.DiseaseID AS DiseaseID, d.DiseaseName AS DiseaseName, d.Synonyms AS Synonyms
+    ORDER BY d.DiseaseID
+"""
+
+batch_embedding_update_query = """
+    UNWIND $batch AS row
+    MATCH (d:Disease {DiseaseID: row.disease_id})
+    CALL apoc.create.setProperty(d, $embedding_prop, row.embedding)
+    YIELD node
+    RETURN count(node) AS updated
+"""
+
+# Synonym embeddings are lists of vectors, which Neo4j can only store as JSON text
+batch_json_embedding_update_query = """
+    UNWIND $batch AS row
+    MATCH (d:Disease {DiseaseID: row.disease_id})
+    CALL apoc.create.setProperty(d, $embedding_prop, apoc.convert.toJson(row.embedding))
+    YIELD node
+    RETURN count(node) AS updated
+"""
+
+create_embedding_cache_table_query = """
+    CREATE TABLE IF NOT EXISTS embeddings (
+        model TEXT NOT NULL,
+        text_hash TEXT NOT NULL,
+        embedding BLOB NOT NULL,
+        PRIMARY KEY (model, text_hash)
+    )
+"""
+
+###########
+# HELPERS #
+###########
+
+def get_embed_model(model: Models):
+    # Imported lazily, loading llama_index and torch takes seconds
+    if model == Models.LLAMA3:
+        from llama_index.embeddings.ollama import OllamaEmbedding
+        return OllamaEmbedding(model_name=model.value)
+
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    return HuggingFaceEmbedding(model_name=model.value)
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite file of float32 vectors keyed by (model, text hash). Every embedded batch is committed,
+    so the cache doubles as the checkpoint of an interrupted run.
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(create_embedding_cache_table_query)
+        self.connection.commit()
+
+    def get_many(self, model: Models, text_hashes: List[str], chunk_size=900) -> Dict[str, np.ndarray]:
+        found = {}
+
+        # Stay below the SQLite limit on bound parameters
+        for chunk in batch_list(text_hashes, chunk_size):
+            rows = self.connection.execute(
+                f"SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                [model.value, *chunk]
+            )
+            found.update((text_hash, np.frombuffer(embedding, dtype=np.float32)) for text_hash, embedding in rows)
+
+        return found
+
+    def put_many(self, model: Models, items: Iterable[tuple]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, text_hash, embedding) VALUES (?, ?, ?)",
+            [(model.value, text_hash, np.asarray(embedding, dtype=np.float32).tobytes()) for text_hash, embedding in items]
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+_worker_embed_model = None
+
+def _init_embedding_worker(model_name: str):
+    global _worker_embed_model
+    _worker_embed_model = get_embed_model(Models[model_name])
+
+def _embed_in_worker(texts: List[str]) -> tuple:
+    return texts, _worker_embed_model.get_text_embedding_batch(texts)
+
+def embed_texts(
+        texts: Iterable[str],
+        model: Models,
+        cache: EmbeddingCache,
+        embed_model=None,
+        batch_size=64,
+        processes=1
+        ) -> Dict[str, np.ndarray]:
+    """
+    Embeds the unique texts that are not cached yet and returns the vectors of all given texts.
+
+    Parameters:
+        texts (iterable): The texts to embed, duplicates are embedded once.
+        model (Models): The embedding model.
+        cache (EmbeddingCache): The on-disk vector cache, written after every batch.
+        embed_model: Optional already loaded llama_index embedding model (loaded with `get_embed_model` otherwise).
+        batch_size (int): The number of texts per `get_text_embedding_batch` call.
+        processes (int): The number of worker processes, each loading its own copy of the model.
+            Meant for the local HuggingFace model, the ollama server batches requests itself.
+
+    Returns:
+        dict: A mapping of text to its embedding.
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    hashes = {text: get_text_hash(text) for text in unique_texts}
+    cached = cache.get_many(model, list(hashes.values()))
+    missing = [text for text in unique_texts if hashes[text] not in cached]
+
+    with tqdm(total=len(unique_texts), initial=len(unique_texts) - len(missing), desc=f'Embedding ({model.value})', unit='texts') as progress:
+        def save(batch_texts: List[str], batch_embeddings: List[list]):
+            items = [(hashes[text], embedding) for text, embedding in zip(batch_texts, batch_embeddings)]
+            cache.put_many(model, items)
+            cached.update((text_hash, np.asarray(embedding, dtype=np.float32)) for text_hash, embedding in items)
+            progress.update(len(batch_texts))
+
+        if processes > 1 and missing:
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(processes, initializer=_init_embedding_worker, initargs=(model.name,)) as pool:
+                for batch_texts, batch_embeddings in pool.imap_unordered(_embed_in_worker, batch_list(missing, batch_size)):
+                    save(batch_texts, batch_embeddings)
+        elif missing:
+            embed_model = embed_model if embed_model is not None else get_embed_model(model)
+            for batch_texts in batch_list(missing, batch_size):
+                save(batch_texts, embed_model.get_text_embedding_batch(batch_texts))
+
+    return {text: cached[hashes[text]] for text in unique_texts}
+
+def get_disease_texts(driver: Driver, disease_ids: Optional[List[str]] = None) -> pd.DataFrame:
+    with driver.session() as session:
+        result = session.run(disease_synonyms_retrieve_query, disease_ids=disease_ids)
+        return pd.DataFrame(result.data(), columns=['DiseaseID', 'DiseaseName', 'Synonyms'])
+
+def get_synonyms(record) -> List[str]:
+    # Diseases without synonyms use their name, as in the original notebook run
+    return record.Synonyms.split('|') if isinstance(record.Synonyms, str) else [record.DiseaseName]
+
+def run_embedding_pipeline(
+        driver: Driver,
+        model: Models,
+        cache_path: str,
+        store: Optional[EmbeddingStore] = None,
+        batch_size=64,
+        write_batch_size=500,
+        processes=1,
+        embed_model=None,
+        disease_ids: Optional[List[str]] = None
+        ):
+    """
+    Embeds every disease name and synonym of the knowledge base for a model and writes the
+    `DiseaseEmbedding` and `SynonymsEmbedding` properties back to the graph (and to `store` if given).
+
+    The run is restartable: texts already present in the cache at `cache_path` are not embedded again.
+    With `disease_ids` only those diseases are (re-)embedded, e.g. the ones changed by a CTD update;
+    the store then isn't written since its matrices always cover the whole knowledge base.
+    """
+    full_refresh = disease_ids is None
+    diseases = get_disease_texts(driver, disease_ids)
+    records = list(diseases.itertuples(index=False))
+    synonyms = [get_synonyms(record) for record in records]
+
+    cache = EmbeddingCache(cache_path)
+    try:
+        embeddings = embed_texts(
+            [record.DiseaseName for record in records] + [name for names in synonyms for name in names],
+            model,
+            cache,
+            embed_model=embed_model,
+            batch_size=batch_size,
+            processes=processes
+        )
+    finally:
+        cache.close()
+
+    disease_embeddings = [embeddings[record.DiseaseName] for record in records]
+    synonyms_embeddings = [np.stack([embeddings[name] for name in names]) for names in synonyms]
+    embedded_ids = [record.DiseaseID for record in records]
+
+    with driver.session() as session:
+        for query, prop, values in [
+            (batch_embedding_update_query, 'DiseaseEmbedding', disease_embeddings),
+            (batch_json_embedding_update_query, 'SynonymsEmbedding', synonyms_embeddings)
+        ]:
+            rows = [{'disease_id': disease_id, 'embedding': value.tolist()} for disease_id, value in zip(embedded_ids, values)]
+
+            for batch in tqdm(list(batch_list(rows, write_batch_size)), desc=f'Writing {prop}'):
+                session.run(query, batch=batch, embedding_prop=get_embedding_col_name(model, prop)).consume()
+
+    if store is not None and full_refresh:
+        store.write(model, 'DiseaseEmbedding', embedded_ids, disease_embeddings)
+        store.write(model, 'SynonymsEmbedding', embedded_ids, synonyms_embeddings)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Embed all disease names and synonyms of the knowledge base.')
+    parser.add_argument('--model', choices=[model.name for model in Models], default=Models.BAAI_BGE_SMALL_EN_V1_5.name)
+    parser.add_argument('--cache-path', default='embedding_cache.sqlite')
+    parser.add_argument('--store-dir', default=None)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    driver = get_driver()
+    try:
+        run_embedding_pipeline(
+            driver,
+            Models[args.model],
+            args.cache_path,
+            store=EmbeddingStore(args.store_dir) if args.store_dir else None,
+            batch_size=args.batch_size,
+            processes=args.processes
+        )
+    finally:
+        driver.close()
@@ -0,0 +1,187 @@
+import json
+import os
+from typing import Iterable, List, Literal, Optional, Sequence
+import numpy as np
+from neo4j import Driver
+from pandas import DataFrame, Series
+
+from utils.generic import Models
+from utils.index_search_helpers import get_embedding_col_name, parse_embedding
+
+
+###########
+# QUERIES #
+###########
+
+node_embedding_retrieve_query = """
+    MATCH (d:Disease)
+    WHERE d[$embedding_prop] IS NOT NULL
+    RETURN d.DiseaseID AS DiseaseID, d[$embedding_prop] AS embedding
+"""
+
+###########
+# HELPERS #
+###########
+
+EmbeddingProp = Literal['SynonymsCentroidEmbedding', 'DiseaseEmbedding', 'SynonymsEmbedding']
+
+def get_mention_key(row) -> str:
+    return f"{row['ID']}-{row['Start']}-{row['End']}"
+
+
+class EmbeddingMatrix:
+    """
+    Read side of a stored embedding property: a memory-mapped matrix plus an ID -> row index.
+
+    Ragged properties (e.g. `SynonymsEmbedding`, one vector per synonym) keep all vectors
+    in a single matrix and an `offsets` array, so the vectors of ID `i` are rows
+    `offsets[i]:offsets[i + 1]`.
+    """
+
+    def __init__(self, matrix: np.ndarray, ids: List[str], offsets: Optional[np.ndarray] = None):
+        self.matrix = matrix
+        self.ids = ids
+        self.offsets = offsets
+        self.index = {id: i for i, id in enumerate(ids)}
+
+    @property
+    def ragged(self) -> bool:
+        return self.offsets is not None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.index
+
+    def get(self, id: str) -> np.ndarray:
+        i = self.index[id]
+
+        if self.ragged:
+            return self.matrix[self.offsets[i]:self.offsets[i + 1]]
+
+        return self.matrix[i]
+
+    def rows(self, ids: Iterable[str]) -> List[np.ndarray]:
+        return [self.get(id) for id in ids]
+
+    def take(self, ids: Iterable[str]) -> np.ndarray:
+        # Fancy indexing copies, use `get`/`rows` for zero-copy views
+        return self.matrix[[self.index[id] for id in ids]]
+
+
+class EmbeddingStore:
+    """
+    Directory of `.npy` embedding matrices, one per model and embedding property.
+
+    Each property is stored as `<prop>-<model>.npy` (see `get_embedding_col_name`) next to a
+    `<prop>-<model>.json` file holding the row IDs, and an `.offsets.npy` file for ragged properties.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, model: Models, prop: EmbeddingProp, suffix: str) -> str:
+        return os.path.join(self.root, get_embedding_col_name(model, prop) + suffix)
+
+    def exists(self, model: Models, prop: EmbeddingProp) -> bool:
+        return os.path.exists(self._path(model, prop, '.npy'))
+
+    def write(
+            self,
+            model: Models,
+            prop: EmbeddingProp,
+            ids: Sequence[str],
+            embeddings: Sequence,
+            dtype=np.float32
+            ):
+        first = np.asarray(embeddings[0]) if len(embeddings) > 0 else np.empty((0,))
+        ragged = first.ndim == 2
+
+        if ragged:
+            lengths = np.array([len(vectors) for vectors in embeddings], dtype=np.int64)
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            shape = (int(offsets[-1]), first.shape[1])
+        else:
+            offsets = None
+            shape = (len(embeddings), first.shape[0])
+
+        matrix = np.lib.format.open_memmap(self._path(model, prop, '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+        if ragged:
+            for i, vectors in enumerate(embeddings):
+                matrix[offsets[i]:offsets[i + 1]] = vectors
+            np.save(self._path(model, prop, '.offsets.npy'), offsets)
+        else:
+            for i, vector in enumerate(embeddings):
+                matrix[i] = vector
+
+        matrix.flush()
+        del matrix
+
+        with open(self._path(model, prop, '.json'), 'w') as f:
+            json.dump({'ids': list(ids), 'dtype': np.dtype(dtype).name, 'ragged': ragged}, f)
+
+    def load(self, model: Models, prop: EmbeddingProp, mmap_mode='r') -> EmbeddingMatrix:
+        with open(self._path(model, prop, '.json')) as f:
+            meta = json.load(f)
+
+        matrix = np.load(self._path(model, prop, '.npy'), mmap_mode=mmap_mode)
+        offsets = np.load(self._path(model, prop, '.offsets.npy')) if meta['ragged'] else None
+
+        return EmbeddingMatrix(matrix, meta['ids'], offsets)
+
+def store_dataframe_embeddings(
+        store: EmbeddingStore,
+        dataset: DataFrame,
+        model: Models,
+        prop: EmbeddingProp = 'DiseaseEmbedding',
+        dtype=np.float32
+        ):
+    """
+    Converts the JSON embedding column of an annotations DataFrame into a stored matrix keyed by mention.
+    """
+    embedding_col = get_embedding_col_name(model, prop)
+    ids = [get_mention_key(row) for _, row in dataset.iterrows()]
+    embeddings = [parse_embedding(embedding) for embedding in dataset[embedding_col]]
+
+    store.write(model, prop, ids, embeddings, dtype)
+
+def store_node_embeddings(
+        store: EmbeddingStore,
+        driver: Driver,
+        model: Models,
+        prop: EmbeddingProp,
+        dtype=np.float32
+        ):
+    """
+    Exports an embedding property of the Disease nodes (list or JSON encoded) into a stored matrix keyed by DiseaseID.
+    """
+    with driver.session() as session:
+        result = session.run(node_embedding_retrieve_query, embedding_prop=get_embedding_col_name(model, prop))
+        records = [(record['DiseaseID'], parse_embedding(record['embedding'])) for record in result]
+
+    records = [(disease_id, embedding) for disease_id, embedding in records if len(embedding) > 0]
+
+    store.write(model, prop, [disease_id for disease_id, _ in records], [embedding for _, embedding in records], dtype)
+
+def attach_stored_embeddings(
+        dataset: DataFrame,
+        store: EmbeddingStore,
+        model: Models,
+        prop: EmbeddingProp = 'DiseaseEmbedding'
+        ) -> DataFrame:
+    """
+    Returns a copy of the annotations DataFrame whose embedding column holds zero-copy row views
+    of the stored matrix instead of JSON strings, ready for the `predict_*` helpers.
+    """
+    embeddings = store.load(model, prop)
+    dataset = dataset.copy()
+    dataset[get_embedding_col_name(model, prop)] = Series(
+        embeddings.rows(get_mention_key(row) for _, row in dataset.iterrows()),
+        index=dataset.index,
+        dtype=object
+    )
+
+    return dataset
@@ -1,6 +1,13 @@
-from matplotlib import pyplot as plt
-from neo4j import Driver
-import pandas as pd
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, Optional, Sequence
+import numpy as np
+
+from utils.disease_aliases import DiseaseAliases, shortest_path_by_disease_id_query
+from utils.hierarchy_graph import HierarchyGraph
+
+if TYPE_CHECKING:
+    from neo4j import Driver
 
 ###########
 # QEURIES #
@@ -17,7 +24,7 @@ get_shortest_path_query = """
     WHERE (end.DiseaseID IS NOT NULL AND ANY(id IN SPLIT(toString(end.DiseaseID), '|') WHERE id = endId))
     OR (end.AltDiseaseIDs IS NOT NULL AND ANY(altId IN SPLIT(toString(end.AltDiseaseIDs), '|') WHERE altId = endId))
 
-    MATCH p = shortestPath((start)-[*]-(end))
+    MATCH p = shortestPath((start)-[:SUB_CATEGORY_OF*]-(end))
 
     RETURN length(p) AS distance
 """
@@ -26,16 +33,24 @@ get_shortest_path_query = """
 # HELPERS #
 ###########
 
-def extract_ids(entry: dict) -> list:
+def extract_ids(entry: dict, aliases: DiseaseAliases = None) -> list:
     """
     Extracts unique IDs from a dictionary entry.
 
     Parameters:
         entry (dict): A dictionary containing 'MESH_ID' and 'AltDiseaseIDs' keys.
+        aliases (DiseaseAliases): Optional alias mapping, used to look up the IDs of known diseases
+        instead of splitting the entry's fields.
 
     Returns:
         list: A list of unique IDs extracted from the entry.
     """
+    if aliases is not None and entry['MESH_ID'] in aliases.ids:
+        return list(aliases.all_ids(entry['MESH_ID']))
+
+    # Imported here, the metrics only need NumPy and pandas is slow to import
+    import pandas as pd
+
     mesh_ids = entry['MESH_ID'].split('|') if entry['MESH_ID'] else []
     alt_disease_ids = []
 
@@ -155,12 +170,153 @@ def hits_at_n_score(disease_predictions: list, n: int):
 
     return hits_at_n_score
 
-def mark_predictions_with_shortest_path(disease_predictions: list, driver: Driver) -> list:
+def is_correct_prediction(entity: dict) -> bool:
+    """
+    Same check as `entity['True MESH_ID'] in extract_ids(entity)` without building the list and set.
+    """
+    true_id = entity['True MESH_ID']
+
+    if entity['MESH_ID'] and true_id in entity['MESH_ID'].split('|'):
+        return True
+
+    alt_disease_ids = entity.get('AltDiseaseIDs')
+    if isinstance(alt_disease_ids, str):
+        return true_id in alt_disease_ids.split('|')
+
+    return False
+
+def first_correct_ranks(disease_predictions: Iterable[list]) -> np.ndarray:
+    """
+    Reduces every list of predictions to the 1-based rank of its first correct prediction.
+
+    Parameters:
+        disease_predictions (iterable): A list, or any stream (e.g. a generator), of prediction lists
+        as returned by the `predict_*` helpers. Only the ranks are kept, not the predictions.
+
+    Returns:
+        np.ndarray: An integer array with one rank per mention, 0 when no prediction is correct.
+    """
+    ranks = array('i')
+
+    for list_of_pred_for_single_disease in disease_predictions:
+        rank = 0
+        for i, entity in enumerate(list_of_pred_for_single_disease):
+            if is_correct_prediction(entity):
+                rank = i + 1
+                break
+        ranks.append(rank)
+
+    return np.frombuffer(ranks, dtype=np.int32) if len(ranks) > 0 else np.zeros(0, dtype=np.int32)
+
+def rank_metrics(ranks: np.ndarray, k_values: Sequence[int] = (1, 3, 5, 10)) -> dict:
+    """
+    Calculates MRR, Hits@k and accuracy from first-correct ranks (see `first_correct_ranks`).
+
+    The values match `mrr_score` and `hits_at_n_score`, accuracy is the share of mentions whose
+    top prediction is correct.
+    """
+    found = ranks > 0
+    reciprocal_ranks = np.where(found, 1 / np.maximum(ranks, 1), 0.0)
+
+    metrics = {'count': len(ranks), 'mrr': float(reciprocal_ranks.mean()) if len(ranks) > 0 else 0.0}
+    for k in k_values:
+        metrics[f'hits@{k}'] = float((found & (ranks <= k)).mean()) if len(ranks) > 0 else 0.0
+    metrics['accuracy'] = float((ranks == 1).mean()) if len(ranks) > 0 else 0.0
+
+    return metrics
+
+def _bootstrap_chunk(reciprocal_ranks: np.ndarray, ranks: np.ndarray, k_values: Sequence[int], n_resamples: int, seed) -> dict:
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, len(ranks), size=(n_resamples, len(ranks)))
+    sampled_ranks = ranks[samples]
+
+    chunk = {'mrr': reciprocal_ranks[samples].mean(axis=1)}
+    for k in k_values:
+        chunk[f'hits@{k}'] = ((sampled_ranks > 0) & (sampled_ranks <= k)).mean(axis=1)
+    chunk['accuracy'] = (sampled_ranks == 1).mean(axis=1)
+
+    return chunk
+
+def bootstrap_confidence_intervals(
+        ranks: np.ndarray,
+        k_values: Sequence[int] = (1, 3, 5, 10),
+        n_resamples=1000,
+        confidence=0.95,
+        workers=4,
+        seed=0
+        ) -> dict:
+    """
+    Calculates percentile bootstrap confidence intervals of the rank metrics.
+
+    The resamples are split across `workers` threads (NumPy releases the GIL while indexing and reducing),
+    each with its own child seed so the result does not depend on the number of workers.
+
+    Returns:
+        dict: A mapping of metric name to its (lower, upper) bounds.
+    """
+    if len(ranks) == 0:
+        return {}
+
+    reciprocal_ranks = np.where(ranks > 0, 1 / np.maximum(ranks, 1), 0.0)
+    chunk_size = 100
+    chunk_sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunks = list(executor.map(
+            lambda args: _bootstrap_chunk(reciprocal_ranks, ranks, k_values, *args),
+            zip(chunk_sizes, seeds)
+        ))
+
+    alpha = (1 - confidence) / 2
+    return {
+        metric: tuple(float(bound) for bound in np.quantile(np.concatenate([chunk[metric] for chunk in chunks]), [alpha, 1 - alpha]))
+        for metric in chunks[0].keys()
+    }
+
+def evaluate_predictions(
+        disease_predictions: Iterable[list],
+        k_values: Sequence[int] = (1, 3, 5, 10),
+        mention_types: Optional[Sequence[str]] = None,
+        n_resamples=0,
+        workers=4
+        ) -> dict:
+    """
+    Evaluates prediction lists in a single pass: every list is reduced to the rank of its first correct
+    prediction and all metrics are then computed from that integer array.
+
+    Parameters:
+        disease_predictions (iterable): The prediction lists, possibly streamed.
+        k_values (list): The cut-offs for Hits@k.
+        mention_types (list): Optional mention type of every prediction list (the 'Type' column of the
+        annotations) for a per-type breakdown.
+        n_resamples (int): The number of bootstrap resamples for confidence intervals, 0 to skip them.
+        workers (int): The number of threads used for the bootstrap.
+
+    Returns:
+        dict: The overall metrics, plus 'by_type' and 'confidence_intervals' when requested.
+    """
+    ranks = first_correct_ranks(disease_predictions)
+    evaluation = rank_metrics(ranks, k_values)
+
+    if mention_types is not None:
+        mention_types = np.asarray(mention_types)
+        evaluation['by_type'] = {
+            str(mention_type): rank_metrics(ranks[mention_types == mention_type], k_values)
+            for mention_type in np.unique(mention_types)
+        }
+
+    if n_resamples > 0:
+        evaluation['confidence_intervals'] = bootstrap_confidence_intervals(ranks, k_values, n_resamples, workers=workers)
+
+    return evaluation
+
+def mark_predictions_with_shortest_path(disease_predictions: list, driver: 'Driver', aliases: DiseaseAliases = None) -> list:
     with driver.session() as session:
         for candidates_for_single_disease in disease_predictions:
             for candidate in candidates_for_single_disease:
                 true_id = candidate['True MESH_ID']
-                predicted_ids = extract_ids(candidate)
+                predicted_ids = extract_ids(candidate, aliases)
                 # Mark whether the prediction is correct
                 if true_id in predicted_ids:
                     candidate['is_correct'] = True
@@ -171,8 +327,16 @@ def mark_predictions_with_shortest_path(disease_predictions: list, driver: Drive
                     
                     # If the predicted ID is not "Unknown", calculate the shortest path
                     if predicted_id != "Unknown":
-                        result = session.run(get_shortest_path_query, trueID=true_id, predictedID=predicted_id)
-                        single_result = result.single()
+                        if aliases is not None:
+                            # Resolve both IDs in process and match the nodes by DiseaseID instead of scanning with SPLIT()
+                            start_id, end_id = aliases.resolve(true_id), aliases.resolve(predicted_id)
+                            single_result = None
+                            if start_id is not None and end_id is not None:
+                                result = session.run(shortest_path_by_disease_id_query, trueID=start_id, predictedID=end_id)
+                                single_result = result.single()
+                        else:
+                            result = session.run(get_shortest_path_query, trueID=true_id, predictedID=predicted_id)
+                            single_result = result.single()
 
                         if single_result is not None:
                             candidate['shortest_path'] = single_result[0]
@@ -183,7 +347,42 @@ def mark_predictions_with_shortest_path(disease_predictions: list, driver: Drive
 
     return disease_predictions
 
+def mark_predictions_with_hierarchy_graph(disease_predictions: list, graph: HierarchyGraph) -> list:
+    """
+    Same as `mark_predictions_with_shortest_path`, but computes the distances on an in-memory
+    hierarchy graph instead of sending one shortestPath query per wrong candidate.
+
+    Parameters:
+        disease_predictions (list): A list of lists with the predictions for each disease.
+        graph (HierarchyGraph): The SUB_CATEGORY_OF hierarchy loaded with its disease aliases.
+
+    Returns:
+        list: The predictions marked with 'is_correct' and 'shortest_path' (0 for a direct match,
+        -1 if no path is found and -2 for an unknown prediction).
+    """
+    for candidates_for_single_disease in disease_predictions:
+        for candidate in candidates_for_single_disease:
+            true_id = candidate['True MESH_ID']
+            predicted_ids = extract_ids(candidate, graph.aliases)
+
+            if true_id in predicted_ids:
+                candidate['is_correct'] = True
+                candidate['shortest_path'] = 0
+            else:
+                candidate['is_correct'] = False
+                predicted_id = candidate['MESH_ID']
+
+                if predicted_id != "Unknown":
+                    candidate['shortest_path'] = graph.shortest_path(true_id, predicted_id)
+                else:
+                    candidate['shortest_path'] = -2
+
+    return disease_predictions
+
 def display_shortest_path_predictions(shortest_path_predictions: list):
+    # Imported here, pyplot alone takes longer to import than the rest of the module
+    from matplotlib import pyplot as plt
+
     bins = list(range(min(shortest_path_predictions), max(shortest_path_predictions) + 2))
 
     plt.figure(figsize=(10, 6))
@@ -0,0 +1,148 @@
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Set
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from neo4j import Driver
+
+
+###########
+# QUERIES #
+###########
+
+disease_names_retrieve_query = """
+    MATCH (d:Disease)
+    RETURN d.DiseaseID AS MESH_ID,
+        d.DiseaseName AS Description,
+        d.Synonyms AS Synonyms,
+        d.AltDiseaseIDs AS AltDiseaseIDs
+"""
+
+###########
+# HELPERS #
+###########
+
+def get_ctd_records(diseases: 'pd.DataFrame') -> Iterable[dict]:
+    # CTD_diseases rows in the shape of the candidate records returned by the index queries
+    for row in diseases.itertuples(index=False):
+        yield {'MESH_ID': row.DiseaseID, 'Description': row.DiseaseName, 'Synonyms': row.Synonyms, 'AltDiseaseIDs': row.AltDiseaseIDs}
+
+def normalize_name(name: str) -> str:
+    return ' '.join(name.lower().split())
+
+def get_record_names(record: dict) -> Set[str]:
+    names = [record['Description']]
+    if isinstance(record['Synonyms'], str):
+        names += record['Synonyms'].split('|')
+
+    return {normalize_name(name) for name in names if isinstance(name, str) and name.strip()}
+
+
+class ExactMatchIndex:
+    """
+    Case-insensitive DiseaseName/Synonyms -> MESH_ID hash index, consulted before any index query.
+
+    A name is a hit only when it maps to exactly one disease; names shared by several diseases
+    are reported as ambiguous and left to the regular retrieval and ranking.
+
+    The index is a copy of the knowledge base: after a CTD update pass it to `update_ctd_diseases`
+    (or call `update`), otherwise it keeps answering with the old names.
+    """
+
+    def __init__(self, records: Iterable[dict] = ()):
+        self.records: Dict[str, dict] = {}
+        self.names: Dict[str, Set[str]] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.ambiguous = 0
+
+        for record in records:
+            self.add(record)
+
+    @classmethod
+    def from_driver(cls, driver: 'Driver') -> 'ExactMatchIndex':
+        with driver.session() as session:
+            return cls(record.data() for record in session.run(disease_names_retrieve_query))
+
+    @classmethod
+    def from_ctd_dataframe(cls, diseases: 'pd.DataFrame') -> 'ExactMatchIndex':
+        return cls(get_ctd_records(diseases))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, record: dict):
+        """
+        Adds or replaces a disease, keeping the index in line with the knowledge base.
+        """
+        if record['MESH_ID'] in self.records:
+            self.remove(record['MESH_ID'])
+
+        self.records[record['MESH_ID']] = record
+
+        for name in get_record_names(record):
+            self.names.setdefault(name, set()).add(record['MESH_ID'])
+
+    def remove(self, mesh_id: str):
+        record = self.records.pop(mesh_id, None)
+        if record is None:
+            return
+
+        for name in get_record_names(record):
+            mesh_ids = self.names.get(name)
+            if mesh_ids is not None:
+                mesh_ids.discard(mesh_id)
+                if not mesh_ids:
+                    del self.names[name]
+
+    def update(self, records: Iterable[dict], removed_ids: Iterable[str] = ()):
+        """
+        Applies a knowledge base update in place, e.g. the diff of `kg_loader.update_ctd_diseases`.
+        """
+        for mesh_id in removed_ids:
+            self.remove(mesh_id)
+
+        for record in records:
+            self.add(record)
+
+    def lookup(self, disease_name: str) -> Optional[dict]:
+        """
+        Returns the candidate for an unambiguous exact match, in the shape of a direct vector hit, or None.
+        """
+        self.lookups += 1
+        mesh_ids = self.names.get(normalize_name(disease_name))
+
+        if mesh_ids is None:
+            return None
+
+        if len(mesh_ids) > 1:
+            self.ambiguous += 1
+            return None
+
+        self.hits += 1
+        record = self.records[next(iter(mesh_ids))]
+
+        return {
+            'MESH_ID': record['MESH_ID'],
+            'Description': record['Description'],
+            'Synonyms': record['Synonyms'],
+            'AltDiseaseIDs': record['AltDiseaseIDs'],
+            'score': 1.0
+        }
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'ambiguous': self.ambiguous,
+            'misses': self.lookups - self.hits - self.ambiguous,
+            'hit_rate': self.hit_rate
+        }
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.hits = 0
+        self.ambiguous = 0
@@ -0,0 +1,196 @@
+import math
+import re
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+from utils.exact_match_index import disease_names_retrieve_query, get_ctd_records
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from neo4j import Driver
+
+
+###########
+# HELPERS #
+###########
+
+token_pattern = re.compile(r"[a-z0-9]+(?:[-'/.][a-z0-9]+)*")
+token_part_pattern = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercases and splits the text, keeping hyphenated and dotted forms such as "ataxia-telangiectasia"
+    or "2.1" as tokens next to their parts, so subtype details are not thrown away.
+    """
+    tokens = []
+
+    for token in token_pattern.findall(text.lower()):
+        tokens.append(token)
+        parts = token_part_pattern.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+
+    return tokens
+
+def char_ngrams(tokens: List[str], n=3) -> List[str]:
+    ngrams = []
+
+    for token in tokens:
+        padded = f"#{token}#"
+        ngrams.extend(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+
+    return ngrams
+
+
+class BM25Postings:
+    """
+    Inverted index with the BM25 weight of every posting computed at build time,
+    so scoring a query is a handful of `np.add.at` calls.
+    """
+
+    def __init__(self, documents: List[List[str]], k1=1.2, b=0.75):
+        self.num_docs = len(documents)
+        term_frequencies = [Counter(terms) for terms in documents]
+        doc_lengths = np.array([len(terms) for terms in documents], dtype=np.float64)
+        avg_doc_length = doc_lengths.mean() if self.num_docs > 0 else 0.0
+
+        postings: Dict[str, Tuple[list, list]] = {}
+        for doc_id, frequencies in enumerate(term_frequencies):
+            for term, tf in frequencies.items():
+                doc_ids, tfs = postings.setdefault(term, ([], []))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for term, (doc_ids, tfs) in postings.items():
+            doc_ids = np.array(doc_ids, dtype=np.int32)
+            tfs = np.array(tfs, dtype=np.float64)
+            idf = math.log(1 + (self.num_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            norm = k1 * (1 - b + b * doc_lengths[doc_ids] / avg_doc_length)
+            self.postings[term] = (doc_ids, (idf * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32))
+
+    @classmethod
+    def from_arrays(cls, num_docs: int, terms: Sequence[str], indptr: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray) -> 'BM25Postings':
+        """
+        Rebuilds the postings from `to_arrays`, with the posting lists as views into the
+        (possibly memory-mapped) arrays.
+        """
+        postings = cls([])
+        postings.num_docs = num_docs
+        postings.postings = {
+            term: (doc_ids[indptr[i]:indptr[i + 1]], weights[indptr[i]:indptr[i + 1]])
+            for i, term in enumerate(terms)
+        }
+
+        return postings
+
+    def to_arrays(self) -> tuple:
+        """
+        Returns the terms and their posting lists concatenated in CSR form: (terms, indptr, doc_ids, weights).
+        """
+        terms = list(self.postings.keys())
+        lengths = [len(self.postings[term][0]) for term in terms]
+
+        return (
+            terms,
+            np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64),
+            np.concatenate([self.postings[term][0] for term in terms]) if terms else np.empty(0, dtype=np.int32),
+            np.concatenate([self.postings[term][1] for term in terms]) if terms else np.empty(0, dtype=np.float32)
+        )
+
+    def score(self, terms: List[str], scores: np.ndarray, weight=1.0):
+        for term, query_tf in Counter(terms).items():
+            posting = self.postings.get(term)
+            if posting is not None:
+                np.add.at(scores, posting[0], posting[1] * (weight * query_tf))
+
+
+class FulltextEngine:
+    """
+    In-process BM25 fulltext search over DiseaseName and Synonyms, a local stand-in for the `diseaseIndex`
+    Lucene index that returns the same records as `fulltext_search`.
+
+    With `ngram_size` set, character n-gram postings are scored as well (weighted by `ngram_weight`)
+    so misspelled or differently inflected mentions still find their candidates.
+    """
+
+    def __init__(self, records: Iterable[dict], ngram_size: Optional[int] = None, ngram_weight=0.3, k1=1.2, b=0.75):
+        self.records = list(records)
+        self.ngram_size = ngram_size
+        self.ngram_weight = ngram_weight
+
+        documents = [tokenize(self.get_record_text(record)) for record in self.records]
+        self.words = BM25Postings(documents, k1, b)
+        self.ngrams = BM25Postings([char_ngrams(tokens, ngram_size) for tokens in documents], k1, b) if ngram_size else None
+
+    @classmethod
+    def from_postings(
+            cls,
+            records: Sequence[dict],
+            words: BM25Postings,
+            ngrams: Optional[BM25Postings] = None,
+            ngram_size: Optional[int] = None,
+            ngram_weight=0.3
+            ) -> 'FulltextEngine':
+        """
+        Creates the engine from prebuilt postings, e.g. those of a KB snapshot, without tokenizing the records.
+        """
+        engine = cls([], ngram_size, ngram_weight)
+        engine.records = records
+        engine.words = words
+        engine.ngrams = ngrams
+
+        return engine
+
+    @staticmethod
+    def get_record_text(record: dict) -> str:
+        names = [record['Description'] if isinstance(record['Description'], str) else ""]
+        if isinstance(record['Synonyms'], str):
+            names += record['Synonyms'].split('|')
+
+        return ' | '.join(names)
+
+    @classmethod
+    def from_driver(cls, driver: 'Driver', **kwargs) -> 'FulltextEngine':
+        with driver.session() as session:
+            return cls([record.data() for record in session.run(disease_names_retrieve_query)], **kwargs)
+
+    @classmethod
+    def from_ctd_dataframe(cls, diseases: 'pd.DataFrame', **kwargs) -> 'FulltextEngine':
+        return cls(get_ctd_records(diseases), **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def scores(self, disease_name: str) -> np.ndarray:
+        scores = np.zeros(len(self), dtype=np.float32)
+        tokens = tokenize(disease_name)
+
+        self.words.score(tokens, scores)
+        if self.ngrams is not None:
+            self.ngrams.score(char_ngrams(tokens, self.ngram_size), scores, self.ngram_weight)
+
+        return scores
+
+    def search(self, disease_name: str, limit=1) -> list:
+        if limit <= 0:
+            return []
+
+        scores = self.scores(disease_name)
+        matches = np.flatnonzero(scores > 0)
+
+        if len(matches) > limit:
+            matches = matches[np.argpartition(-scores[matches], limit - 1)[:limit]]
+        matches = matches[np.argsort(-scores[matches], kind='stable')]
+
+        return [{
+            'MESH_ID': self.records[i]['MESH_ID'],
+            'Description': self.records[i]['Description'],
+            'Synonyms': self.records[i]['Synonyms'],
+            'AltDiseaseIDs': self.records[i]['AltDiseaseIDs'],
+            'score': float(scores[i])} for i in matches
+        ]
+
+    def search_batch(self, disease_names: List[str], limit=1) -> List[list]:
+        return [self.search(disease_name, limit) for disease_name in disease_names]
@@ -1,20 +1,41 @@
-from neo4j import Driver, GraphDatabase
 from enum import Enum
+from functools import lru_cache
 import os
 import re
-from dotenv import load_dotenv
-from typing import Literal, Union
+from typing import TYPE_CHECKING, Literal, Union
 
-load_dotenv()
+if TYPE_CHECKING:
+    from neo4j import AsyncDriver, Driver
+
+@lru_cache(maxsize=None)
+def load_environment():
+    # Read .env on first use instead of at import, processes serving from a KB snapshot never need it
+    from dotenv import load_dotenv
+    load_dotenv()
+
+def get_driver() -> 'Driver':
+    from neo4j import GraphDatabase
+    load_environment()
 
-def get_driver() -> Driver:
     uri = os.getenv('NEO4J_URI')
     username = os.getenv('NEO4J_USERNAME')
     password = os.getenv('NEO4J_PASSWORD')
 
     return GraphDatabase.driver(uri, auth=(username, password))
 
+def get_async_driver() -> 'AsyncDriver':
+    from neo4j import AsyncGraphDatabase
+    load_environment()
+
+    uri = os.getenv('NEO4J_URI')
+    username = os.getenv('NEO4J_USERNAME')
+    password = os.getenv('NEO4J_PASSWORD')
+
+    return AsyncGraphDatabase.driver(uri, auth=(username, password))
+
 def get_credentials(type: Literal['uri', 'username', 'password']) -> Union[str, None]:
+    load_environment()
+
     if type == 'uri':
         return os.getenv('NEO4J_URI')
     elif type == 'username':
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+import numpy as np
+
+from utils.disease_aliases import DiseaseAliases, split_ids
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from neo4j import Driver
+
+
+###########
+# QUERIES #
+###########
+
+hierarchy_edges_retrieve_query = """
+    MATCH (d:Disease)-[:SUB_CATEGORY_OF]->(p:Disease)
+    RETURN d.DiseaseID AS DiseaseID, p.DiseaseID AS ParentID
+"""
+
+###########
+# HELPERS #
+###########
+
+class HierarchyGraph:
+    """
+    The SUB_CATEGORY_OF hierarchy as an undirected CSR adjacency over interned disease IDs.
+
+    Distances are computed with a vectorised BFS from the true disease and memoised per source,
+    so all candidates predicted for the same disease share one traversal.
+    """
+
+    def __init__(
+            self,
+            aliases: DiseaseAliases,
+            edges: Iterable[Tuple[str, str]] = (),
+            max_cached_sources=4096,
+            pairs: Optional[np.ndarray] = None
+            ):
+        self.aliases = aliases
+        self.disease_ids: List[str] = list(aliases.ids.keys())
+        self.node_index = {disease_id: i for i, disease_id in enumerate(self.disease_ids)}
+
+        # (child, parent) node index pairs, given directly or resolved from the ID pairs in `edges`
+        if pairs is None:
+            pairs = np.array([
+                (self.node_index[child], self.node_index[parent])
+                for child, parent in edges if child in self.node_index and parent in self.node_index
+            ], dtype=np.int64).reshape(-1, 2)
+
+        # Store both directions since shortestPath((start)-[:SUB_CATEGORY_OF*]-(end)) ignores the relationship direction
+        sources = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        targets = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        order = np.argsort(sources, kind='stable')
+
+        self.indices = targets[order].astype(np.int32)
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=len(self.disease_ids)))]).astype(np.int64)
+
+        self.max_cached_sources = max_cached_sources
+        self._distances = OrderedDict()
+
+    @classmethod
+    def from_driver(cls, driver: 'Driver', aliases: Optional[DiseaseAliases] = None) -> 'HierarchyGraph':
+        if aliases is None:
+            aliases = DiseaseAliases.from_driver(driver)
+
+        with driver.session() as session:
+            result = session.run(hierarchy_edges_retrieve_query)
+            edges = [(record['DiseaseID'], record['ParentID']) for record in result]
+
+        return cls(aliases, edges)
+
+    @classmethod
+    def from_ctd_dataframe(cls, diseases: 'pd.DataFrame') -> 'HierarchyGraph':
+        """
+        Builds the graph straight from the CTD_diseases table (DiseaseID, AltDiseaseIDs, ParentIDs),
+        so the shortest path analysis can run without a database.
+        """
+        aliases = DiseaseAliases(zip(diseases['DiseaseID'], diseases['AltDiseaseIDs']))
+        edges = [
+            (disease_id, parent_id)
+            for disease_id, parent_ids in zip(diseases['DiseaseID'], diseases['ParentIDs'])
+            for parent_id in split_ids(parent_ids)
+        ]
+
+        return cls(aliases, edges)
+
+    @classmethod
+    def from_parent_csr(cls, aliases: DiseaseAliases, indptr: np.ndarray, parents: np.ndarray) -> 'HierarchyGraph':
+        """
+        Builds the graph from the parents of every disease in CSR form (the parents of node `i` are
+        `parents[indptr[i]:indptr[i + 1]]`), with the nodes in the order of `aliases`.
+        """
+        children = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+
+        return cls(aliases, pairs=np.stack([children, np.asarray(parents, dtype=np.int64)], axis=1))
+
+    def __len__(self) -> int:
+        return len(self.disease_ids)
+
+    def distances_from(self, source: int) -> np.ndarray:
+        if source in self._distances:
+            self._distances.move_to_end(source)
+            return self._distances[source]
+
+        distances = np.full(len(self), -1, dtype=np.int32)
+        distances[source] = 0
+        frontier = np.array([source], dtype=np.int64)
+        level = 0
+
+        while frontier.size > 0:
+            level += 1
+            starts = self.indptr[frontier]
+            counts = self.indptr[frontier + 1] - starts
+            total = counts.sum()
+
+            if total == 0:
+                break
+
+            # Gather the neighbours of the whole frontier without a Python loop
+            positions = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(total)
+            neighbours = self.indices[positions]
+            frontier = np.unique(neighbours[distances[neighbours] < 0]).astype(np.int64)
+            distances[frontier] = level
+
+        self._distances[source] = distances
+        if len(self._distances) > self.max_cached_sources:
+            self._distances.popitem(last=False)
+
+        return distances
+
+    def shortest_path(self, true_id: str, predicted_id: str) -> int:
+        """
+        Returns the number of hops between the two diseases, or -1 when either is unknown or no path exists.
+        """
+        start_id, end_id = self.aliases.resolve(true_id), self.aliases.resolve(predicted_id)
+
+        if start_id is None or end_id is None:
+            return -1
+
+        return int(self.distances_from(self.node_index[start_id])[self.node_index[end_id]])
@@ -1,11 +1,21 @@
+import asyncio
 import json
 import re
-from typing import Dict, List, Literal
-from neo4j import Driver
-from pandas import DataFrame
-from rapidfuzz import fuzz, distance
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Literal
 
+from utils.candidate_ranking import rank_candidates
+from utils.exact_match_index import ExactMatchIndex
+from utils.fulltext_engine import FulltextEngine
 from utils.generic import Models, Vectors, contains_abbreviation
+from utils.search_cache import SearchCache, make_cache_key
+from utils.string_similarity import calculate_string_similarity_batch, rescore_predictions, string_similarity_scorers
+from utils.tracing import span
+
+if TYPE_CHECKING:
+    from neo4j import AsyncDriver, Driver
+    from pandas import DataFrame
 
 
 ###########
@@ -31,29 +41,140 @@ vector_index_query = """
         score
 """
 
+batch_fulltext_index_query = """
+    UNWIND $batch AS item
+    CALL {
+        WITH item
+        CALL db.index.fulltext.queryNodes('diseaseIndex', item.disease_name)
+        YIELD node, score
+        RETURN node, score
+        LIMIT $limit
+    }
+    RETURN item.row AS row,
+        node.DiseaseID AS MESH_ID,
+        node.AltDiseaseIDs as AltDiseaseIDs,
+        node.DiseaseName AS Description,
+        node.Synonyms AS Synonyms,
+        score
+"""
+
+batch_vector_index_query = """
+    UNWIND $batch AS item
+    CALL {
+        WITH item
+        CALL db.index.vector.queryNodes($index, $limit, item.embedding)
+        YIELD node, score
+        WITH node, score
+        WHERE score > $threshold
+        RETURN node, score
+    }
+    RETURN item.row AS row,
+        node.DiseaseName AS Description,
+        node.DiseaseID AS MESH_ID,
+        node.AltDiseaseIDs AS AltDiseaseIDs,
+        node.Synonyms AS Synonyms,
+        score
+"""
+
 ###########
 # HELPERS #
 ###########
 
+def batch_list(lst: list, batch_size: int):
+    for i in range(0, len(lst), batch_size):
+        yield lst[i:i + batch_size]
+
+def demultiplex_records(records, batch_len: int) -> List[list]:
+    results = [[] for _ in range(batch_len)]
+
+    for record in records:
+        results[record['row']].append({
+            'MESH_ID': record['MESH_ID'],
+            'Description': record['Description'],
+            'Synonyms': record['Synonyms'],
+            'AltDiseaseIDs': record['AltDiseaseIDs'],
+            'score': record['score']
+        })
+
+    return results
+
+def label_search_results(search_results: list, true_mesh_id: str, disease_name: str) -> list:
+    for item in search_results:
+        item['True MESH_ID'] = true_mesh_id
+        item['True Description'] = disease_name
+
+    return search_results if len(search_results) > 0 else [{
+        "MESH_ID": "Unknown", 
+        "AltDiseaseIDs": "Unknown", 
+        "Description": "Unknown",
+        "True MESH_ID": true_mesh_id,
+        "True Description": disease_name
+        }]
+
 def fulltext_search(
         query: str,
         disease_name: str,
-        driver: Driver,
+        driver: 'Driver',
         limit=1
         ) -> list:
-    with driver.session() as session:
+    with span('fulltext_search', limit=limit) as fulltext_span:
+        # Sessions are lazy, the connection is acquired by the first run and so timed by the query span
+        with driver.session() as session:
+            disease_name_re = re.sub('[^A-Za-z0-9 ]+', '', disease_name) # to address the limitation of the fulltext index
+
+            with span('fulltext_search.query'):
+                result = session.run(query, disease_name=disease_name_re, limit=limit)
+
+                search_results = [{
+                    'MESH_ID': record['MESH_ID'],
+                    'Description': record['Description'],
+                    'Synonyms': record['Synonyms'],
+                    'AltDiseaseIDs': record['AltDiseaseIDs'],
+                    'score': record['score']} for record in result
+                ]
+
+        fulltext_span.set(rows=len(search_results))
+        return search_results
+
+async def fulltext_search_async(
+        query: str,
+        disease_name: str,
+        driver: 'AsyncDriver',
+        limit=1
+        ) -> list:
+    async with driver.session() as session:
         disease_name_re = re.sub('[^A-Za-z0-9 ]+', '', disease_name) # to address the limitation of the fulltext index
 
-        result = session.run(query, disease_name=disease_name_re, limit=limit)
+        result = await session.run(query, disease_name=disease_name_re, limit=limit)
 
         return [{
             'MESH_ID': record['MESH_ID'],
             'Description': record['Description'],
             'Synonyms': record['Synonyms'],
             'AltDiseaseIDs': record['AltDiseaseIDs'],
-            'score': record['score']} for record in result
+            'score': record['score']} async for record in result
         ]
 
+def fulltext_search_batch(
+        disease_names: List[str],
+        driver: 'Driver',
+        limit=1,
+        query=batch_fulltext_index_query
+        ) -> List[list]:
+    batch = [
+        {'row': i, 'disease_name': re.sub('[^A-Za-z0-9 ]+', '', disease_name)}
+        for i, disease_name in enumerate(disease_names)
+    ]
+
+    with driver.session() as session:
+        result = session.run(query, batch=batch, limit=limit)
+
+        return demultiplex_records(result, len(batch))
+
+def parse_embedding(embedding) -> list:
+    # Embedding columns hold JSON strings in the CSV files, or vectors when attached from an EmbeddingStore
+    return json.loads(embedding) if isinstance(embedding, str) else embedding
+
 def get_embedding_col_name(
         model: Models,
         prop: Literal['SynonymsCentroidEmbedding','DiseaseEmbedding' ,'SynonymsEmbedding']
@@ -61,41 +182,153 @@ def get_embedding_col_name(
     return f"{prop}-{model.value.replace('.', '_').replace('/', '-')}"
 
 def vector_index_search(
-        driver: Driver,
+        driver: 'Driver',
         query: str,
         embedding: list,
         index: str,
         limit=1, 
         threshold=0.80
         ) -> list:
-    with driver.session() as session:
-        result = session.run(query, index=index, embedding=embedding, limit=limit, threshold=threshold)
+    with span('vector_index_search', index=index, limit=limit) as vector_span:
+        with driver.session() as session:
+            with span('vector_index_search.query'):
+                result = session.run(query, index=index, embedding=embedding, limit=limit, threshold=threshold)
+
+                search_results = [{
+                    'MESH_ID': record['MESH_ID'],
+                    'Description': record['Description'],
+                    'Synonyms': record['Synonyms'],
+                    'AltDiseaseIDs': record['AltDiseaseIDs'],
+                    'score': record['score']} for record in result
+                ]
+
+        vector_span.set(rows=len(search_results))
+        return search_results
+
+async def vector_index_search_async(
+        driver: 'AsyncDriver',
+        query: str,
+        embedding: list,
+        index: str,
+        limit=1,
+        threshold=0.80
+        ) -> list:
+    async with driver.session() as session:
+        result = await session.run(query, index=index, embedding=embedding, limit=limit, threshold=threshold)
 
         return [{
             'MESH_ID': record['MESH_ID'],
             'Description': record['Description'],
             'Synonyms': record['Synonyms'],
             'AltDiseaseIDs': record['AltDiseaseIDs'],
-            'score': record['score']} for record in result
+            'score': record['score']} async for record in result
         ]
 
+def vector_index_search_batch(
+        driver: 'Driver',
+        embeddings: List[list],
+        index: str,
+        limit=1,
+        threshold=0.80,
+        query=batch_vector_index_query
+        ) -> List[list]:
+    batch = [{'row': i, 'embedding': embedding} for i, embedding in enumerate(embeddings)]
+
+    with driver.session() as session:
+        result = session.run(query, batch=batch, index=index, limit=limit, threshold=threshold)
+
+        return demultiplex_records(result, len(batch))
+
+def search_vector_index_or_engine(
+        driver: 'Driver',
+        embedding: list,
+        index: str,
+        limit=1,
+        threshold=0.80,
+        vector_engines: dict = None
+        ) -> list:
+    # Answer from the in-process engine (see utils.vector_engine) when one is loaded for the index
+    if vector_engines is not None and index in vector_engines:
+        with span('vector_engine.search', index=index, limit=limit) as engine_span:
+            search_results = vector_engines[index].search(embedding, limit, threshold)
+            engine_span.set(rows=len(search_results))
+
+            return search_results
+
+    return vector_index_search(driver, vector_index_query, embedding, index, limit, threshold)
+
+def search_vector_index_or_engine_batch(
+        driver: 'Driver',
+        embeddings: List[list],
+        index: str,
+        limit=1,
+        threshold=0.80,
+        vector_engines: dict = None
+        ) -> List[list]:
+    if vector_engines is not None and index in vector_engines:
+        return vector_engines[index].search_batch(embeddings, limit, threshold)
+
+    return vector_index_search_batch(driver, embeddings, index, limit, threshold)
+
 def predict_with_vector_index(
-        dataset: DataFrame,
+        dataset: 'DataFrame',
         query: str,
         index: str,
         embedding_col: str,
-        driver: Driver,
+        driver: 'Driver',
         limit=1,
-        threshold=0.80
+        threshold=0.80,
+        batch_size: int = None,
+        batch_query=batch_vector_index_query
+        ) -> list:
+    """
+    With `batch_size` the mentions are searched with `batch_query`, the UNWIND form of `query`,
+    so a custom `query` has to come with its own `batch_query`.
+    """
+    with span('predict_with_vector_index', index=index, rows=len(dataset), batch_size=batch_size):
+        return _predict_with_vector_index(dataset, query, index, embedding_col, driver, limit, threshold, batch_size, batch_query)
+
+def _predict_with_vector_index(
+        dataset: 'DataFrame',
+        query: str,
+        index: str,
+        embedding_col: str,
+        driver: 'Driver',
+        limit=1,
+        threshold=0.80,
+        batch_size: int = None,
+        batch_query=batch_vector_index_query
         ) -> list:
     predicted_values = []
 
+    if batch_size is not None:
+        if query != vector_index_query and batch_query == batch_vector_index_query:
+            raise ValueError('A custom `query` needs a matching `batch_query` to be run in batches')
+
+        # One UNWIND round trip per batch of mentions instead of one query per row
+        rows = list(zip(dataset['Description'], dataset['MESH ID'], dataset[embedding_col]))
+
+        for batch in batch_list(rows, batch_size):
+            with span('predict_with_vector_index.parse_embedding', rows=len(batch)):
+                embeddings = [parse_embedding(embedding) for _, _, embedding in batch]
+
+            with span('predict_with_vector_index.batch', rows=len(batch)):
+                batch_results = vector_index_search_batch(driver, embeddings, index, limit, threshold, batch_query)
+
+            for (disease_name, true_mesh_id, _), search_results in zip(batch, batch_results):
+                predicted_values.append(label_search_results(search_results, true_mesh_id, disease_name))
+
+        return predicted_values
+
     for _, row in dataset.iterrows():
         disease_name = row['Description']
         true_mesh_id = row['MESH ID']
         embedding = row[embedding_col]
-        
-        search_results = vector_index_search(driver, query, json.loads(embedding), index, limit, threshold)
+
+        with span('predict_with_vector_index.parse_embedding', rows=1):
+            embedding = parse_embedding(embedding)
+
+        search_results = vector_index_search(driver, query, embedding, index, limit, threshold)
 
         for item in search_results:
             item['True MESH_ID'] = true_mesh_id
@@ -113,42 +346,39 @@ def predict_with_vector_index(
     return predicted_values
 
 def predict_with_fulltext_index(
-        dataset: DataFrame,
-        driver: Driver,
-        limit=1
+        dataset: 'DataFrame',
+        driver: 'Driver',
+        limit=1,
+        batch_size: int = None
+        ) -> list:
+    with span('predict_with_fulltext_index', rows=len(dataset), batch_size=batch_size):
+        return _predict_with_fulltext_index(dataset, driver, limit, batch_size)
+
+def _predict_with_fulltext_index(
+        dataset: 'DataFrame',
+        driver: 'Driver',
+        limit=1,
+        batch_size: int = None
         ) -> list:
     predicted_values = []
 
-    for _, row in dataset.iterrows():
-        disease_name = row['Description']
-        true_mesh_id = row['MESH ID']
-        
-        search_results = fulltext_search(fulltext_index_query, disease_name, driver, limit)
-        for item in search_results:
-            item['True MESH_ID'] = true_mesh_id
-            item['True Description'] = disease_name
-        
-        predicted_values.append(search_results if len(search_results) > 0 else [{
-            "MESH_ID": "Unknown", 
-            "AltDiseaseIDs": "Unknown", 
-            "Description": "Unknown",
-            "True MESH_ID": true_mesh_id,
-            "True Description": disease_name
-            }]
-        )
+    if batch_size is not None:
+        rows = list(zip(dataset['Description'], dataset['MESH ID']))
 
-    return predicted_values
+        for batch in batch_list(rows, batch_size):
+            with span('predict_with_fulltext_index.batch', rows=len(batch)):
+                batch_results = fulltext_search_batch([disease_name for disease_name, _ in batch], driver, limit)
 
-def get_combined_search_for_df(dataset: DataFrame, embedding_col: str, driver: Driver) -> list:
-    predicted_values = []
+            for (disease_name, true_mesh_id), search_results in zip(batch, batch_results):
+                predicted_values.append(label_search_results(search_results, true_mesh_id, disease_name))
+
+        return predicted_values
 
     for _, row in dataset.iterrows():
         disease_name = row['Description']
         true_mesh_id = row['MESH ID']
-        embedding = row[embedding_col]
         
-        search_results = combined_search(disease_name=disease_name, embedding=json.loads(embedding), driver=driver)
-
+        search_results = fulltext_search(fulltext_index_query, disease_name, driver, limit)
         for item in search_results:
             item['True MESH_ID'] = true_mesh_id
             item['True Description'] = disease_name
@@ -165,20 +395,15 @@ def get_combined_search_for_df(dataset: DataFrame, embedding_col: str, driver: D
     return predicted_values
 
 def calculate_string_similarity(candidates_list: List[str], disease_name: str) -> Dict[str, float]:
-    similarity_metrics = {
-        "weighted_ratio": 0,
-        "token_set_ratio": 0,
-        "JaroWinkler_distance": 0,
-        "LCSseq_distance": 0
-    }
+    """
+    The best similarity of a single candidate's names to the disease name, see `calculate_string_similarity_batch`.
+    """
+    if len(candidates_list) == 0:
+        return {metric: 0 for metric in string_similarity_scorers}
 
-    for candidate in candidates_list:
-        similarity_metrics["weighted_ratio"] = max(similarity_metrics["weighted_ratio"], fuzz.WRatio(candidate, disease_name))
-        similarity_metrics["token_set_ratio"] = max(similarity_metrics["token_set_ratio"], fuzz.token_set_ratio(candidate, disease_name))
-        similarity_metrics["JaroWinkler_distance"] = max(similarity_metrics["JaroWinkler_distance"], distance.JaroWinkler.similarity(candidate, disease_name))
-        similarity_metrics["LCSseq_distance"] = max(similarity_metrics["LCSseq_distance"], distance.LCSseq.similarity(candidate, disease_name))
+    similarity_metrics = calculate_string_similarity_batch([candidates_list], disease_name)
 
-    return similarity_metrics
+    return {metric: values[0].item() for metric, values in similarity_metrics.items()}
 
 def custom_sort_key(candidate: dict, disease_name: str) -> tuple:
     abbrev = contains_abbreviation(disease_name)
@@ -212,101 +437,641 @@ def custom_sort_key(candidate: dict, disease_name: str) -> tuple:
         -quaternary_metric
     )
 
-def process_predictions(predictions: list, disease_name: str) -> list:
-    for prediction in predictions:
-        synonyms = prediction['Synonyms'] if isinstance(prediction['Synonyms'], str) else ""
-        combined_names = synonyms.split('|') + [prediction['Description']]
+def process_predictions(predictions: list, disease_name: str, workers=1) -> list:
+    rescore_predictions([predictions], disease_name, workers)
 
-        ranking = calculate_string_similarity(combined_names, disease_name)
-        prediction.update(ranking)
-
-    return sorted(predictions, key=lambda candidate: custom_sort_key(candidate, disease_name))
+    return rank_candidates(disease_name, [predictions])
 
 def find_all_direct_vector_hits(candidates: list) -> list:
     return [d for d in candidates if d.get('score') == 1.0]
 
+def get_cache_limit(limit: int, cascade=None, fusion='tuple', fusion_params: dict = None):
+    # The limit part of the cache key, tagged for results that differ from the default full search
+    if cascade is not None:
+        return f'cascade-{limit}'
+    if fusion != 'tuple' or fusion_params:
+        return f"{fusion}-{json.dumps(fusion_params or {}, sort_keys=True)}-{limit}"
+
+    return limit
+
+
+class CascadeConfig:
+    """
+    Stages and budgets of the cascade mode of `combined_search`.
+
+    Parameters:
+        name_vector_limit (int): The initial k of the disease name vector index.
+        centroid_vector_limit (int): The initial k of the synonyms centroid vector index.
+        max_vector_limit (int): The k the vector stages grow to when the cascade falls through to fulltext.
+        fulltext_limit (int): The limit of the fulltext stage.
+        min_confidence (float): The primary string similarity (0-100) the best vector candidate needs to settle the mention.
+        margin (float): How far that similarity has to be ahead of the best candidate with another MESH_ID.
+        max_queries (int): Optional budget of index queries per mention; when spent, the best ranking so far is returned.
+    """
+
+    def __init__(
+            self,
+            name_vector_limit=10,
+            centroid_vector_limit=10,
+            max_vector_limit=100,
+            fulltext_limit=100,
+            min_confidence=90.0,
+            margin=10.0,
+            max_queries: int = None
+            ):
+        self.name_vector_limit = name_vector_limit
+        self.centroid_vector_limit = centroid_vector_limit
+        self.max_vector_limit = max_vector_limit
+        self.fulltext_limit = fulltext_limit
+        self.min_confidence = min_confidence
+        self.margin = margin
+        self.max_queries = max_queries
+
+
 def combined_search(
         disease_name: str,
         embedding: list,
-        driver: Driver,
-        limit: 100,
+        driver: 'Driver',
+        limit: int = 100,
         name_vec_index=Vectors.BAAI_DISEASE_NAME.value,
-        centoid_vec_index=Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value) -> dict:
-    fulltext_predictions = fulltext_search(
-        query=fulltext_index_query,
-        disease_name=disease_name,
-        driver=driver,
-        limit=100
-    )
+        centoid_vec_index=Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value,
+        vector_engines: dict = None,
+        executor: Executor = None,
+        workers=1,
+        exact_match_index: ExactMatchIndex = None,
+        fulltext_engine: FulltextEngine = None,
+        cache: SearchCache = None,
+        cascade: CascadeConfig = None,
+        fusion='tuple',
+        fusion_params: dict = None,
+        return_report=False):
+    """
+    With `return_report` returns the predictions and a report like `cascade_search`'s, whose 'stage' is
+    'cache', 'exact_match', a cascade stage or 'combined' for the full search.
+    """
+    if cache is not None:
+        # Cascade and fused results may differ from the full search, so they are cached under their own key
+        cache_key = make_cache_key(disease_name, name_vec_index, centoid_vec_index, get_cache_limit(limit, cascade, fusion, fusion_params))
+        with span('combined_search.cache') as cache_span:
+            search_results = cache.get(cache_key)
+            cache_span.set(hits=int(search_results is not None))
 
-    name_vector_predictions = vector_index_search(
-        driver=driver,
-        query=vector_index_query,
-        embedding=embedding,
-        index=name_vec_index,
+        report = {'stage': 'cache', 'queries': 0, 'limits': {}}
+        if search_results is None:
+            search_results, report = combined_search(
+                disease_name=disease_name,
+                embedding=embedding,
+                driver=driver,
+                limit=limit,
+                name_vec_index=name_vec_index,
+                centoid_vec_index=centoid_vec_index,
+                vector_engines=vector_engines,
+                executor=executor,
+                workers=workers,
+                exact_match_index=exact_match_index,
+                fulltext_engine=fulltext_engine,
+                cascade=cascade,
+                fusion=fusion,
+                fusion_params=fusion_params,
+                return_report=True
+            )
+            cache.put(cache_key, search_results)
+
+        return (search_results, report) if return_report else search_results
+
+    if exact_match_index is not None:
+        # Unambiguous exact name/synonym matches skip the index queries and the rescoring
+        with span('combined_search.exact_match') as exact_match_span:
+            exact_match = exact_match_index.lookup(disease_name)
+            exact_match_span.set(hits=int(exact_match is not None))
+
+        if exact_match is not None:
+            return ([exact_match], {'stage': 'exact_match', 'queries': 0, 'limits': {}}) if return_report else [exact_match]
+
+    if cascade is not None:
+        with span('combined_search.cascade') as cascade_span:
+            search_results, report = cascade_search(
+                disease_name=disease_name,
+                embedding=embedding,
+                driver=driver,
+                limit=limit,
+                name_vec_index=name_vec_index,
+                centoid_vec_index=centoid_vec_index,
+                vector_engines=vector_engines,
+                fulltext_engine=fulltext_engine,
+                config=cascade,
+                workers=workers
+            )
+            cascade_span.set(stage=report['stage'], queries=report['queries'])
+
+        return (search_results, report) if return_report else search_results
+
+    with span('combined_search', limit=limit) as search_span:
+        retrievers = [
+            partial(
+                fulltext_search,
+                query=fulltext_index_query,
+                disease_name=disease_name,
+                driver=driver,
+                limit=100
+            ) if fulltext_engine is None else partial(fulltext_engine.search, disease_name, 100),
+            partial(
+                search_vector_index_or_engine,
+                driver=driver,
+                embedding=embedding,
+                index=name_vec_index,
+                limit=100,
+                threshold=0.80,
+                vector_engines=vector_engines
+            ),
+            partial(
+                search_vector_index_or_engine,
+                driver=driver,
+                embedding=embedding,
+                index=centoid_vec_index,
+                limit=100,
+                threshold=0.80,
+                vector_engines=vector_engines
+            )
+        ]
+
+        with span('combined_search.retrieve') as retrieve_span:
+            if executor is not None:
+                # Each retriever opens its own session on the shared driver, so they can run side by side
+                futures = [executor.submit(retriever) for retriever in retrievers]
+                fulltext_predictions, name_vector_predictions, centroid_synonyms_vector_predictions = [
+                    future.result() for future in futures
+                ]
+            else:
+                fulltext_predictions, name_vector_predictions, centroid_synonyms_vector_predictions = [
+                    retriever() for retriever in retrievers
+                ]
+
+            retrieve_span.set(
+                candidates=len(fulltext_predictions) + len(name_vector_predictions) + len(centroid_synonyms_vector_predictions)
+            )
+
+        search_results = rank_combined_predictions(
+            disease_name,
+            fulltext_predictions,
+            name_vector_predictions,
+            centroid_synonyms_vector_predictions,
+            limit,
+            workers,
+            fusion,
+            fusion_params
+        )
+
+        search_span.set(rows=len(search_results))
+
+    if return_report:
+        return search_results, {'stage': 'combined', 'queries': len(retrievers), 'limits': {'fulltext': 100, 'name_vector': 100, 'centroid_vector': 100}}
+
+    return search_results
+
+async def combined_search_async(
+        disease_name: str,
+        embedding: list,
+        driver: 'AsyncDriver',
         limit=100,
-        threshold=0.80
+        name_vec_index=Vectors.BAAI_DISEASE_NAME.value,
+        centoid_vec_index=Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value,
+        vector_engines: dict = None,
+        workers=1,
+        exact_match_index: ExactMatchIndex = None,
+        fulltext_engine: FulltextEngine = None,
+        cache: SearchCache = None) -> list:
+    if cache is not None:
+        cache_key = make_cache_key(disease_name, name_vec_index, centoid_vec_index, limit)
+        search_results = cache.get(cache_key)
+
+        if search_results is None:
+            search_results = await combined_search_async(
+                disease_name=disease_name,
+                embedding=embedding,
+                driver=driver,
+                limit=limit,
+                name_vec_index=name_vec_index,
+                centoid_vec_index=centoid_vec_index,
+                vector_engines=vector_engines,
+                workers=workers,
+                exact_match_index=exact_match_index,
+                fulltext_engine=fulltext_engine
+            )
+            cache.put(cache_key, search_results)
+
+        return search_results
+
+    if exact_match_index is not None:
+        exact_match = exact_match_index.lookup(disease_name)
+        if exact_match is not None:
+            return [exact_match]
+
+    async def vector_search(index: str) -> list:
+        if vector_engines is not None and index in vector_engines:
+            return vector_engines[index].search(embedding, 100, 0.80)
+
+        return await vector_index_search_async(driver, vector_index_query, embedding, index, 100, 0.80)
+
+    async def text_search() -> list:
+        if fulltext_engine is not None:
+            return fulltext_engine.search(disease_name, 100)
+
+        return await fulltext_search_async(fulltext_index_query, disease_name, driver, 100)
+
+    fulltext_predictions, name_vector_predictions, centroid_synonyms_vector_predictions = await asyncio.gather(
+        text_search(),
+        vector_search(name_vec_index),
+        vector_search(centoid_vec_index)
     )
-    
-    centroid_synonyms_vector_predictions = vector_index_search(
-        driver=driver,
-        query=vector_index_query,
-        embedding=embedding,
-        index=centoid_vec_index,
-        limit=100,
-        threshold=0.80
+
+    return rank_combined_predictions(
+        disease_name,
+        fulltext_predictions,
+        name_vector_predictions,
+        centroid_synonyms_vector_predictions,
+        limit,
+        workers
     )
 
-    name_vec_direct_hits = find_all_direct_vector_hits(name_vector_predictions)
-    centroid_direct_hits = find_all_direct_vector_hits(centroid_synonyms_vector_predictions)
+def rank_combined_predictions(
+        disease_name: str,
+        fulltext_predictions: list,
+        name_vector_predictions: list,
+        centroid_synonyms_vector_predictions: list,
+        limit=100,
+        workers=1,
+        fusion='tuple',
+        fusion_params: dict = None
+        ) -> list:
+    with span('combined_search.direct_hits') as direct_hits_span:
+        name_vec_direct_hits = find_all_direct_vector_hits(name_vector_predictions)
+        centroid_direct_hits = find_all_direct_vector_hits(centroid_synonyms_vector_predictions)
+        direct_hits_span.set(hits=len(name_vec_direct_hits) + len(centroid_direct_hits))
 
     if len(name_vec_direct_hits) > 0 or len(centroid_direct_hits) > 0:
         return name_vec_direct_hits + centroid_direct_hits
     else:
-        fulltext_predictions = process_predictions(fulltext_predictions, disease_name)
-        name_vector_predictions = process_predictions(name_vector_predictions, disease_name)
-        centroid_synonyms_vector_predictions = process_predictions(centroid_synonyms_vector_predictions, disease_name)
+        candidates = len(fulltext_predictions) + len(name_vector_predictions) + len(centroid_synonyms_vector_predictions)
+
+        # Score each distinct MESH_ID once across all three retrievers
+        with span('combined_search.rescore', candidates=candidates):
+            rescore_predictions(
+                [fulltext_predictions, name_vector_predictions, centroid_synonyms_vector_predictions],
+                disease_name,
+                workers
+            )
+
+        return sort_rescored_predictions(
+            disease_name,
+            fulltext_predictions,
+            name_vector_predictions,
+            centroid_synonyms_vector_predictions,
+            limit,
+            fusion,
+            **(fusion_params or {})
+        )
+
+def sort_rescored_predictions(
+        disease_name: str,
+        fulltext_predictions: list,
+        name_vector_predictions: list,
+        centroid_synonyms_vector_predictions: list,
+        limit=100,
+        fusion='tuple',
+        **fusion_params
+        ) -> list:
+    candidates = len(fulltext_predictions) + len(name_vector_predictions) + len(centroid_synonyms_vector_predictions)
+
+    # Same order as sorting every list by custom_sort_key, then their concatenation, see `rank_candidates`
+    with span('combined_search.sort', candidates=candidates):
+        return rank_candidates(
+            disease_name,
+            [fulltext_predictions, name_vector_predictions, centroid_synonyms_vector_predictions],
+            limit,
+            fusion,
+            **fusion_params
+        )
+
+def get_confidence(ranked_predictions: list, disease_name: str) -> tuple:
+    """
+    Returns the primary string similarity of the best candidate and its margin over the best candidate
+    with a different MESH_ID. An exact name match counts as fully confident.
+    """
+    if len(ranked_predictions) == 0:
+        return 0.0, 0.0
+
+    top_key = custom_sort_key(ranked_predictions[0], disease_name)
+    if top_key[0] == -1:
+        return 100.0, 100.0
+
+    runner_up = next((candidate for candidate in ranked_predictions if candidate['MESH_ID'] != ranked_predictions[0]['MESH_ID']), None)
+    runner_up_similarity = -custom_sort_key(runner_up, disease_name)[2] if runner_up is not None else 0.0
+
+    return -top_key[2], -top_key[2] - runner_up_similarity
+
+def cascade_search(
+        disease_name: str,
+        embedding: list,
+        driver: 'Driver',
+        limit=100,
+        name_vec_index=Vectors.BAAI_DISEASE_NAME.value,
+        centoid_vec_index=Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value,
+        vector_engines: dict = None,
+        fulltext_engine: FulltextEngine = None,
+        config: CascadeConfig = None,
+        workers=1
+        ) -> tuple:
+    """
+    Cost-aware variant of `combined_search` that stops at the first stage able to answer the mention:
+
+        1. 'name_vector': the name vector index at a small k, answered by direct hits (score 1.0)
+        2. 'centroid_vector': the centroid vector index at a small k, answered by direct hits
+        3. 'vector_margin': the rescored vector candidates, answered when the best one is confident
+           (`min_confidence`) and far enough ahead of the runner-up (`margin`)
+        4. 'fulltext': the fulltext index, with the vector stages grown to `max_vector_limit`
+           if they were cut off by k, ranked like `combined_search`
+
+    Unlike `combined_search`, a name vector direct hit is returned without the centroid index's direct hits.
+
+    Returns:
+        tuple: The ranked predictions and a report with the answering 'stage', the number of index
+        'queries' and the 'limits' used per stage.
+    """
+    config = config if config is not None else CascadeConfig()
+    report = {'stage': None, 'queries': 0, 'limits': {}}
+
+    def search_vector(stage: str, index: str, k: int) -> list:
+        report['queries'] += 1
+        report['limits'][stage] = k
+
+        with span(f'cascade_search.{stage}', limit=k) as stage_span:
+            search_results = search_vector_index_or_engine(driver, embedding, index, k, 0.80, vector_engines)
+            stage_span.set(rows=len(search_results))
+
+            return search_results
+
+    def over_budget() -> bool:
+        return config.max_queries is not None and report['queries'] >= config.max_queries
+
+    name_vector_predictions = search_vector('name_vector', name_vec_index, config.name_vector_limit)
+    name_vec_direct_hits = find_all_direct_vector_hits(name_vector_predictions)
+
+    if len(name_vec_direct_hits) > 0:
+        report['stage'] = 'name_vector'
+        return name_vec_direct_hits, report
+
+    centroid_synonyms_vector_predictions = []
+    if not over_budget():
+        centroid_synonyms_vector_predictions = search_vector('centroid_vector', centoid_vec_index, config.centroid_vector_limit)
+        centroid_direct_hits = find_all_direct_vector_hits(centroid_synonyms_vector_predictions)
+
+        if len(centroid_direct_hits) > 0:
+            report['stage'] = 'centroid_vector'
+            return centroid_direct_hits, report
+
+    with span('combined_search.rescore', candidates=len(name_vector_predictions) + len(centroid_synonyms_vector_predictions)):
+        rescore_predictions([name_vector_predictions, centroid_synonyms_vector_predictions], disease_name, workers)
+
+    ranked_predictions = sort_rescored_predictions(disease_name, [], name_vector_predictions, centroid_synonyms_vector_predictions, limit)
+    similarity, margin = get_confidence(ranked_predictions, disease_name)
+
+    if (similarity >= config.min_confidence and margin >= config.margin) or over_budget():
+        report['stage'] = 'vector_margin'
+        return ranked_predictions, report
+
+    # Low confidence: grow the vector stages that were cut off by k and add the fulltext candidates
+    if len(name_vector_predictions) >= config.name_vector_limit and config.max_vector_limit > config.name_vector_limit and not over_budget():
+        name_vector_predictions = search_vector('name_vector', name_vec_index, config.max_vector_limit)
+    if len(centroid_synonyms_vector_predictions) >= config.centroid_vector_limit and config.max_vector_limit > config.centroid_vector_limit and not over_budget():
+        centroid_synonyms_vector_predictions = search_vector('centroid_vector', centoid_vec_index, config.max_vector_limit)
+
+    fulltext_predictions = []
+    if not over_budget():
+        report['queries'] += 1
+        report['limits']['fulltext'] = config.fulltext_limit
+
+        with span('cascade_search.fulltext', limit=config.fulltext_limit) as stage_span:
+            if fulltext_engine is not None:
+                fulltext_predictions = fulltext_engine.search(disease_name, config.fulltext_limit)
+            else:
+                fulltext_predictions = fulltext_search(fulltext_index_query, disease_name, driver, config.fulltext_limit)
+            stage_span.set(rows=len(fulltext_predictions))
+
+    with span('combined_search.rescore', candidates=len(fulltext_predictions) + len(name_vector_predictions) + len(centroid_synonyms_vector_predictions)):
+        rescore_predictions([fulltext_predictions, name_vector_predictions, centroid_synonyms_vector_predictions], disease_name, workers)
+
+    report['stage'] = 'fulltext'
+    return sort_rescored_predictions(
+        disease_name,
+        fulltext_predictions,
+        name_vector_predictions,
+        centroid_synonyms_vector_predictions,
+        limit
+    ), report
+
+def summarize_cascade_reports(reports: List[dict]) -> dict:
+    """
+    Returns the share of mentions answered by every cascade stage and the mean number of index queries.
+    """
+    stages = [report['stage'] for report in reports]
+
+    return {
+        'mentions': len(reports),
+        'stages': {stage: stages.count(stage) / len(reports) for stage in dict.fromkeys(stages)} if reports else {},
+        'queries_per_mention': sum(report['queries'] for report in reports) / len(reports) if reports else 0.0
+    }
+
+def combined_search_batch(
+        disease_names: List[str],
+        embeddings: List[list],
+        driver: 'Driver',
+        limit=100,
+        name_vec_index=Vectors.BAAI_DISEASE_NAME.value,
+        centoid_vec_index=Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value,
+        vector_engines: dict = None,
+        workers=1,
+        exact_match_index: ExactMatchIndex = None,
+        fulltext_engine: FulltextEngine = None,
+        cache: SearchCache = None,
+        fusion='tuple',
+        fusion_params: dict = None) -> List[list]:
+    if cache is not None:
+        cache_limit = get_cache_limit(limit, None, fusion, fusion_params)
+        cache_keys = [make_cache_key(disease_name, name_vec_index, centoid_vec_index, cache_limit) for disease_name in disease_names]
+        results = [cache.get(cache_key) for cache_key in cache_keys]
+        misses = [i for i, cached in enumerate(results) if cached is None]
+
+        miss_results = combined_search_batch(
+            disease_names=[disease_names[i] for i in misses],
+            embeddings=[embeddings[i] for i in misses],
+            driver=driver,
+            limit=limit,
+            name_vec_index=name_vec_index,
+            centoid_vec_index=centoid_vec_index,
+            vector_engines=vector_engines,
+            workers=workers,
+            exact_match_index=exact_match_index,
+            fulltext_engine=fulltext_engine,
+            fusion=fusion,
+            fusion_params=fusion_params
+        ) if misses else []
+
+        for i, search_results in zip(misses, miss_results):
+            cache.put(cache_keys[i], search_results)
+            results[i] = search_results
+
+        return results
+
+    if exact_match_index is not None:
+        exact_matches = [exact_match_index.lookup(disease_name) for disease_name in disease_names]
+        misses = [i for i, exact_match in enumerate(exact_matches) if exact_match is None]
+
+        miss_results = combined_search_batch(
+            disease_names=[disease_names[i] for i in misses],
+            embeddings=[embeddings[i] for i in misses],
+            driver=driver,
+            limit=limit,
+            name_vec_index=name_vec_index,
+            centoid_vec_index=centoid_vec_index,
+            vector_engines=vector_engines,
+            workers=workers,
+            fulltext_engine=fulltext_engine,
+            fusion=fusion,
+            fusion_params=fusion_params
+        ) if misses else []
+
+        results = [[exact_match] if exact_match is not None else None for exact_match in exact_matches]
+        for i, search_results in zip(misses, miss_results):
+            results[i] = search_results
+
+        return results
+
+    if fulltext_engine is not None:
+        fulltext_predictions = fulltext_engine.search_batch(disease_names, limit=100)
+    else:
+        fulltext_predictions = fulltext_search_batch(disease_names, driver, limit=100)
+
+    name_vector_predictions = search_vector_index_or_engine_batch(
+        driver=driver,
+        embeddings=embeddings,
+        index=name_vec_index,
+        limit=100,
+        threshold=0.80,
+        vector_engines=vector_engines
+    )
 
-        # Combine all predictions and sort
-        combined = fulltext_predictions + name_vector_predictions + centroid_synonyms_vector_predictions
-        combined = sorted(combined, key=lambda candidate: custom_sort_key(candidate, disease_name))
+    centroid_synonyms_vector_predictions = search_vector_index_or_engine_batch(
+        driver=driver,
+        embeddings=embeddings,
+        index=centoid_vec_index,
+        limit=100,
+        threshold=0.80,
+        vector_engines=vector_engines
+    )
 
-        return combined[0:limit]
+    return [
+        rank_combined_predictions(disease_name, fulltext, name_vector, centroid_vector, limit, workers, fusion, fusion_params)
+        for disease_name, fulltext, name_vector, centroid_vector in zip(
+            disease_names, fulltext_predictions, name_vector_predictions, centroid_synonyms_vector_predictions
+        )
+    ]
     
-def get_combined_search_for_df(dataset: DataFrame,
+def get_combined_search_for_df(dataset: 'DataFrame',
                                embedding_col: str,
-                               driver: Driver,
-                               limit: 100,
-                               name_vec_index: Vectors.BAAI_DISEASE_NAME.value,
-                               centoid_vec_index: Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value
+                               driver: 'Driver',
+                               limit=100,
+                               name_vec_index=Vectors.BAAI_DISEASE_NAME.value,
+                               centoid_vec_index=Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value,
+                               vector_engines: dict = None,
+                               batch_size: int = None,
+                               exact_match_index: ExactMatchIndex = None,
+                               fulltext_engine: FulltextEngine = None,
+                               cache: SearchCache = None,
+                               executor: Executor = None,
+                               workers=1,
+                               cascade: CascadeConfig = None,
+                               fusion='tuple',
+                               fusion_params: dict = None
                                ) -> list:
+    """
+    Runs `combined_search` for every annotation of the DataFrame and labels the predictions with the true MESH ID.
+
+    With `workers` > 1 and no `executor`, the three retrievers of each mention run on a thread pool
+    created for the call, and `workers` threads rescore the candidates. With `batch_size` the mentions
+    are searched with `combined_search_batch` instead, which has no cascade mode.
+    """
     predicted_values = []
 
-    for _, row in dataset.iterrows():
-        disease_name = row['Description']
-        true_mesh_id = row['MESH ID']
-        embedding = row[embedding_col]
-        
-        search_results = combined_search(
-            disease_name=disease_name,
-            embedding=json.loads(embedding),
-            driver=driver,
-            limit=limit,
-            name_vec_index=name_vec_index,
-            centoid_vec_index=centoid_vec_index
+    if batch_size is not None:
+        if cascade is not None:
+            raise ValueError('cascade is not supported with batch_size, the batched search always runs the full search')
+
+        rows = list(zip(dataset['Description'], dataset['MESH ID'], dataset[embedding_col]))
+
+        for batch in batch_list(rows, batch_size):
+            batch_results = combined_search_batch(
+                disease_names=[disease_name for disease_name, _, _ in batch],
+                embeddings=[parse_embedding(embedding) for _, _, embedding in batch],
+                driver=driver,
+                limit=limit,
+                name_vec_index=name_vec_index,
+                centoid_vec_index=centoid_vec_index,
+                vector_engines=vector_engines,
+                workers=workers,
+                exact_match_index=exact_match_index,
+                fulltext_engine=fulltext_engine,
+                cache=cache,
+                fusion=fusion,
+                fusion_params=fusion_params
             )
 
-        for item in search_results:
-            item['True MESH_ID'] = true_mesh_id
-            item['True Description'] = disease_name
-        
-        predicted_values.append(search_results if len(search_results) > 0 else [{
-            "MESH_ID": "Unknown", 
-            "AltDiseaseIDs": "Unknown", 
-            "Description": "Unknown",
-            "True MESH_ID": true_mesh_id,
-            "True Description": disease_name
-            }]
-        )
+            for (disease_name, true_mesh_id, _), search_results in zip(batch, batch_results):
+                predicted_values.append(label_search_results(search_results, true_mesh_id, disease_name))
+
+        return predicted_values
+
+    # One retriever thread each for the fulltext and the two vector indexes
+    own_executor = ThreadPoolExecutor(max_workers=3) if executor is None and workers > 1 else None
+
+    try:
+        for _, row in dataset.iterrows():
+            disease_name = row['Description']
+            true_mesh_id = row['MESH ID']
+            embedding = row[embedding_col]
+
+            search_results = combined_search(
+                disease_name=disease_name,
+                embedding=parse_embedding(embedding),
+                driver=driver,
+                limit=limit,
+                name_vec_index=name_vec_index,
+                centoid_vec_index=centoid_vec_index,
+                vector_engines=vector_engines,
+                executor=executor if executor is not None else own_executor,
+                workers=workers,
+                exact_match_index=exact_match_index,
+                fulltext_engine=fulltext_engine,
+                cache=cache,
+                cascade=cascade,
+                fusion=fusion,
+                fusion_params=fusion_params
+                )
+
+            for item in search_results:
+                item['True MESH_ID'] = true_mesh_id
+                item['True Description'] = disease_name
+
+            predicted_values.append(search_results if len(search_results) > 0 else [{
+                "MESH_ID": "Unknown", 
+                "AltDiseaseIDs": "Unknown", 
+                "Description": "Unknown",
+                "True MESH_ID": true_mesh_id,
+                "True Description": disease_name
+                }]
+            )
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
 
     return predicted_values
\ No newline at end of file
@@ -1,6 +1,15 @@
 import json
+import os
+import time
+from typing import List, Optional
 from neo4j import Driver
 import numpy as np
+from tqdm import tqdm
+
+from utils.disease_aliases import disease_id_constraint_query
+from utils.embedding_store import EmbeddingMatrix
+from utils.generic import Models
+from utils.index_search_helpers import get_embedding_col_name, parse_embedding
 
 ###########
 # QUERIES #
@@ -19,6 +28,38 @@ batch_retrieve_query = """
     SKIP $skip LIMIT $limit
 """
 
+keyset_batch_retrieve_query = """
+    MATCH (d:Disease)
+    WHERE d.DiseaseID > $last_id
+    RETURN d.DiseaseID AS DiseaseID,
+        d[$synonym_embeddings_prop] AS SynonymsEmbedding,
+        d[$disease_embedding_prop] AS DiseaseEmbedding
+    ORDER BY d.DiseaseID
+    LIMIT $limit
+"""
+
+keyset_disease_embedding_retrieve_query = """
+    MATCH (d:Disease)
+    WHERE d.DiseaseID > $last_id
+    RETURN d.DiseaseID AS DiseaseID,
+        d[$disease_embedding_prop] AS DiseaseEmbedding
+    ORDER BY d.DiseaseID
+    LIMIT $limit
+"""
+
+batch_node_prop_update_query = """
+    UNWIND $batch AS row
+    MATCH (d:Disease {DiseaseID: row.disease_id})
+    CALL apoc.create.setProperty(d, $embedding_prop, row.embedding)
+    YIELD node
+    RETURN count(node) AS updated
+"""
+
+disease_count_query = """
+    MATCH (d:Disease)
+    RETURN count(d) AS total
+"""
+
 ###########
 # HELPERS #
 ###########
@@ -67,4 +108,149 @@ def batch_update_synonym_centorid_embeddings(driver: Driver, embedding_model_nam
                 session.run(node_prop_update_query, disease_id=disease_id, embedding_prop=embedding_prop, embedding=embedding)
 
             # Increment the skip value to move to the next batch
-            skip += batch_size
\ No newline at end of file
+            skip += batch_size
+
+def calculate_centroids(vectors_per_node: List[np.ndarray]) -> np.ndarray:
+    """
+    Calculates the centroid of every non-empty group of vectors in one pass over the ragged batch.
+
+    Parameters:
+        vectors_per_node (list): A list of 2D arrays, one (n_i, dim) array per node with n_i > 0.
+
+    Returns:
+        np.ndarray: A (len(vectors_per_node), dim) array of centroids.
+    """
+    lengths = np.array([len(vectors) for vectors in vectors_per_node])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    flat = np.concatenate(vectors_per_node).astype(np.float64)
+
+    return np.add.reduceat(flat, offsets, axis=0) / lengths[:, None]
+
+def load_checkpoint(checkpoint_path: Optional[str], embedding_prop: str) -> dict:
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+        if checkpoint.get('embedding_prop') == embedding_prop:
+            return checkpoint
+
+    return {'embedding_prop': embedding_prop, 'last_id': '', 'processed': 0}
+
+def save_checkpoint(checkpoint_path: Optional[str], checkpoint: dict):
+    if checkpoint_path is None:
+        return
+
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+def check_synonym_embeddings(synonym_embeddings: EmbeddingMatrix):
+    if not synonym_embeddings.ragged:
+        raise ValueError('synonym_embeddings must be a ragged matrix (one row per synonym), got one row per ID')
+
+    offsets = synonym_embeddings.offsets
+    if len(offsets) != len(synonym_embeddings) + 1:
+        raise ValueError(f'synonym_embeddings has {len(offsets)} offsets for {len(synonym_embeddings)} disease IDs, expected {len(synonym_embeddings) + 1}')
+
+    if offsets[-1] != len(synonym_embeddings.matrix):
+        raise ValueError(f'synonym_embeddings offsets end at row {offsets[-1]} but the matrix has {len(synonym_embeddings.matrix)} rows')
+
+def rebuild_synonym_centroid_embeddings(
+        driver: Driver,
+        model: Models,
+        batch_size=1000,
+        checkpoint_path: Optional[str] = None,
+        synonym_embeddings: Optional[EmbeddingMatrix] = None
+        ) -> dict:
+    """
+    Rebuilds the synonym centroid embeddings of all Disease nodes for the given model.
+
+    Nodes are paged by DiseaseID (keyset pagination, backed by the DiseaseID uniqueness constraint which is
+    created if missing), only the embedding properties are fetched,
+    the centroids of a batch are computed in one NumPy call and written back with a single UNWIND.
+    Progress is saved to `checkpoint_path` after every batch so an interrupted run resumes where it stopped.
+
+    Parameters:
+        driver (Driver): The Neo4j driver.
+        model (Models): The embedding model whose centroids are rebuilt.
+        batch_size (int): The number of nodes read and written per round trip.
+        checkpoint_path (str): Optional path of the JSON checkpoint file, removed once the run completes.
+        synonym_embeddings (EmbeddingMatrix): Optional stored synonym embeddings (see utils.embedding_store)
+            used instead of decoding the JSON node property. Must be ragged and aligned with its disease IDs,
+            a ValueError is raised otherwise.
+
+    Returns:
+        dict: The number of processed nodes, the elapsed seconds and the throughput in nodes per second.
+    """
+    embedding_prop = get_embedding_col_name(model, 'SynonymsCentroidEmbedding')
+    synonym_embeddings_prop = get_embedding_col_name(model, 'SynonymsEmbedding')
+    disease_embedding_prop = get_embedding_col_name(model, 'DiseaseEmbedding')
+
+    if synonym_embeddings is not None:
+        check_synonym_embeddings(synonym_embeddings)
+
+    checkpoint = load_checkpoint(checkpoint_path, embedding_prop)
+    start_time = time.perf_counter()
+    processed_in_run = 0
+
+    with driver.session() as session:
+        # Without the index every keyset page is a full label scan plus a sort
+        session.run(disease_id_constraint_query).consume()
+        total = session.run(disease_count_query).single()['total']
+
+        with tqdm(total=total, initial=checkpoint['processed'], desc='Rebuilding centroids', unit='nodes') as progress:
+            while True:
+                # Skip transferring the JSON property when the stored matrix is used instead
+                records = list(session.run(
+                    keyset_batch_retrieve_query if synonym_embeddings is None else keyset_disease_embedding_retrieve_query,
+                    last_id=checkpoint['last_id'],
+                    limit=batch_size,
+                    synonym_embeddings_prop=synonym_embeddings_prop,
+                    disease_embedding_prop=disease_embedding_prop
+                ))
+
+                if not records:
+                    break
+
+                disease_ids = [record['DiseaseID'] for record in records]
+                embeddings = [record['DiseaseEmbedding'] for record in records]
+
+                if synonym_embeddings is None:
+                    vectors_per_node = [np.asarray(parse_embedding(record['SynonymsEmbedding'] or '[]')) for record in records]
+                else:
+                    vectors_per_node = [
+                        synonym_embeddings.get(disease_id) if disease_id in synonym_embeddings else np.empty((0,))
+                        for disease_id in disease_ids
+                    ]
+
+                with_synonyms = [i for i, vectors in enumerate(vectors_per_node) if len(vectors) > 0]
+
+                if with_synonyms:
+                    centroids = calculate_centroids([vectors_per_node[i] for i in with_synonyms])
+                    for i, centroid in zip(with_synonyms, centroids):
+                        embeddings[i] = centroid.tolist()
+
+                # If no synonym embeddings, the disease embedding is used as is
+                batch = [
+                    {'disease_id': disease_id, 'embedding': embedding}
+                    for disease_id, embedding in zip(disease_ids, embeddings) if embedding is not None
+                ]
+                session.run(batch_node_prop_update_query, batch=batch, embedding_prop=embedding_prop).consume()
+
+                checkpoint['last_id'] = disease_ids[-1]
+                checkpoint['processed'] += len(records)
+                processed_in_run += len(records)
+                save_checkpoint(checkpoint_path, checkpoint)
+                progress.update(len(records))
+
+    elapsed = time.perf_counter() - start_time
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return {
+        'processed': checkpoint['processed'],
+        'elapsed_seconds': elapsed,
+        'nodes_per_second': processed_in_run / elapsed if elapsed > 0 else 0.0
+    }
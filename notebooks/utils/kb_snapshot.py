@@ -0,0 +1,405 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+from collections.abc import Sequence
+from functools import cached_property
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+from utils.disease_aliases import DiseaseAliases, split_ids
+from utils.exact_match_index import ExactMatchIndex
+from utils.fulltext_engine import BM25Postings, FulltextEngine, char_ngrams, tokenize
+from utils.generic import Vectors
+from utils.hierarchy_graph import HierarchyGraph
+from utils.vector_engine import VectorEngine, embedding_retrieve_query, get_vector_index_property, normalize_rows
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from neo4j import Driver
+    from utils.candidate_batch import KBTable
+
+
+###########
+# QUERIES #
+###########
+
+snapshot_records_retrieve_query = """
+    MATCH (d:Disease)
+    OPTIONAL MATCH (d)-[:SUB_CATEGORY_OF]->(p:Disease)
+    RETURN d.DiseaseID AS MESH_ID,
+        d.DiseaseName AS Description,
+        d.Synonyms AS Synonyms,
+        d.AltDiseaseIDs AS AltDiseaseIDs,
+        collect(p.DiseaseID) AS ParentIDs
+"""
+
+#############
+# CONSTANTS #
+#############
+
+snapshot_format = 1
+
+manifest_file = 'manifest.json'
+
+# Candidate record key -> string column file
+record_columns = {
+    'MESH_ID': 'mesh_ids',
+    'Description': 'descriptions',
+    'Synonyms': 'synonyms',
+    'AltDiseaseIDs': 'alt_disease_ids'
+}
+
+###########
+# HELPERS #
+###########
+
+def is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class StringColumn(Sequence):
+    """
+    Strings stored as one UTF-8 blob plus an offsets array, so a memory-mapped column costs nothing
+    until a string is read. Missing values (None or NaN) are flagged in an optional `nulls` array
+    and read back as None.
+
+    With `rows` set, the column is a view of the rows at those positions.
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray, nulls: Optional[np.ndarray] = None, rows: Optional[np.ndarray] = None):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+        self.rows = rows
+
+    @staticmethod
+    def write(path: str, values: Iterable):
+        blobs, nulls = [], []
+        for value in values:
+            nulls.append(is_missing(value))
+            blobs.append(b'' if nulls[-1] else str(value).encode('utf-8'))
+
+        np.save(path + '.offsets.npy', np.concatenate([[0], np.cumsum([len(blob) for blob in blobs], dtype=np.int64)]).astype(np.int64))
+        np.save(path + '.data.npy', np.frombuffer(b''.join(blobs), dtype=np.uint8))
+
+        if any(nulls):
+            np.save(path + '.nulls.npy', np.array(nulls, dtype=bool))
+
+    @classmethod
+    def load(cls, path: str, mmap_mode='r') -> 'StringColumn':
+        nulls_path = path + '.nulls.npy'
+        data = np.load(path + '.data.npy', mmap_mode=mmap_mode)
+
+        return cls(
+            # An empty blob can not be memory-mapped
+            data if data.size > 0 else np.empty(0, dtype=np.uint8),
+            np.load(path + '.offsets.npy', mmap_mode=mmap_mode),
+            np.load(nulls_path, mmap_mode=mmap_mode) if os.path.exists(nulls_path) else None
+        )
+
+    def take(self, rows: np.ndarray) -> 'StringColumn':
+        return StringColumn(self.data, self.offsets, self.nulls, self.rows[rows] if self.rows is not None else np.asarray(rows))
+
+    def __len__(self) -> int:
+        return len(self.rows) if self.rows is not None else len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if self.rows is not None:
+            i = int(self.rows[i])
+
+        if self.nulls is not None and self.nulls[i]:
+            return None
+
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        # Copying the blob once and slicing the bytes is much faster than reading string by string
+        blob = bytes(self.data)
+        offsets = np.asarray(self.offsets).tolist()
+        nulls = np.asarray(self.nulls).tolist() if self.nulls is not None else None
+        rows = np.asarray(self.rows).tolist() if self.rows is not None else range(len(offsets) - 1)
+
+        for i in rows:
+            yield None if nulls is not None and nulls[i] else blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+
+
+class SnapshotRecords(Sequence):
+    """
+    The snapshot diseases as candidate records (MESH_ID, Description, Synonyms, AltDiseaseIDs), built on access.
+    """
+
+    def __init__(self, columns: Dict[str, StringColumn]):
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns['MESH_ID'])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        return {key: column[i] for key, column in self.columns.items()}
+
+    def __iter__(self):
+        keys = list(self.columns.keys())
+
+        for values in zip(*self.columns.values()):
+            yield dict(zip(keys, values))
+
+def write_postings(path: str, postings: BM25Postings):
+    terms, indptr, doc_ids, weights = postings.to_arrays()
+
+    StringColumn.write(path + '.terms', terms)
+    np.save(path + '.indptr.npy', indptr)
+    np.save(path + '.doc_ids.npy', doc_ids.astype(np.int32))
+    np.save(path + '.weights.npy', weights.astype(np.float32))
+
+def load_postings(path: str, num_docs: int, mmap_mode='r') -> BM25Postings:
+    return BM25Postings.from_arrays(
+        num_docs,
+        StringColumn.load(path + '.terms', mmap_mode),
+        np.load(path + '.indptr.npy', mmap_mode=mmap_mode),
+        np.load(path + '.doc_ids.npy', mmap_mode=mmap_mode),
+        np.load(path + '.weights.npy', mmap_mode=mmap_mode)
+    )
+
+
+class KBSnapshot:
+    """
+    Self-contained, memory-mappable export of the knowledge base, so a linker can start without a database:
+
+    - the candidate record fields as offset-indexed string blobs (`StringColumn`), in one row order
+      shared by every other file,
+    - the parents of every disease as CSR arrays (`HierarchyGraph.from_parent_csr`),
+    - the BM25 postings of the fulltext engine (words and, optionally, character n-grams),
+    - one normalised embedding matrix per vector index, with the record row of each matrix row.
+
+    Everything is written into a new directory with a manifest holding the snapshot `version`;
+    an existing snapshot is never overwritten. Loading only reads the manifest and maps the files,
+    the engines are built on first use.
+
+    Parameters:
+        path (str): The snapshot directory.
+        mmap_mode (str): Passed to `np.load`, None to read the arrays into memory instead.
+    """
+
+    def __init__(self, path: str, mmap_mode='r'):
+        with open(os.path.join(path, manifest_file)) as f:
+            self.manifest = json.load(f)
+
+        if self.manifest['format'] != snapshot_format:
+            raise ValueError(f"{path} is a format {self.manifest['format']} snapshot, expected format {snapshot_format}")
+
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.version = self.manifest['version']
+        self.columns = {key: StringColumn.load(self._path(name), mmap_mode) for key, name in record_columns.items()}
+        self.records = SnapshotRecords(self.columns)
+        self.parents_indptr = np.load(self._path('parents.indptr.npy'), mmap_mode=mmap_mode)
+        self.parents = np.load(self._path('parents.npy'), mmap_mode=mmap_mode)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def write(
+            path: str,
+            records: List[dict],
+            parent_ids: List[List[str]],
+            embeddings: Optional[Dict[str, Tuple[List[str], np.ndarray]]] = None,
+            version='',
+            ngram_size: Optional[int] = None,
+            dtype=np.float32,
+            block_size=4096
+            ):
+        """
+        Writes a snapshot to the new directory `path`.
+
+        Parameters:
+            records (list): The candidate records of all diseases.
+            parent_ids (list): The parent disease IDs of every record.
+            embeddings (dict): Vector index name -> (disease IDs, embedding matrix), e.g. the `ids` and `matrix`
+                of an `EmbeddingStore` property. Rows of unknown diseases are skipped.
+            version (str): The KB version recorded in the manifest, e.g. the CTD release.
+            ngram_size (int): Also store character n-gram postings for the fulltext engine.
+            dtype: The dtype of the stored embedding matrices.
+        """
+        if os.path.exists(path):
+            raise FileExistsError(f'{path} already exists, snapshots are written once per version')
+
+        # Written next to the final location and renamed, so a snapshot directory is always complete
+        temporary_path = f'{path}.tmp-{os.getpid()}'
+        os.makedirs(temporary_path)
+
+        try:
+            for key, name in record_columns.items():
+                StringColumn.write(os.path.join(temporary_path, name), [record[key] for record in records])
+
+            row_index = {record['MESH_ID']: i for i, record in enumerate(records)}
+            parents = [[row_index[parent_id] for parent_id in ids if parent_id in row_index] for ids in parent_ids]
+            np.save(os.path.join(temporary_path, 'parents.indptr.npy'), np.concatenate([[0], np.cumsum([len(ids) for ids in parents], dtype=np.int64)]).astype(np.int64))
+            np.save(os.path.join(temporary_path, 'parents.npy'), np.array([row for ids in parents for row in ids], dtype=np.int32))
+
+            documents = [tokenize(FulltextEngine.get_record_text(record)) for record in records]
+            write_postings(os.path.join(temporary_path, 'fulltext.words'), BM25Postings(documents))
+            if ngram_size:
+                write_postings(os.path.join(temporary_path, 'fulltext.ngrams'), BM25Postings([char_ngrams(tokens, ngram_size) for tokens in documents]))
+
+            indexes = {}
+            for index, (ids, matrix) in (embeddings or {}).items():
+                known = [i for i, id in enumerate(ids) if id in row_index]
+                name = f'embeddings.{get_vector_index_property(index)}'
+
+                stored = np.lib.format.open_memmap(os.path.join(temporary_path, name + '.npy'), mode='w+', dtype=dtype, shape=(len(known), matrix.shape[1]))
+                for start in range(0, len(known), block_size):
+                    rows = known[start:start + block_size]
+                    stored[start:start + len(rows)] = normalize_rows(np.asarray(matrix[rows], dtype=np.float32))
+                stored.flush()
+                del stored
+
+                np.save(os.path.join(temporary_path, name + '.rows.npy'), np.array([row_index[ids[i]] for i in known], dtype=np.int32))
+                indexes[index] = name
+
+            with open(os.path.join(temporary_path, manifest_file), 'w') as f:
+                json.dump({
+                    'format': snapshot_format,
+                    'version': version,
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                    'diseases': len(records),
+                    'ngram_size': ngram_size,
+                    'embeddings': indexes
+                }, f, indent=2)
+
+            os.replace(temporary_path, path)
+        except BaseException:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            raise
+
+    @classmethod
+    def export_from_driver(
+            cls,
+            driver: 'Driver',
+            path: str,
+            indexes: Iterable[str] = (Vectors.BAAI_DISEASE_NAME.value, Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value),
+            **kwargs
+            ) -> 'KBSnapshot':
+        from utils.index_search_helpers import parse_embedding
+
+        with driver.session() as session:
+            records = [record.data() for record in session.run(snapshot_records_retrieve_query)]
+
+            embeddings = {}
+            for index in indexes:
+                result = list(session.run(embedding_retrieve_query, embedding_prop=get_vector_index_property(index)))
+                embeddings[index] = (
+                    [record['MESH_ID'] for record in result],
+                    np.array([parse_embedding(record['embedding']) for record in result], dtype=np.float32)
+                )
+
+        cls.write(path, records, [record.pop('ParentIDs') for record in records], embeddings, **kwargs)
+
+        return cls(path)
+
+    @classmethod
+    def export_from_ctd_dataframe(
+            cls,
+            diseases: 'pd.DataFrame',
+            path: str,
+            embeddings: Optional[Dict[str, Tuple[List[str], np.ndarray]]] = None,
+            **kwargs
+            ) -> 'KBSnapshot':
+        from utils.exact_match_index import get_ctd_records
+
+        cls.write(path, list(get_ctd_records(diseases)), [split_ids(parent_ids) for parent_ids in diseases['ParentIDs']], embeddings, **kwargs)
+
+        return cls(path)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def nbytes(self) -> int:
+        """
+        The size of the snapshot files, i.e. the most it can take in the page cache.
+        """
+        return sum(entry.stat().st_size for entry in os.scandir(self.path))
+
+    @cached_property
+    def aliases(self) -> DiseaseAliases:
+        return DiseaseAliases(zip(self.columns['MESH_ID'], self.columns['AltDiseaseIDs']))
+
+    @cached_property
+    def hierarchy(self) -> HierarchyGraph:
+        return HierarchyGraph.from_parent_csr(self.aliases, self.parents_indptr, self.parents)
+
+    @cached_property
+    def exact_match_index(self) -> ExactMatchIndex:
+        return ExactMatchIndex(self.records)
+
+    @cached_property
+    def fulltext_engine(self) -> FulltextEngine:
+        ngram_size = self.manifest['ngram_size']
+
+        return FulltextEngine.from_postings(
+            self.records,
+            load_postings(self._path('fulltext.words'), len(self), self.mmap_mode),
+            load_postings(self._path('fulltext.ngrams'), len(self), self.mmap_mode) if ngram_size else None,
+            ngram_size
+        )
+
+    @cached_property
+    def vector_engines(self) -> Dict[str, VectorEngine]:
+        engines = {}
+
+        for index, name in self.manifest['embeddings'].items():
+            rows = np.load(self._path(name + '.rows.npy'))
+            engines[index] = VectorEngine(
+                np.load(self._path(name + '.npy'), mmap_mode=self.mmap_mode),
+                *[self.columns[key].take(rows) for key in record_columns],
+                normalized=True
+            )
+
+        return engines
+
+    def get_kb_table(self) -> 'KBTable':
+        from utils.candidate_batch import KBTable
+
+        return KBTable(self.records)
+
+    def search_kwargs(self, exact_match=True) -> dict:
+        """
+        The engines to pass to `combined_search`/`combined_search_batch` to link against the snapshot,
+        with any driver (the driver is not queried when all of them are given).
+        """
+        search_kwargs = {'fulltext_engine': self.fulltext_engine, 'vector_engines': self.vector_engines}
+        if exact_match:
+            search_kwargs['exact_match_index'] = self.exact_match_index
+
+        return search_kwargs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the knowledge base into a memory-mappable snapshot.')
+    parser.add_argument('path', help='The new snapshot directory')
+    parser.add_argument('--version', default='')
+    parser.add_argument('--ngram-size', type=int, default=None)
+    parser.add_argument('--indexes', nargs='+', default=[Vectors.BAAI_DISEASE_NAME.value, Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value])
+    args = parser.parse_args()
+
+    from utils.generic import get_driver
+
+    driver = get_driver()
+    try:
+        snapshot = KBSnapshot.export_from_driver(driver, args.path, args.indexes, version=args.version, ngram_size=args.ngram_size)
+    finally:
+        driver.close()
+
+    print(f'{len(snapshot)} diseases, {snapshot.nbytes() / 1e6:.1f} MB in {args.path}')
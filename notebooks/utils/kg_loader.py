@@ -0,0 +1,263 @@
+import csv
+import os
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import pandas as pd
+from neo4j import Driver
+from tqdm import tqdm
+
+from utils.disease_aliases import disease_id_constraint_query, split_ids
+from utils.exact_match_index import ExactMatchIndex
+from utils.generic import Models
+from utils.index_search_helpers import batch_list, get_embedding_col_name
+
+
+###########
+# QUERIES #
+###########
+
+batch_node_merge_query = """
+    UNWIND $batch AS row
+    MERGE (d:Disease {DiseaseID: row.DiseaseID})
+    SET d += row.properties
+"""
+
+batch_hierarchy_merge_query = """
+    UNWIND $batch AS row
+    MATCH (d:Disease {DiseaseID: row.DiseaseID})
+    MATCH (p:Disease {DiseaseID: row.ParentID})
+    MERGE (d)-[:SUB_CATEGORY_OF]->(p)
+"""
+
+batch_hierarchy_delete_query = """
+    UNWIND $batch AS row
+    MATCH (:Disease {DiseaseID: row.DiseaseID})-[r:SUB_CATEGORY_OF]->(:Disease {DiseaseID: row.ParentID})
+    DELETE r
+"""
+
+batch_node_delete_query = """
+    UNWIND $batch AS disease_id
+    MATCH (d:Disease {DiseaseID: disease_id})
+    DETACH DELETE d
+"""
+
+batch_embedding_remove_query = """
+    UNWIND $batch AS disease_id
+    MATCH (d:Disease {DiseaseID: disease_id})
+    CALL apoc.create.removeProperties(d, $embedding_props)
+    YIELD node
+    RETURN count(node) AS updated
+"""
+
+current_graph_retrieve_query = """
+    MATCH (d:Disease)
+    OPTIONAL MATCH (d)-[:SUB_CATEGORY_OF]->(p:Disease)
+    RETURN d.DiseaseID AS DiseaseID,
+        d.DiseaseName AS DiseaseName,
+        d.AltDiseaseIDs AS AltDiseaseIDs,
+        d.Definition AS Definition,
+        d.TreeNumbers AS TreeNumbers,
+        d.ParentTreeNumbers AS ParentTreeNumbers,
+        d.Synonyms AS Synonyms,
+        d.SlimMappings AS SlimMappings,
+        collect(p.DiseaseID) AS ParentIDs
+"""
+
+#############
+# CONSTANTS #
+#############
+
+disease_properties = [
+    'DiseaseName', 'AltDiseaseIDs', 'Definition', 'TreeNumbers', 'ParentTreeNumbers', 'Synonyms', 'SlimMappings'
+]
+
+# Properties the embeddings are computed from
+embedded_properties = ['DiseaseName', 'Synonyms']
+
+###########
+# HELPERS #
+###########
+
+def read_ctd_chunks(path: str, chunk_size=5000) -> Iterator[pd.DataFrame]:
+    for chunk in pd.read_csv(path, sep=',', chunksize=chunk_size, dtype=str):
+        # Neo4j parameters can't hold NaN, missing values are stored as absent properties
+        yield chunk.astype(object).where(chunk.notna(), None)
+
+def get_node_rows(chunk: pd.DataFrame) -> List[dict]:
+    return [
+        {'DiseaseID': row['DiseaseID'], 'properties': {prop: row[prop] for prop in disease_properties}}
+        for row in chunk.to_dict('records')
+    ]
+
+def get_candidate_records(node_rows: List[dict]) -> List[dict]:
+    # Node rows in the shape of the candidate records returned by the index queries
+    return [
+        {
+            'MESH_ID': row['DiseaseID'],
+            'Description': row['properties']['DiseaseName'],
+            'Synonyms': row['properties']['Synonyms'],
+            'AltDiseaseIDs': row['properties']['AltDiseaseIDs']
+        }
+        for row in node_rows
+    ]
+
+def get_edge_rows(chunk: pd.DataFrame) -> List[dict]:
+    return [
+        {'DiseaseID': disease_id, 'ParentID': parent_id}
+        for disease_id, parent_ids in zip(chunk['DiseaseID'], chunk['ParentIDs'])
+        for parent_id in split_ids(parent_ids)
+    ]
+
+def load_ctd_diseases(driver: Driver, path: str, chunk_size=5000, batch_size=1000):
+    """
+    Loads CTD_diseases.csv into the graph, streaming the file in chunks and writing the Disease nodes
+    and then the SUB_CATEGORY_OF edges with batched UNWIND statements.
+
+    Parameters:
+        driver (Driver): The Neo4j driver.
+        path (str): The path of CTD_diseases.csv.
+        chunk_size (int): The number of CSV rows held in memory at once.
+        batch_size (int): The number of nodes or edges written per statement.
+    """
+    with driver.session() as session:
+        session.run(disease_id_constraint_query).consume()
+
+        # Nodes first, so every parent exists when the edges are merged
+        for query, get_rows, desc in [
+            (batch_node_merge_query, get_node_rows, 'Loading diseases'),
+            (batch_hierarchy_merge_query, get_edge_rows, 'Loading hierarchy')
+        ]:
+            for chunk in tqdm(read_ctd_chunks(path, chunk_size), desc=desc, unit='chunks'):
+                for batch in batch_list(get_rows(chunk), batch_size):
+                    session.execute_write(lambda tx: tx.run(query, batch=batch).consume())
+
+def write_admin_import_csvs(path: str, output_dir: str, chunk_size=5000) -> Tuple[str, str]:
+    """
+    Writes the node and relationship CSV files for a cold load with `neo4j-admin database import`:
+
+        neo4j-admin database import full --nodes=Disease=diseases.csv --relationships=SUB_CATEGORY_OF=hierarchy.csv
+
+    Returns:
+        tuple: The paths of the nodes and the relationships files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    nodes_path = os.path.join(output_dir, 'diseases.csv')
+    edges_path = os.path.join(output_dir, 'hierarchy.csv')
+
+    disease_ids = set(pd.read_csv(path, sep=',', usecols=['DiseaseID'], dtype=str)['DiseaseID'])
+
+    with open(nodes_path, 'w', newline='') as nodes_file, open(edges_path, 'w', newline='') as edges_file:
+        nodes_writer = csv.writer(nodes_file)
+        edges_writer = csv.writer(edges_file)
+        nodes_writer.writerow(['DiseaseID:ID(Disease)'] + disease_properties)
+        edges_writer.writerow([':START_ID(Disease)', ':END_ID(Disease)'])
+
+        for chunk in read_ctd_chunks(path, chunk_size):
+            for row in chunk.to_dict('records'):
+                nodes_writer.writerow([row['DiseaseID']] + [row[prop] for prop in disease_properties])
+
+            # Like the MATCH/MATCH/MERGE load, edges to unknown parents are skipped
+            for edge in get_edge_rows(chunk):
+                if edge['ParentID'] in disease_ids:
+                    edges_writer.writerow([edge['DiseaseID'], edge['ParentID']])
+
+    return nodes_path, edges_path
+
+def get_edge_param_rows(edges: List[Tuple[str, str]]) -> List[dict]:
+    return [{'DiseaseID': disease_id, 'ParentID': parent_id} for disease_id, parent_id in edges]
+
+def get_current_graph(driver: Driver) -> Tuple[Dict[str, dict], Set[Tuple[str, str]]]:
+    nodes, edges = {}, set()
+
+    with driver.session() as session:
+        for record in session.run(current_graph_retrieve_query):
+            # Graphs loaded row by row from pandas may hold NaN where the CSV had no value
+            nodes[record['DiseaseID']] = {
+                prop: None if isinstance(record[prop], float) and pd.isna(record[prop]) else record[prop]
+                for prop in disease_properties
+            }
+            edges.update((record['DiseaseID'], parent_id) for parent_id in record['ParentIDs'])
+
+    return nodes, edges
+
+def diff_ctd_release(
+        current_nodes: Dict[str, dict],
+        current_edges: Set[Tuple[str, str]],
+        path: str,
+        chunk_size=5000
+        ) -> dict:
+    """
+    Compares a CTD release with the current graph.
+
+    Returns:
+        dict: The rows of the new and changed nodes ('upserted_nodes'), the IDs of the removed nodes,
+        the added and removed edges, and the IDs whose name or synonyms changed ('reembed_ids').
+    """
+    upserted_nodes, reembed_ids, new_ids, new_edges = [], [], set(), set()
+
+    for chunk in read_ctd_chunks(path, chunk_size):
+        for row in get_node_rows(chunk):
+            disease_id = row['DiseaseID']
+            new_ids.add(disease_id)
+            current = current_nodes.get(disease_id)
+
+            if current != row['properties']:
+                upserted_nodes.append(row)
+
+                if current is None or any(current[prop] != row['properties'][prop] for prop in embedded_properties):
+                    reembed_ids.append(disease_id)
+
+        new_edges.update((edge['DiseaseID'], edge['ParentID']) for edge in get_edge_rows(chunk))
+
+    new_edges = {edge for edge in new_edges if edge[1] in new_ids}
+
+    return {
+        'upserted_nodes': upserted_nodes,
+        'removed_ids': sorted(set(current_nodes) - new_ids),
+        'added_edges': sorted(new_edges - current_edges),
+        'removed_edges': sorted(current_edges - new_edges),
+        'reembed_ids': reembed_ids
+    }
+
+def update_ctd_diseases(
+        driver: Driver,
+        path: str,
+        models: Optional[List[Models]] = None,
+        chunk_size=5000,
+        batch_size=1000,
+        exact_match_index: Optional[ExactMatchIndex] = None
+        ) -> dict:
+    """
+    Incrementally applies a new CTD release: only new, changed and removed nodes and edges are written.
+
+    Embedding properties of the given models are removed from nodes whose name or synonyms changed,
+    so they can be recomputed with `run_embedding_pipeline(..., disease_ids=diff['reembed_ids'])`.
+    An `exact_match_index` built before the update is updated in place; other in-process copies of
+    the knowledge base (vector and fulltext engines, KB snapshots) have to be rebuilt.
+
+    Returns:
+        dict: The diff that was applied, see `diff_ctd_release`.
+    """
+    current_nodes, current_edges = get_current_graph(driver)
+    diff = diff_ctd_release(current_nodes, current_edges, path, chunk_size)
+
+    embedding_props = [
+        get_embedding_col_name(model, prop)
+        for model in (models or [])
+        for prop in ['DiseaseEmbedding', 'SynonymsEmbedding', 'SynonymsCentroidEmbedding']
+    ]
+
+    with driver.session() as session:
+        for query, rows, params in [
+            (batch_hierarchy_delete_query, get_edge_param_rows(diff['removed_edges']), {}),
+            (batch_node_delete_query, diff['removed_ids'], {}),
+            (batch_node_merge_query, diff['upserted_nodes'], {}),
+            (batch_hierarchy_merge_query, get_edge_param_rows(diff['added_edges']), {}),
+            (batch_embedding_remove_query, diff['reembed_ids'] if embedding_props else [], {'embedding_props': embedding_props})
+        ]:
+            for batch in batch_list(rows, batch_size):
+                session.execute_write(lambda tx: tx.run(query, batch=batch, **params).consume())
+
+    if exact_match_index is not None:
+        exact_match_index.update(get_candidate_records(diff['upserted_nodes']), diff['removed_ids'])
+
+    return diff
@@ -0,0 +1,472 @@
+import argparse
+import asyncio
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional
+import numpy as np
+from aiohttp import ClientSession, web
+
+from utils.disease_context import DiseaseContext
+from utils.generic import Models
+from utils.index_search_helpers import combined_search_batch
+
+
+#############
+# CONSTANTS #
+#############
+
+ollama_url = "http://localhost:11434/api/generate"
+
+###########
+# HELPERS #
+###########
+
+class Overloaded(Exception):
+    pass
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent `submit` calls into batches of at most `max_batch_size` items, waiting at most
+    `max_wait_ms` after the first item of a batch for more to arrive.
+
+    At most `max_pending` items may wait or run at a time; beyond that `submit` raises `Overloaded`
+    right away, so callers can shed load instead of queueing without bound. A single submission of more
+    than `max_pending` items can never be admitted and raises `RequestTooLarge`.
+
+    Up to `max_concurrent_batches` batches are processed at once; while all of them are busy the next
+    batch keeps filling up in the queue.
+    """
+
+    def __init__(
+            self,
+            process_batch: Callable[[list], Awaitable[list]],
+            max_batch_size=32,
+            max_wait_ms=5.0,
+            max_pending=1024,
+            max_concurrent_batches=1
+            ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_pending = max_pending
+        self.max_concurrent_batches = max_concurrent_batches
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.batch_slots: Optional[asyncio.Semaphore] = None
+        self.batch_tasks = set()
+        self.pending = 0
+        self.stats = {'items': 0, 'batches': 0, 'rejected': 0, 'max_batch_size': 0}
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            for task in self.batch_tasks:
+                task.cancel()
+            await asyncio.gather(self.worker, *self.batch_tasks, return_exceptions=True)
+            self.worker = None
+
+    async def submit(self, items: list) -> list:
+        """
+        Queues all `items` and returns their results in order. The items are admitted together or
+        not at all, so a rejected request leaves no work behind in the queue.
+        """
+        if len(items) > self.max_pending:
+            self.stats['rejected'] += len(items)
+            raise RequestTooLarge()
+
+        if self.pending + len(items) > self.max_pending:
+            self.stats['rejected'] += len(items)
+            raise Overloaded()
+
+        self.pending += len(items)
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in items]
+
+        for item, future in zip(items, futures):
+            self.queue.put_nowait((item, future))
+
+        try:
+            return await asyncio.gather(*futures)
+        finally:
+            self.pending -= len(items)
+
+    async def _collect(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            # A batch is only collected once a slot is free, so waiting items keep joining it meanwhile
+            await self.batch_slots.acquire()
+
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self.batch_slots.release()
+                raise
+
+            task = asyncio.create_task(self._process(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def _process(self, batch: list):
+        items = [item for item, _ in batch]
+
+        self.stats['items'] += len(items)
+        self.stats['batches'] += 1
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(items))
+
+        try:
+            results = await self.process_batch(items)
+        except Exception as error:
+            results = [error] * len(items)
+        finally:
+            self.batch_slots.release()
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+def to_json_value(value):
+    # Neo4j and pandas return NaN for missing synonyms, which is not valid JSON
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        return to_json_value(value.item())
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_json_value(item) for item in value]
+
+    return value
+
+def build_prompt(disease_name: str, entities: List[dict]) -> str:
+    """
+    The RAG prompt of augumented_search_results.ipynb, built from already retrieved entities.
+    """
+    prompt = f"""Act as a medical expert. Return the retrieved information on a given {disease_name}.
+    If there are multiple entries with the identical information - then return only one.
+    If there is no Definition, then return the AncestorDefinition.
+    Always include the DiseaseID and DiseaseName.\n\n"""
+
+    seen = set()
+
+    for entity in entities:
+        disease_id = entity.get('DiseaseID', 'Unknown')
+        entity_name = entity.get('DiseaseName', 'Unknown')
+
+        if (disease_id, entity_name) in seen:
+            continue
+        seen.add((disease_id, entity_name))
+
+        entry = f"DiseaseID: {disease_id}\nDiseaseName: {entity_name}"
+
+        definition = entity.get('Definition')
+        if definition and not (isinstance(definition, float) and math.isnan(definition)):
+            entry += f"\nDefinition: {definition}"
+        else:
+            ancestor_definition = entity.get('AncestorDefinition')
+            if ancestor_definition and not (isinstance(ancestor_definition, float) and math.isnan(ancestor_definition)):
+                entry += f"\nAncestorDefinition: {ancestor_definition}"
+
+        entry += f"\nDistance: {entity.get('Distance', 'Unknown')}\n"
+        prompt += "\n" + entry
+
+    return prompt
+
+
+class LinkingService:
+    """
+    Keeps the embedding model and the driver (and with it the Neo4j connection pool) warm and links
+    concurrent requests in micro-batches: one `get_text_embedding_batch` and one `combined_search_batch`
+    per batch instead of per request. The blocking calls run on a small thread pool so the event loop
+    keeps accepting requests meanwhile.
+
+    Parameters:
+        embed_model: A llama_index embedding model (or anything with `get_text_embedding_batch`).
+        driver: The Neo4j driver, or an in-process stand-in.
+        context (DiseaseContext): Optional nearest-defined-ancestor table for the RAG prompt.
+        limit (int): The number of candidates searched per mention, the most a request can ask for.
+        threads (int): The size of the thread pool, and so the number of batches linked at once.
+        search_kwargs: Passed to `combined_search_batch`, e.g. `vector_engines` or `exact_match_index`.
+    """
+
+    def __init__(
+            self,
+            embed_model,
+            driver,
+            context: Optional[DiseaseContext] = None,
+            limit=5,
+            max_batch_size=32,
+            max_wait_ms=5.0,
+            max_pending=1024,
+            threads=2,
+            llm_url=ollama_url,
+            llm_model='llama3',
+            **search_kwargs
+            ):
+        self.embed_model = embed_model
+        self.driver = driver
+        self.context = context
+        self.limit = limit
+        self.search_kwargs = search_kwargs
+        self.llm_url = llm_url
+        self.llm_model = llm_model
+
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.batcher = MicroBatcher(self._link_batch, max_batch_size, max_wait_ms, max_pending, max_concurrent_batches=threads)
+        self.http: Optional[ClientSession] = None
+
+    def _link_batch_sync(self, disease_names: List[str]) -> List[list]:
+        embeddings = self.embed_model.get_text_embedding_batch(disease_names)
+        return combined_search_batch(disease_names, embeddings, self.driver, self.limit, **self.search_kwargs)
+
+    async def _link_batch(self, disease_names: List[str]) -> List[list]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._link_batch_sync, disease_names)
+
+    def check_limit(self, limit) -> int:
+        """
+        Returns the number of candidates to return for a requested `limit`, `self.limit` when it is None.
+        """
+        if limit is None:
+            return self.limit
+
+        if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= self.limit:
+            raise ValueError(f'"limit" must be an integer between 1 and {self.limit}')
+
+        return limit
+
+    async def link(self, disease_names: List[str], limit: Optional[int] = None) -> List[list]:
+        limit = self.check_limit(limit)
+        candidate_lists = await self.batcher.submit(disease_names)
+
+        return [candidates[:limit] for candidates in candidate_lists]
+
+    def get_entities(self, candidates: list) -> List[dict]:
+        if self.context is not None:
+            return self.context.get_entities([candidates])[0]
+
+        return [{'DiseaseID': candidate['MESH_ID'], 'DiseaseName': candidate['Description']} for candidate in candidates]
+
+    async def stream_llm(self, prompt: str):
+        """
+        Yields the response tokens of the ollama generate endpoint as they arrive.
+        """
+        payload = {'model': self.llm_model, 'prompt': prompt, 'temperature': 0.5, 'max_tokens': 1000}
+
+        async with self.http.post(self.llm_url, json=payload) as response:
+            response.raise_for_status()
+
+            async for line in response.content:
+                if line.strip():
+                    part = json.loads(line)
+                    if part.get('response'):
+                        yield part['response']
+                    if part.get('done'):
+                        break
+
+    async def on_startup(self, app: web.Application):
+        self.http = ClientSession()
+        self.batcher.start()
+
+    async def on_cleanup(self, app: web.Application):
+        await self.batcher.stop()
+        await self.http.close()
+        self.executor.shutdown(wait=False)
+        self.driver.close()
+
+async def read_body(request: web.Request) -> dict:
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text='The request body must be JSON')
+
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text='The request body must be a JSON object')
+
+    return body
+
+async def link_or_shed(service: LinkingService, mentions: List[str], limit) -> List[list]:
+    """
+    Links the mentions, turning a bad `limit` into 400, a full queue into a retryable 503 and a
+    request that could never be admitted into 413.
+    """
+    try:
+        limit = service.check_limit(limit)
+    except ValueError as error:
+        raise web.HTTPBadRequest(text=str(error))
+
+    try:
+        return await service.link(mentions, limit)
+    except Overloaded:
+        raise web.HTTPServiceUnavailable(text='Too many pending mentions', headers={'Retry-After': '1'})
+    except RequestTooLarge:
+        raise web.HTTPRequestEntityTooLarge(
+            service.batcher.max_pending,
+            len(mentions),
+            text=f'At most {service.batcher.max_pending} mentions per request'
+        )
+
+SERVICE_KEY = web.AppKey('service', LinkingService)
+
+async def handle_link(request: web.Request) -> web.Response:
+    """
+    POST /link with {"mentions": [...], "limit": 5} (or a single "disease_name")
+    returns {"results": [[candidate, ...], ...]} in the order of the mentions.
+    The limit defaults to, and can't exceed, the limit of the service.
+    """
+    service = request.app[SERVICE_KEY]
+    body = await read_body(request)
+    mentions = body.get('mentions', [body['disease_name']] if 'disease_name' in body else [])
+
+    if not isinstance(mentions, list) or not all(isinstance(mention, str) for mention in mentions):
+        raise web.HTTPBadRequest(text='"mentions" must be a list of strings')
+
+    results = await link_or_shed(service, mentions, body.get('limit'))
+
+    return web.json_response({'results': to_json_value(results)})
+
+async def handle_generate(request: web.Request) -> web.StreamResponse:
+    """
+    POST /generate with {"disease_name": "..."} links the mention, builds the RAG prompt and streams
+    the LLM answer back as newline-delimited JSON: the entities first, then one line per token.
+    """
+    service = request.app[SERVICE_KEY]
+    body = await read_body(request)
+    disease_name = body.get('disease_name')
+
+    if not isinstance(disease_name, str):
+        raise web.HTTPBadRequest(text='"disease_name" must be a string')
+
+    candidates = (await link_or_shed(service, [disease_name], body.get('limit')))[0]
+
+    entities = service.get_entities(candidates)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    await response.write((json.dumps({'entities': to_json_value(entities)}) + '\n').encode('utf-8'))
+
+    async for token in service.stream_llm(build_prompt(disease_name, entities)):
+        await response.write((json.dumps({'token': token}) + '\n').encode('utf-8'))
+
+    await response.write_eof()
+    return response
+
+async def handle_stats(request: web.Request) -> web.Response:
+    service = request.app[SERVICE_KEY]
+    return web.json_response({**service.batcher.stats, 'pending': service.batcher.pending})
+
+async def handle_health(request: web.Request) -> web.Response:
+    return web.json_response({'status': 'ok'})
+
+def create_app(service: LinkingService) -> web.Application:
+    app = web.Application()
+    app[SERVICE_KEY] = service
+    app.on_startup.append(service.on_startup)
+    app.on_cleanup.append(service.on_cleanup)
+    app.add_routes([
+        web.post('/link', handle_link),
+        web.post('/generate', handle_generate),
+        web.get('/stats', handle_stats),
+        web.get('/health', handle_health)
+    ])
+
+    return app
+
+
+class HashedEmbeddingModel:
+    """
+    Stand-in for the embedding model, see `utils.benchmark.hashed_embedding`.
+    """
+
+    def get_text_embedding_batch(self, texts: List[str]) -> List[list]:
+        from utils.benchmark import hashed_embedding
+        return [hashed_embedding(text).tolist() for text in texts]
+
+def create_llm_standin_app(tokens_per_second=200.0) -> web.Application:
+    """
+    Stand-in for the ollama generate endpoint, streaming back the DiseaseName lines of the prompt word by word.
+    """
+    async def generate(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        words = ' '.join(line for line in body['prompt'].splitlines() if line.startswith('DiseaseName')).split()
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+
+        for word in words:
+            await asyncio.sleep(1 / tokens_per_second)
+            await response.write((json.dumps({'response': word + ' ', 'done': False}) + '\n').encode('utf-8'))
+
+        await response.write((json.dumps({'response': '', 'done': True}) + '\n').encode('utf-8'))
+        return response
+
+    app = web.Application()
+    app.add_routes([web.post('/api/generate', generate)])
+
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve entity linking and RAG answers over HTTP.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--max-pending', type=int, default=1024)
+    parser.add_argument('--context-path', default=None, help='Saved DiseaseContext table for the RAG prompt')
+    parser.add_argument('--llm-url', default=ollama_url)
+    parser.add_argument('--standin', action='store_true', help='Use in-process stand-ins for Neo4j and the embedding model')
+    args = parser.parse_args()
+
+    if args.standin:
+        from utils.benchmark import build_standin_driver, get_standin_records, load_split
+        embed_model = HashedEmbeddingModel()
+        driver = build_standin_driver(get_standin_records(load_split('train')))
+    else:
+        from utils.embedding_pipeline import get_embed_model
+        from utils.generic import get_driver
+        embed_model = get_embed_model(Models.BAAI_BGE_SMALL_EN_V1_5)
+        driver = get_driver()
+
+    service = LinkingService(
+        embed_model,
+        driver,
+        context=DiseaseContext.load(args.context_path) if args.context_path else None,
+        limit=args.limit,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_pending=args.max_pending,
+        llm_url=args.llm_url
+    )
+
+    web.run_app(create_app(service), host=args.host, port=args.port)
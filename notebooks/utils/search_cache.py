@@ -0,0 +1,156 @@
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+
+###########
+# QUERIES #
+###########
+
+create_cache_table_query = """
+    CREATE TABLE IF NOT EXISTS search_cache (
+        key TEXT PRIMARY KEY,
+        version TEXT NOT NULL,
+        created REAL NOT NULL,
+        value TEXT NOT NULL
+    )
+"""
+
+select_cache_entry_query = "SELECT created, value FROM search_cache WHERE key = ? AND version = ?"
+
+upsert_cache_entry_query = "INSERT OR REPLACE INTO search_cache (key, version, created, value) VALUES (?, ?, ?, ?)"
+
+delete_stale_entries_query = "DELETE FROM search_cache WHERE version != ?"
+
+delete_expired_entry_query = "DELETE FROM search_cache WHERE key = ?"
+
+###########
+# HELPERS #
+###########
+
+def make_cache_key(disease_name: str, name_vec_index: str, centoid_vec_index: str, limit: int) -> str:
+    # Only the Unicode form is normalised: case and whitespace change the rapidfuzz scores
+    # and the abbreviation check, so folding them would return a different ranking
+    return json.dumps([unicodedata.normalize('NFC', disease_name), name_vec_index, centoid_vec_index, limit])
+
+
+class SearchCache:
+    """
+    Two-tier cache for `combined_search` results.
+
+    The memory tier is an LRU bounded by `max_size` entries, the optional disk tier is a SQLite file
+    at `path` that survives restarts. Both honour `ttl` (seconds) and are invalidated when `version`
+    (e.g. a KB release or index build stamp) changes.
+    """
+
+    def __init__(self, max_size=10000, ttl: Optional[float] = None, path: Optional[str] = None, version=''):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(create_cache_table_query)
+            self.connection.execute(delete_stale_entries_query, (version,))
+            self.connection.commit()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remember(self, key: str, created: float, value: list):
+        self.entries[key] = (created, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[list]:
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and self._expired(entry[0]):
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return [dict(candidate) for candidate in entry[1]]
+
+            if self.connection is not None:
+                row = self.connection.execute(select_cache_entry_query, (key, self.version)).fetchone()
+
+                if row is not None and self._expired(row[0]):
+                    self.connection.execute(delete_expired_entry_query, (key,))
+                    self.connection.commit()
+                    self.expirations += 1
+                    row = None
+
+                if row is not None:
+                    value = json.loads(row[1])
+                    self._remember(key, row[0], value)
+                    self.disk_hits += 1
+                    return [dict(candidate) for candidate in value]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: list):
+        # Store copies, callers go on to add keys such as 'True MESH_ID' to the returned candidates
+        value = [dict(candidate) for candidate in value]
+        created = time.time()
+
+        with self.lock:
+            self._remember(key, created, value)
+
+            if self.connection is not None:
+                self.connection.execute(upsert_cache_entry_query, (key, self.version, created, json.dumps(value)))
+                self.connection.commit()
+
+    def set_version(self, version: str):
+        """
+        Invalidates every entry written for another KB/index version.
+        """
+        with self.lock:
+            self.version = version
+            self.entries.clear()
+
+            if self.connection is not None:
+                self.connection.execute(delete_stale_entries_query, (version,))
+                self.connection.commit()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+
+        return {
+            'size': len(self.entries),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0
+        }
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
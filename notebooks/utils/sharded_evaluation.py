@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from typing import Callable, Iterator, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+from neo4j import Driver
+
+from utils.evalutation import evaluate_predictions
+from utils.index_search_helpers import get_combined_search_for_df
+
+
+#############
+# CONSTANTS #
+#############
+
+manifest_file = 'manifest.json'
+
+###########
+# HELPERS #
+###########
+
+# One driver per worker process, created by the pool initializer and reused for all its chunks
+_worker_driver: Optional[Driver] = None
+_worker_search_kwargs: dict = {}
+
+def _init_evaluation_worker(driver_factory: Callable[[], Driver], search_kwargs: dict, snapshot_path: Optional[str] = None):
+    global _worker_driver, _worker_search_kwargs
+    _worker_driver = driver_factory()
+    _worker_search_kwargs = search_kwargs
+
+    if snapshot_path is not None:
+        # Every worker maps the snapshot files itself, the OS shares their pages between the processes
+        from utils.kb_snapshot import KBSnapshot
+        _worker_search_kwargs = {**KBSnapshot(snapshot_path).search_kwargs(), **search_kwargs}
+
+def get_chunk_path(output_dir: str, chunk: int) -> str:
+    return os.path.join(output_dir, f'chunk-{chunk:05d}.jsonl')
+
+def to_json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def write_chunk(path: str, disease_predictions: List[list]):
+    # Written under a temporary name and renamed, so a chunk file on disk is always complete
+    temporary_path = path + '.tmp'
+
+    with open(temporary_path, 'w') as f:
+        for predictions in disease_predictions:
+            f.write(json.dumps(predictions, default=to_json_default) + '\n')
+
+    os.replace(temporary_path, path)
+
+def read_chunk(path: str) -> Iterator[list]:
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+def _evaluate_chunk(chunk: int, dataset: pd.DataFrame, embedding_col: str, output_dir: str) -> tuple:
+    started = time.perf_counter()
+    disease_predictions = get_combined_search_for_df(dataset, embedding_col, _worker_driver, **_worker_search_kwargs)
+    write_chunk(get_chunk_path(output_dir, chunk), disease_predictions)
+
+    return chunk, len(disease_predictions), time.perf_counter() - started
+
+def get_snapshot_identity(snapshot_path: str) -> dict:
+    from utils.kb_snapshot import KBSnapshot
+    snapshot = KBSnapshot(snapshot_path)
+
+    return {'path': os.path.abspath(snapshot_path), 'version': snapshot.version, 'created': snapshot.manifest['created']}
+
+def get_run_fingerprint(
+        dataset: pd.DataFrame,
+        embedding_col: str,
+        chunk_size: int,
+        search_kwargs: dict,
+        snapshot_path: Optional[str] = None
+        ) -> str:
+    """
+    Identifies a run by its mentions, chunking, search settings and KB snapshot, so a checkpoint is only
+    resumed by the run that wrote it. The search settings must be JSON values: engines and caches have
+    no stable identity across processes, pass them as a `snapshot_path` instead.
+    """
+    try:
+        settings = json.dumps(search_kwargs, sort_keys=True, default=to_json_default)
+    except TypeError as error:
+        raise ValueError(f'Search settings must be JSON values, pass the engines as a KB snapshot: {error}') from error
+
+    snapshot = get_snapshot_identity(snapshot_path) if snapshot_path is not None else None
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps([embedding_col, chunk_size, settings, snapshot]).encode('utf-8'))
+
+    for disease_name, true_mesh_id in zip(dataset['Description'], dataset['MESH ID']):
+        fingerprint.update(f'{disease_name}\t{true_mesh_id}\n'.encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+def load_manifest(output_dir: str) -> Optional[dict]:
+    path = os.path.join(output_dir, manifest_file)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+def get_completed_chunks(output_dir: str, n_chunks: int) -> List[int]:
+    return [chunk for chunk in range(n_chunks) if os.path.exists(get_chunk_path(output_dir, chunk))]
+
+def read_predictions(output_dir: str) -> Iterator[list]:
+    """
+    Streams the prediction lists of a completed run in the order of the annotations DataFrame.
+    """
+    manifest = load_manifest(output_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'No evaluation run in {output_dir}')
+
+    for chunk in range(manifest['chunks']):
+        yield from read_chunk(get_chunk_path(output_dir, chunk))
+
+def merge_evaluation(
+        output_dir: str,
+        dataset: Optional[pd.DataFrame] = None,
+        k_values: Sequence[int] = (1, 3, 5, 10),
+        n_resamples=0
+        ) -> dict:
+    """
+    Feeds the chunk files of a completed run to `evaluate_predictions`, broken down by the
+    'Type' column of `dataset` when given.
+    """
+    manifest = load_manifest(output_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'No evaluation run in {output_dir}')
+
+    missing = manifest['chunks'] - len(get_completed_chunks(output_dir, manifest['chunks']))
+    if missing > 0:
+        raise ValueError(f'{missing} of {manifest["chunks"]} chunks in {output_dir} are not done yet')
+
+    mention_types = dataset['Type'].tolist() if dataset is not None and 'Type' in dataset.columns else None
+
+    return evaluate_predictions(read_predictions(output_dir), k_values, mention_types, n_resamples)
+
+def run_sharded_evaluation(
+        dataset: pd.DataFrame,
+        embedding_col: str,
+        output_dir: str,
+        driver_factory: Callable[[], Driver] = None,
+        workers: Optional[int] = None,
+        chunk_size=200,
+        batch_size: Optional[int] = 50,
+        k_values: Sequence[int] = (1, 3, 5, 10),
+        n_resamples=0,
+        snapshot_path: Optional[str] = None,
+        verbose=False,
+        **search_kwargs
+        ) -> dict:
+    """
+    Runs `get_combined_search_for_df` over the annotations in chunks of `chunk_size` mentions on a pool of
+    `workers` processes, each with its own driver, writing every chunk to `output_dir` as soon as it is done.
+    Running it again with the same arguments resumes from the chunks already on disk.
+
+    Parameters:
+        dataset (DataFrame): The annotations with 'Description', 'MESH ID' and the embedding column.
+        embedding_col (str): The column with the mention embeddings.
+        output_dir (str): The checkpoint directory, one JSON lines file per chunk.
+        driver_factory (callable): Creates the driver of a worker, `get_driver` by default. It must be
+            picklable, e.g. a module-level function or a `functools.partial` of one.
+        workers (int): The number of processes, all cores by default.
+        chunk_size (int): The number of mentions per chunk, the unit of checkpointing.
+        batch_size (int): Passed to `get_combined_search_for_df`, None to search mention by mention.
+        snapshot_path (str): A `KBSnapshot` every worker loads its engines from, instead of querying the driver.
+        search_kwargs: Passed to `get_combined_search_for_df`, e.g. `limit`. They must be JSON values,
+            as they identify the run for resuming.
+
+    Returns:
+        dict: The metrics of `evaluate_predictions`, with the run's chunk and timing statistics under 'run'.
+    """
+    if driver_factory is None:
+        from utils.generic import get_driver
+        driver_factory = get_driver
+
+    search_kwargs = {'batch_size': batch_size, **search_kwargs}
+    dataset = dataset.reset_index(drop=True)
+    n_chunks = (len(dataset) + chunk_size - 1) // chunk_size
+    fingerprint = get_run_fingerprint(dataset, embedding_col, chunk_size, search_kwargs, snapshot_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+
+    if manifest is not None and manifest['fingerprint'] != fingerprint:
+        raise ValueError(f'{output_dir} holds a different evaluation run, use another directory or remove it')
+
+    if manifest is None:
+        with open(os.path.join(output_dir, manifest_file), 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'chunks': n_chunks, 'chunk_size': chunk_size, 'mentions': len(dataset)}, f)
+
+    completed = set(get_completed_chunks(output_dir, n_chunks))
+    pending = [chunk for chunk in range(n_chunks) if chunk not in completed]
+    columns = ['Description', 'MESH ID', embedding_col]
+
+    started = time.perf_counter()
+    chunk_seconds = []
+
+    if pending:
+        with ProcessPoolExecutor(
+            max_workers=min(workers or os.cpu_count(), len(pending)),
+            initializer=_init_evaluation_worker,
+            initargs=(driver_factory, search_kwargs, snapshot_path)
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _evaluate_chunk,
+                    chunk,
+                    dataset.loc[chunk * chunk_size:(chunk + 1) * chunk_size - 1, columns],
+                    embedding_col,
+                    output_dir
+                )
+                for chunk in pending
+            ]
+
+            for future in as_completed(futures):
+                chunk, n_mentions, seconds = future.result()
+                chunk_seconds.append(seconds)
+
+                if verbose:
+                    print(f'Chunk {chunk + 1}/{n_chunks}: {n_mentions} mentions in {seconds:.1f} s')
+
+    wall_seconds = time.perf_counter() - started
+    evaluation = merge_evaluation(output_dir, dataset, k_values, n_resamples)
+    evaluation['run'] = {
+        'chunks': n_chunks,
+        'resumed_chunks': len(completed),
+        'wall_seconds': wall_seconds,
+        'chunk_seconds': sum(chunk_seconds),
+        'mentions_per_second': sum(min(chunk_size, len(dataset) - chunk * chunk_size) for chunk in pending) / wall_seconds if pending else 0.0
+    }
+
+    return evaluation
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate combined search on an annotation split with a process pool.')
+    parser.add_argument('--split', default='test')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--backend', choices=['standin', 'neo4j'], default='neo4j')
+    parser.add_argument('--kb-split', default='train', help='Split whose annotations make up the stand-in knowledge base')
+    parser.add_argument('--store-dir', default=None, help='EmbeddingStore with the mention embeddings (neo4j backend)')
+    parser.add_argument('--snapshot', default=None, help='KB snapshot the workers link against instead of the backend')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--max-mentions', type=int, default=None)
+    args = parser.parse_args()
+
+    from utils.benchmark import build_standin_driver, get_mention_embedder, get_standin_records, load_split
+    from utils.generic import Models
+
+    dataset = load_split(args.split).iloc[:args.max_mentions]
+    embed = get_mention_embedder(args.backend, Models.BAAI_BGE_SMALL_EN_V1_5, args.store_dir)
+    dataset['MentionEmbedding'] = [np.asarray(embed(row), dtype=np.float32).tolist() for row in dataset.itertuples(index=False)]
+
+    if args.backend == 'standin':
+        driver_factory = partial(build_standin_driver, get_standin_records(load_split(args.kb_split)))
+    else:
+        driver_factory = None
+
+    evaluation = run_sharded_evaluation(
+        dataset,
+        'MentionEmbedding',
+        args.output_dir,
+        driver_factory=driver_factory,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        limit=args.limit,
+        snapshot_path=args.snapshot,
+        verbose=True
+    )
+
+    print(json.dumps(evaluation, indent=2))
@@ -0,0 +1,88 @@
+from typing import Dict, List
+import numpy as np
+from rapidfuzz import fuzz, distance, process
+
+
+#############
+# CONSTANTS #
+#############
+
+# Metric name -> (scorer, result dtype), matching the values produced by `calculate_string_similarity`
+string_similarity_scorers = {
+    "weighted_ratio": (fuzz.WRatio, np.float64),
+    "token_set_ratio": (fuzz.token_set_ratio, np.float64),
+    "JaroWinkler_distance": (distance.JaroWinkler.similarity, np.float64),
+    "LCSseq_distance": (distance.LCSseq.similarity, np.int64),
+}
+
+###########
+# HELPERS #
+###########
+
+def get_candidate_names(prediction: dict) -> List[str]:
+    synonyms = prediction['Synonyms'] if isinstance(prediction['Synonyms'], str) else ""
+
+    return synonyms.split('|') + [prediction['Description']]
+
+def calculate_string_similarity_batch(
+        names_per_candidate: List[List[str]],
+        disease_name: str,
+        workers=1
+        ) -> Dict[str, np.ndarray]:
+    """
+    Calculates the best similarity of every candidate's names to the disease name.
+
+    All names are flattened into one choices array and scored with a single `rapidfuzz.process.cdist`
+    call per metric, then reduced to a per-candidate maximum with `np.maximum.reduceat`.
+
+    Parameters:
+        names_per_candidate (list): A list with the (non-empty) list of names and synonyms of each candidate.
+        disease_name (str): The mention to compare against.
+        workers (int): The number of threads used by cdist, -1 uses all cores.
+
+    Returns:
+        dict: A mapping of metric name to an array with one value per candidate.
+    """
+    if len(names_per_candidate) == 0:
+        return {metric: np.empty(0, dtype=dtype) for metric, (_, dtype) in string_similarity_scorers.items()}
+
+    lengths = np.array([len(names) for names in names_per_candidate])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    choices = [name if isinstance(name, str) else "" for names in names_per_candidate for name in names]
+
+    similarity_metrics = {}
+
+    for metric, (scorer, dtype) in string_similarity_scorers.items():
+        scores = process.cdist(choices, [disease_name], scorer=scorer, dtype=dtype, workers=workers)[:, 0]
+        similarity_metrics[metric] = np.maximum.reduceat(scores, offsets)
+
+    return similarity_metrics
+
+def rescore_predictions(prediction_lists: List[list], disease_name: str, workers=1) -> List[list]:
+    """
+    Adds the string similarity metrics to every prediction of the given lists in place.
+
+    Candidates are deduplicated by MESH_ID first, so a disease returned by several retrievers is scored once.
+    """
+    unique_predictions = {}
+    for predictions in prediction_lists:
+        for prediction in predictions:
+            unique_predictions.setdefault(prediction['MESH_ID'], prediction)
+
+    mesh_ids = list(unique_predictions.keys())
+    similarity_metrics = calculate_string_similarity_batch(
+        [get_candidate_names(unique_predictions[mesh_id]) for mesh_id in mesh_ids],
+        disease_name,
+        workers
+    )
+
+    rankings = {
+        mesh_id: {metric: values[i].item() for metric, values in similarity_metrics.items()}
+        for i, mesh_id in enumerate(mesh_ids)
+    }
+
+    for predictions in prediction_lists:
+        for prediction in predictions:
+            prediction.update(rankings[prediction['MESH_ID']])
+
+    return prediction_lists
@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+from array import array
+from collections import deque
+from typing import Dict, Optional
+import numpy as np
+
+
+#############
+# CONSTANTS #
+#############
+
+# Upper bounds (ms) of the histogram buckets, the last bucket collects everything slower
+histogram_buckets_ms = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+# Span attributes that are counts and get summed up per span name
+counted_attributes = {'rows', 'candidates', 'hits', 'sort_keys'}
+
+###########
+# HELPERS #
+###########
+
+class Span:
+    """
+    A timed stage of the pipeline. Attributes such as candidate or row counts are attached with `set`.
+    """
+    __slots__ = ('tracer', 'name', 'attrs', 'start')
+
+    def __init__(self, tracer: 'Tracer', name: str, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = 0
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.record(self, time.perf_counter_ns())
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class NullSpan:
+    """
+    Shared do-nothing span handed out while tracing is disabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+null_span = NullSpan()
+
+
+class Tracer:
+    """
+    Collects spans from every thread: per-name durations and totals of the counted attributes for the histograms,
+    and the last `max_spans` spans for the Chrome trace export (chrome://tracing or Perfetto).
+
+    Disabled by default, `span` then returns `null_span` and nothing is recorded.
+    """
+
+    def __init__(self, enabled=False, max_spans=100000):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset(max_spans)
+
+    def reset(self, max_spans: Optional[int] = None):
+        with self.lock:
+            self.spans = deque(maxlen=max_spans if max_spans is not None else self.spans.maxlen)
+            self.durations: Dict[str, array] = {}
+            self.totals: Dict[str, dict] = {}
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return null_span
+
+        return Span(self, name, attrs)
+
+    def record(self, span: Span, end: int):
+        duration = end - span.start
+
+        with self.lock:
+            self.spans.append((span.name, span.start, duration, threading.get_ident(), span.attrs))
+            self.durations.setdefault(span.name, array('q')).append(duration)
+
+            totals = self.totals.setdefault(span.name, {})
+            for key, value in span.attrs.items():
+                if key in counted_attributes:
+                    totals[key] = totals.get(key, 0) + value
+
+    def histograms(self) -> Dict[str, dict]:
+        """
+        Aggregates the recorded durations per span name.
+
+        Returns:
+            dict: For every span name the count, total/mean/percentile/max wall time in ms, the number
+            of spans per bucket of `histogram_buckets_ms` and the totals of `counted_attributes`.
+        """
+        with self.lock:
+            durations = {name: np.frombuffer(values, dtype=np.int64) / 1e6 for name, values in self.durations.items()}
+            totals = {name: dict(values) for name, values in self.totals.items()}
+
+        histograms = {}
+        for name, values in durations.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            histograms[name] = {
+                'count': len(values),
+                'total_ms': float(values.sum()),
+                'mean_ms': float(values.mean()),
+                'p50_ms': float(p50),
+                'p95_ms': float(p95),
+                'p99_ms': float(p99),
+                'max_ms': float(values.max()),
+                'buckets': np.bincount(
+                    np.searchsorted(histogram_buckets_ms, values), minlength=len(histogram_buckets_ms) + 1
+                ).tolist(),
+                'totals': totals.get(name, {})
+            }
+
+        return histograms
+
+    def chrome_trace(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+
+        pid = os.getpid()
+        return {
+            'traceEvents': [{
+                'name': name,
+                'cat': name.split('.')[0],
+                'ph': 'X',
+                'ts': start / 1000,
+                'dur': duration / 1000,
+                'pid': pid,
+                'tid': tid,
+                'args': {key: value if isinstance(value, (int, float, str, bool)) else str(value) for key, value in attrs.items()}
+            } for name, start, duration, tid, attrs in spans],
+            'displayTimeUnit': 'ms'
+        }
+
+    def write_chrome_trace(self, path: str):
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file)
+
+tracer = Tracer()
+
+def span(name: str, **attrs):
+    """
+    Opens a span on the module tracer, used as `with span('stage') as s: ...; s.set(rows=len(rows))`.
+    """
+    if not tracer.enabled:
+        return null_span
+
+    return Span(tracer, name, attrs)
+
+def enable_tracing(max_spans: Optional[int] = None):
+    if max_spans is not None:
+        tracer.reset(max_spans)
+    tracer.enabled = True
+
+def disable_tracing():
+    tracer.enabled = False
@@ -0,0 +1,202 @@
+from typing import TYPE_CHECKING, List, Optional, Sequence
+import numpy as np
+
+from utils.generic import Models, Vectors
+from utils.index_search_helpers import get_embedding_col_name, parse_embedding
+
+if TYPE_CHECKING:
+    from neo4j import Driver
+    from pandas import DataFrame
+
+
+###########
+# QUERIES #
+###########
+
+embedding_retrieve_query = """
+    MATCH (d:Disease)
+    WHERE d[$embedding_prop] IS NOT NULL
+    RETURN d.DiseaseID AS MESH_ID,
+        d.DiseaseName AS Description,
+        d.AltDiseaseIDs AS AltDiseaseIDs,
+        d.Synonyms AS Synonyms,
+        d[$embedding_prop] AS embedding
+"""
+
+#############
+# CONSTANTS #
+#############
+
+# Node property backing each Neo4j vector index
+vector_index_properties = {
+    Vectors.BAAI_DISEASE_NAME.value: (Models.BAAI_BGE_SMALL_EN_V1_5, 'DiseaseEmbedding'),
+    Vectors.BAAI_DISEASE_SYNONYMS_CENTROID.value: (Models.BAAI_BGE_SMALL_EN_V1_5, 'SynonymsCentroidEmbedding'),
+    Vectors.LLAMA3_DISEASE_NAME.value: (Models.LLAMA3, 'DiseaseEmbedding'),
+    Vectors.LLAMA3_DISEASE_SYNONYMS_CENTROID.value: (Models.LLAMA3, 'SynonymsCentroidEmbedding'),
+}
+
+# float32 rounding leaves the self-similarity of a normalised row a few ulps below 1
+direct_hit_tolerance = 1e-6
+
+###########
+# HELPERS #
+###########
+
+def get_vector_index_property(index: str) -> str:
+    return get_embedding_col_name(*vector_index_properties[index])
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return matrix / norms
+
+def to_index_scores(similarities: np.ndarray) -> np.ndarray:
+    """
+    Maps cosine similarities to the vector index score (1 + cos) / 2, snapping scores within
+    `direct_hit_tolerance` of 1 to exactly 1.0 so direct hits are recognised.
+    """
+    scores = np.clip((1 + similarities) / 2, 0, 1)
+    scores[scores >= 1 - direct_hit_tolerance] = 1.0
+
+    return scores
+
+
+class VectorEngine:
+    """
+    Exact in-process cosine search over the disease embeddings of a single vector index.
+
+    Scores follow the Neo4j vector index convention for cosine similarity, (1 + cos) / 2,
+    so `threshold` values and direct hit checks (score == 1.0) behave as with `vector_index_search`.
+    Storing the matrix as float16 halves the memory, but its rounding can push exact hits below the
+    snapping tolerance of `to_index_scores`, i.e. just below 1.0.
+    """
+
+    def __init__(
+            self,
+            embeddings: np.ndarray,
+            mesh_ids: Sequence[str],
+            descriptions: Sequence[str],
+            synonyms: Sequence[Optional[str]],
+            alt_disease_ids: Sequence[Optional[str]],
+            dtype=np.float32,
+            block_size=65536,
+            normalized=False
+            ):
+        if normalized:
+            # Already normalised rows (e.g. a memory-mapped KB snapshot matrix) are used as they are, without a copy
+            self.matrix = embeddings
+        else:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            self.matrix = np.ascontiguousarray(normalize_rows(embeddings), dtype=dtype)
+
+        self.mesh_ids = list(mesh_ids)
+        self.descriptions = list(descriptions)
+        self.synonyms = list(synonyms)
+        self.alt_disease_ids = list(alt_disease_ids)
+        self.block_size = block_size
+
+    @classmethod
+    def from_driver(cls, driver: 'Driver', index: str, dtype=np.float32) -> 'VectorEngine':
+        embedding_prop = get_vector_index_property(index)
+
+        with driver.session() as session:
+            records = list(session.run(embedding_retrieve_query, embedding_prop=embedding_prop))
+
+        embeddings = [parse_embedding(record['embedding']) for record in records]
+
+        return cls(
+            embeddings=np.array(embeddings, dtype=np.float32),
+            mesh_ids=[record['MESH_ID'] for record in records],
+            descriptions=[record['Description'] for record in records],
+            synonyms=[record['Synonyms'] for record in records],
+            alt_disease_ids=[record['AltDiseaseIDs'] for record in records],
+            dtype=dtype
+        )
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def scores(self, embeddings: np.ndarray) -> np.ndarray:
+        queries = normalize_rows(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+
+        if self.matrix.dtype == np.float32:
+            similarities = queries @ self.matrix.T
+        else:
+            # NumPy has no fast half precision matmul, upcast the matrix block by block
+            similarities = np.empty((queries.shape[0], len(self)), dtype=np.float32)
+            for start in range(0, len(self), self.block_size):
+                block = self.matrix[start:start + self.block_size].astype(np.float32)
+                similarities[:, start:start + self.block_size] = queries @ block.T
+
+        return to_index_scores(similarities)
+
+    def top_k(self, embeddings: np.ndarray, limit=1) -> tuple:
+        scores = self.scores(embeddings)
+        k = min(limit, len(self))
+
+        if k == 0:
+            empty = np.empty((scores.shape[0], 0), dtype=np.int64)
+            return empty, empty.astype(np.float32)
+
+        if k < len(self):
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(len(self)), (scores.shape[0], 1))
+
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def search_batch(self, embeddings: np.ndarray, limit=1, threshold=0.80) -> List[list]:
+        indices, scores = self.top_k(embeddings, limit)
+
+        return [
+            [{
+                'MESH_ID': self.mesh_ids[i],
+                'Description': self.descriptions[i],
+                'Synonyms': self.synonyms[i],
+                'AltDiseaseIDs': self.alt_disease_ids[i],
+                'score': float(score)} for i, score in zip(row_indices, row_scores) if score > threshold
+            ]
+            for row_indices, row_scores in zip(indices, scores)
+        ]
+
+    def search(self, embedding: list, limit=1, threshold=0.80) -> list:
+        return self.search_batch(np.asarray(embedding, dtype=np.float32)[None, :], limit, threshold)[0]
+
+def predict_with_vector_engine(
+        dataset: 'DataFrame',
+        engine: VectorEngine,
+        embedding_col: str,
+        limit=1,
+        threshold=0.80,
+        batch_size=1024
+        ) -> list:
+    predicted_values = []
+
+    for start in range(0, len(dataset), batch_size):
+        batch = dataset.iloc[start:start + batch_size]
+        embeddings = np.array([parse_embedding(embedding) for embedding in batch[embedding_col]], dtype=np.float32)
+
+        batch_results = engine.search_batch(embeddings, limit, threshold)
+
+        for (_, row), search_results in zip(batch.iterrows(), batch_results):
+            disease_name = row['Description']
+            true_mesh_id = row['MESH ID']
+
+            for item in search_results:
+                item['True MESH_ID'] = true_mesh_id
+                item['True Description'] = disease_name
+
+            predicted_values.append(search_results if len(search_results) > 0 else [{
+                "MESH_ID": "Unknown",
+                "AltDiseaseIDs": "Unknown",
+                "Description": "Unknown",
+                "True MESH_ID": true_mesh_id,
+                "True Description": disease_name
+                }]
+            )
+
+    return predicted_values